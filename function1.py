@@ -3,6 +3,7 @@ import shutil
 import glob
 import json
 import boto3
+import botocore
 import uuid
 from zipfile import ZipFile
 from datetime import datetime
@@ -11,17 +12,127 @@ from pytz import timezone
 import pymysql.cursors
 import paramiko
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+import numpy as np
 import time
+import logging
+import resource
+import threading
+import hashlib
+import fcntl
+from datetime import timedelta
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 
 
-def Function1(job_id, logger, remote_path, marketdata_ending):
+# columns of the market data Parquet file, in order
+PARQUET_COLUMNS = [
+    'date',
+    'type',
+    'targetGroup',
+    'pricesNet',
+    'consumption',
+    'zip',
+    'city',
+    'households',
+    'rank',
+    'provider',
+    'tariffName',
+    'priceSumNet',
+    'basicRate',
+    'kwhSum',
+    'NCbonus',
+    'Ibonus',
+    'kwhRate'
+]
+
+# a market data row is unique by these columns
+DUPLICATE_SUBSET = ['consumption', 'zip', 'city', 'rank']
+
+# low cardinality string columns, stored dictionary-encoded in Parquet
+CATEGORICAL_COLUMNS = ['provider', 'city', 'tariffName', 'zip', 'type', 'targetGroup']
+
+# pyarrow.parquet.write_table() options of the market data Parquet file,
+# override per call with Function1(parquet_options={...})
+PARQUET_OPTIONS = {
+    'compression': 'zstd',
+    'row_group_size': None,
+    'data_page_size': None,
+}
+
+# lower bounds of the consumption_tier partitions of the market data dataset
+CONSUMPTION_TIERS = [0, 2000, 5000, 10000, 20000, 50000, 100000]
+
+# name of the manifest file at the root of a market data dataset
+MANIFEST_NAME = '_manifest.json'
+
+# column with the row position in the market data Table, a dataset keeps it
+# so readers can restore the original row order across partitions
+ROW_COLUMN = 'row'
+
+# SFTP to S3 multipart transfer defaults, see transfer_sftp_to_s3()
+TRANSFER_CHUNK_SIZE = 16 << 20
+TRANSFER_CONCURRENCY = 8
+TRANSFER_MAX_RETRIES = 3
+
+# S3 accepts no smaller multipart parts, except the last one
+S3_MIN_PART_SIZE = 5 << 20
+
+# host-local ingest manifest of Function1(skip_unchanged=True)
+INGEST_MANIFEST_PATH = os.environ.get('INGEST_MANIFEST_PATH', '/tmp/function1_ingest_manifest.json')
+
+# pyarrow.csv column types of the dtypes from resolve_csv_columns()
+ARROW_CSV_TYPES = {int: pa.int64(), str: pa.string(), float: pa.float64()}
+
+
+
+def Function1(job_id, logger, remote_path, marketdata_ending, streaming=False, workers=None, max_memory_mb=None,
+              engine='pandas', parquet_options=None, layout='file', pipelined=False, transfer='get',
+              transfer_options=None, skip_unchanged=False):
     """
     Function1 task:
     - download ZIP files from SFTP server
     - upload it to ZIP-bucket at Amazon S3
     - create Parquet file from ZIP of CSV files
     - upload it to Parquet-bucket at Amazon S3
+    
+    With streaming=True the CSV files are decoded straight out of the ZIP
+    archive and never extracted to /tmp, so peak disk usage is the ZIP size
+    plus the Parquet output.
+    
+    With workers=N the CSV files are parsed by a pool of N processes, see
+    read_csv_files_parallel().
+    
+    With engine='arrow' the CSV files are converted by
+    convert_csv_to_parquet_arrow() without a pandas round trip.
+    
+    parquet_options overrides codec, row group size and page size of the
+    Parquet file, see PARQUET_OPTIONS.
+    
+    With layout='dataset' the market data is saved as Hive-partitioned
+    dataset <date>_<ending>/ with a manifest, see write_parquet_dataset().
+    
+    With pipelined=True the stages after the SFTP download run concurrently,
+    see convert_zip_pipelined().
+    
+    With transfer='multipart' the ZIP is streamed from SFTP straight into a
+    S3 multipart upload and written to /tmp on the way, instead of
+    sftp_client.get() followed by s3.upload_file(). transfer_options are
+    passed to transfer_sftp_to_s3().
+    
+    SFTP_PORT and S3_ENDPOINT_URL (optional) point the job at a local SFTP
+    server and S3 stand-in.
+    
+    With skip_unchanged=True the remote file is compared with the ingest
+    manifest (see find_ingest_manifest_entry()) first. If size and mtime,
+    or after the download the SHA-256, are unchanged, the existing Parquet
+    is copied to today's key instead of converting the ZIP again (unless
+    it no longer exists, see reuse_market_data()).
     """
     
     # to get current date file name prefix
@@ -30,7 +141,7 @@ def Function1(job_id, logger, remote_path, marketdata_ending):
     current_date_str = current_date.strftime('%Y%m%d')
     
     # s3 client to upload downloaded files from SFTP
-    s3 = boto3.client('s3')
+    s3 = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
     
     # create work directory
     os.mkdir("/tmp/%s" % job_id)
@@ -39,6 +150,7 @@ def Function1(job_id, logger, remote_path, marketdata_ending):
     ssh_client = paramiko.SSHClient()
     ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     ssh_client.connect(hostname=os.environ['SFTP_HOST'],
+                       port=int(os.environ.get('SFTP_PORT', 22)),
                        username=os.environ['SFTP_USER'],
                        password=os.environ['SFTP_PASSWORD'])
     
@@ -47,44 +159,107 @@ def Function1(job_id, logger, remote_path, marketdata_ending):
     
     
     
+    # skip unchanged remote file
+    parquet_file_name = "/tmp/%s/%s_%s.parquet" % (job_id, current_date_str, marketdata_ending[:-4])
+    parquet_s3_key = market_data_key(parquet_file_name, layout)
+    ingest_entry = None
+    if skip_unchanged:
+        remote_stat = sftp_client.stat(remote_path)
+        ingest_entry = {'remote_path': remote_path,
+                        'size': remote_stat.st_size,
+                        'mtime': int(remote_stat.st_mtime),
+                        'sha256': None,
+                        'parquet_key': parquet_s3_key,
+                        'layout': layout}
+        previous_entry = find_ingest_manifest_entry(s3, remote_path, marketdata_ending, current_date, layout)
+        if previous_entry is not None and (previous_entry['size'], previous_entry['mtime']) == (ingest_entry['size'], ingest_entry['mtime']):
+            logger.info("Remote file unchanged (size, mtime) since %s" % previous_entry['parquet_key'])
+            if reuse_market_data(logger, s3, previous_entry, current_date_str, marketdata_ending):
+                sftp_client.close()
+                shutil.rmtree("/tmp/%s" % job_id)
+                return
+            # the previous market data is gone, convert the file again
+            previous_entry = None
+    
+    
+    
     # download ZIP file from SFTP
     s = time.time()
     local_path  = "/tmp/%s/%s" % (job_id, marketdata_ending)
-    sftp_client.get(remote_path, local_path)
-    logger.info("Time to download via SFTP: %d" % (time.time() - s))
+    s3_key = "%s_%s" % (current_date_str, marketdata_ending)
+    if transfer == 'multipart':
+        # upload ZIP to Amazon S3 while downloading it
+        transfer_sftp_to_s3(logger, sftp_client, remote_path, s3, os.environ['S3_BUCKET_ORIGIN'], s3_key,
+                            local_path, **(transfer_options or {}))
+        logger.info("Time to transfer from SFTP to S3: %d" % (time.time() - s))
+    else:
+        sftp_client.get(remote_path, local_path)
+        logger.info("Time to download via SFTP: %d" % (time.time() - s))
     
     # close SFTP connection
     sftp_client.close()
     
+    # skip ZIP file with unchanged content
+    if skip_unchanged:
+        ingest_entry['sha256'] = file_sha256(local_path)
+        if previous_entry is not None and previous_entry['sha256'] == ingest_entry['sha256']:
+            logger.info("Remote file content unchanged since %s" % previous_entry['parquet_key'])
+            previous_entry.update(size=ingest_entry['size'], mtime=ingest_entry['mtime'])
+            if reuse_market_data(logger, s3, previous_entry, current_date_str, marketdata_ending, stat_changed=True):
+                shutil.rmtree("/tmp/%s" % job_id)
+                return
+    
+    if pipelined:
+        convert_zip_pipelined(job_id, logger, s3, local_path, marketdata_ending, current_date_str,
+                              {'download': (0, time.time() - s)}, streaming=streaming, workers=workers,
+                              max_memory_mb=max_memory_mb, engine=engine, parquet_options=parquet_options,
+                              layout=layout, upload_zip=transfer != 'multipart', ingest_entry=ingest_entry)
+        if ingest_entry is not None:
+            write_ingest_manifest_entry(ingest_entry)
+        shutil.rmtree("/tmp/%s" % job_id)
+        return
+    
     # upload ZIP to Amazon S3
-    s = time.time()
-    s3_key = "%s_%s" % (current_date_str, marketdata_ending)
-    s3.upload_file(local_path, os.environ['S3_BUCKET_ORIGIN'], s3_key)
-    logger.info("Time to upload to S3: %d" % (time.time() - s))
+    if transfer != 'multipart':
+        s = time.time()
+        s3.upload_file(local_path, os.environ['S3_BUCKET_ORIGIN'], s3_key)
+        logger.info("Time to upload to S3: %d" % (time.time() - s))
     
     
     
-    # extract the ZIP file
-    s = time.time()
-    zip_path     = "/tmp/%s/%s"         % (job_id, marketdata_ending)
-    extract_path = "/tmp/%s/extracted/" % (job_id)
-    zip_ref = ZipFile(zip_path, 'r')
-    zip_ref.extractall(extract_path)
-    zip_ref.close()
-    logger.info("Time to extract ZIP file: %d" % (time.time() - s))
+    zip_path = "/tmp/%s/%s" % (job_id, marketdata_ending)
+    if streaming:
+        # read CSV files directly from the ZIP archive
+        csv_files = list_zip_csv_files(zip_path)
+    else:
+        # extract the ZIP file
+        s = time.time()
+        extract_path = "/tmp/%s/extracted/" % (job_id)
+        zip_ref = ZipFile(zip_path, 'r')
+        zip_ref.extractall(extract_path)
+        zip_ref.close()
+        logger.info("Time to extract ZIP file: %d" % (time.time() - s))
+        csv_files = None
     
     
     
     # open all CSV files, combine it and save as Parquet.
-    parquet_file_name = "/tmp/%s/%s_%s.parquet" % (job_id, current_date_str, marketdata_ending[:-4])
-    convert_csv_to_parquet(job_id, logger, marketdata_ending, current_date_str, parquet_file_name)
+    if engine == 'arrow':
+        convert_csv_to_parquet_arrow(job_id, logger, marketdata_ending, current_date_str, parquet_file_name, csv_files,
+                                     parquet_options=parquet_options, layout=layout)
+    else:
+        convert_csv_to_parquet(job_id, logger, marketdata_ending, current_date_str, parquet_file_name, csv_files,
+                               workers=workers, max_memory_mb=max_memory_mb, parquet_options=parquet_options,
+                               layout=layout)
     
     # upload Parquet file to S3 bucket
     s = time.time()
-    s3_key = os.path.basename(parquet_file_name)
-    s3.upload_file(parquet_file_name, os.environ['S3_BUCKET_PARQUET'], s3_key)
+    upload_market_data(s3, parquet_file_name, layout, ingest_entry)
     logger.info("Time to upload Parquet file: %d" % (time.time() - s))
     
+    if ingest_entry is not None:
+        write_ingest_manifest_entry(ingest_entry)
+    
     
     
     # delete work directory
@@ -92,22 +267,565 @@ def Function1(job_id, logger, remote_path, marketdata_ending):
 
 
 
-def convert_csv_to_parquet(job_id, logger, marketdata_ending, current_date_str, parquet_file_name):
+def upload_market_data(s3, parquet_file_name, layout='file', ingest_entry=None):
+    """
+    Upload Parquet file (or dataset, see write_market_data()) to S3 bucket.
+    The ingest manifest entry, if any, is stored as object metadata of the
+    Parquet file (or the dataset manifest).
+    """
+    
+    extra_args = None
+    if ingest_entry is not None:
+        extra_args = {'Metadata': ingest_metadata(ingest_entry)}
+    
+    if layout == 'dataset':
+        upload_parquet_dataset(s3, os.environ['S3_BUCKET_PARQUET'], parquet_file_name[:-len('.parquet')], extra_args)
+    else:
+        s3_key = os.path.basename(parquet_file_name)
+        s3.upload_file(parquet_file_name, os.environ['S3_BUCKET_PARQUET'], s3_key, ExtraArgs=extra_args)
+
+
+
+def market_data_key(parquet_file_name, layout='file'):
+    """
+    S3 key Function3 looks up for the market data: the Parquet file, or the
+    manifest of the dataset.
+    """
+    
+    if layout == 'dataset':
+        return "%s/%s" % (os.path.basename(parquet_file_name)[:-len('.parquet')], MANIFEST_NAME)
+    return os.path.basename(parquet_file_name)
+
+
+
+def file_sha256(path):
+    """
+    SHA-256 hex digest of a local file.
+    """
+    
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+
+def ingest_metadata(ingest_entry):
+    """
+    S3 object metadata of an ingest manifest entry.
+    """
+    
+    return {
+        'remote-path': ingest_entry['remote_path'],
+        'remote-size': str(ingest_entry['size']),
+        'remote-mtime': str(ingest_entry['mtime']),
+        'sha256': ingest_entry['sha256'] or '',
+    }
+
+
+
+def find_ingest_manifest_entry(s3, remote_path, marketdata_ending, current_date, layout='file'):
+    """
+    This function will:
+    - return the entry of remote_path (written with layout) from the
+      host-local ingest manifest
+    - otherwise (e.g. on a new host) read it from the metadata of today's or
+      yesterday's market data object at S3
+    - return None if there is no entry
+    """
+    
+    if os.path.exists(INGEST_MANIFEST_PATH):
+        with open(INGEST_MANIFEST_PATH) as fp:
+            manifest = json.load(fp)
+        if manifest.get(remote_path, {}).get('layout') == layout:
+            return manifest[remote_path]
+    
+    for date in [current_date, current_date - timedelta(1)]:
+        parquet_file_name = "%s_%s.parquet" % (date.strftime('%Y%m%d'), marketdata_ending[:-4])
+        key = market_data_key(parquet_file_name, layout)
+        try:
+            metadata = s3.head_object(Bucket=os.environ['S3_BUCKET_PARQUET'], Key=key)['Metadata']
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+                continue
+            raise
+        if metadata.get('remote-path') == remote_path:
+            return {'remote_path': remote_path,
+                    'size': int(metadata['remote-size']),
+                    'mtime': int(metadata['remote-mtime']),
+                    'sha256': metadata['sha256'] or None,
+                    'parquet_key': key,
+                    'layout': layout}
+    return None
+
+
+
+def write_ingest_manifest_entry(ingest_entry):
+    """
+    Add or replace the entry of a remote file at the host-local ingest
+    manifest. Concurrent jobs are serialized with a file lock.
+    """
+    
+    with open(INGEST_MANIFEST_PATH + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = {}
+        if os.path.exists(INGEST_MANIFEST_PATH):
+            with open(INGEST_MANIFEST_PATH) as fp:
+                manifest = json.load(fp)
+        manifest[ingest_entry['remote_path']] = ingest_entry
+        with open(INGEST_MANIFEST_PATH + '.tmp', 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        os.replace(INGEST_MANIFEST_PATH + '.tmp', INGEST_MANIFEST_PATH)
+
+
+
+def reuse_market_data(logger, s3, ingest_entry, current_date_str, marketdata_ending, stat_changed=False):
+    """
+    This function will:
+    - copy the market data of an unchanged remote file from its previous key
+      to today's key (server-side, file or dataset)
+    - only refresh the object metadata if it is already at today's key and
+      the remote size or mtime changed (stat_changed)
+    - record the new key at the ingest manifest
+    - return False, without copying, if the previous market data no longer
+      exists (e.g. removed by a bucket lifecycle rule), so the caller
+      converts the file again
+    """
+    
+    s = time.time()
+    bucket = os.environ['S3_BUCKET_PARQUET']
+    parquet_file_name = "%s_%s.parquet" % (current_date_str, marketdata_ending[:-4])
+    parquet_s3_key = market_data_key(parquet_file_name, ingest_entry['layout'])
+    
+    # the dataset manifest is uploaded last, so it stands for the partitions too
+    try:
+        s3.head_object(Bucket=bucket, Key=ingest_entry['parquet_key'])
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            logger.info("Market data %s not found, converting again" % ingest_entry['parquet_key'])
+            return False
+        raise
+    
+    if ingest_entry['parquet_key'] == parquet_s3_key and not stat_changed:
+        logger.info("Market data %s is up to date" % parquet_s3_key)
+        write_ingest_manifest_entry(ingest_entry)
+        return True
+    
+    extra_args = {'Metadata': ingest_metadata(ingest_entry), 'MetadataDirective': 'REPLACE'}
+    if ingest_entry['layout'] == 'dataset' and ingest_entry['parquet_key'] != parquet_s3_key:
+        source_prefix = ingest_entry['parquet_key'][:-len(MANIFEST_NAME)]
+        target_prefix = parquet_s3_key[:-len(MANIFEST_NAME)]
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=source_prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'] != ingest_entry['parquet_key']:
+                    s3.copy({'Bucket': bucket, 'Key': obj['Key']}, bucket, target_prefix + obj['Key'][len(source_prefix):])
+    s3.copy({'Bucket': bucket, 'Key': ingest_entry['parquet_key']}, bucket, parquet_s3_key, ExtraArgs=extra_args)
+    logger.info("Time to copy market data %s to %s: %d" % (ingest_entry['parquet_key'], parquet_s3_key, time.time() - s))
+    
+    ingest_entry = dict(ingest_entry, parquet_key=parquet_s3_key)
+    write_ingest_manifest_entry(ingest_entry)
+    return True
+
+
+
+def convert_zip_pipelined(job_id, logger, s3, zip_path, marketdata_ending, current_date_str, stages,
+                          streaming=False, workers=None, max_memory_mb=None, engine='pandas', parquet_options=None,
+                          layout='file', upload_zip=True, ingest_entry=None):
+    """
+    Pipelined variant of the Function1 stages after the SFTP download:
+    - upload ZIP to Amazon S3 in the background, nothing waits for it
+      except the end of the job (skipped with upload_zip=False, when the
+      download already did it)
+    - extract (unless streaming) and parse the CSV members on a thread
+      pool, so finished members are saved while later ones are still
+      parsed, see parse_zip_members()
+    - save as Parquet (streamed in member order, see
+      stream_data_frames_as_parquet(), unless engine='arrow' or
+      layout='dataset'), then upload it
+    - log the critical path instead of per-stage seconds
+    
+    stages maps stage name to (start, end) seconds relative to the start of
+    the job, it already holds the 'download' stage.
+    
+    The download itself is not overlapped: the members of a ZIP are only
+    known once its central directory, at the end of the archive, is there.
+    """
+    
+    t0 = time.time() - stages['download'][1]
+    threads = workers or os.cpu_count()
+    
+    with ThreadPoolExecutor(max_workers=threads + 1) as executor:
+        if upload_zip:
+            s3_key = "%s_%s" % (current_date_str, marketdata_ending)
+            zip_upload = executor.submit(run_stage, stages, 'upload ZIP', t0,
+                                         s3.upload_file, zip_path, os.environ['S3_BUCKET_ORIGIN'], s3_key)
+        
+        extract_path = None if streaming else "/tmp/%s/extracted/" % job_id
+        parsed = parse_zip_members(executor, stages, t0, job_id, logger, zip_path, extract_path, engine, threads,
+                                   max_memory_mb)
+        if engine == 'arrow':
+            data_frames = list(parsed)
+        else:
+            data_frames = drop_duplicates_in_file_order(logger, parsed)
+        
+        parquet_file_name = "/tmp/%s/%s_%s.parquet" % (job_id, current_date_str, marketdata_ending[:-4])
+        if engine == 'arrow':
+            run_stage(stages, 'convert', t0, save_tables_as_parquet,
+                      logger, data_frames, marketdata_ending, parquet_file_name, parquet_options, layout)
+        elif layout == 'dataset':
+            run_stage(stages, 'convert', t0, save_data_frames_as_parquet,
+                      logger, list(data_frames), marketdata_ending, parquet_file_name, parquet_options, layout, True)
+        else:
+            # the file is written while later members are still parsed
+            run_stage(stages, 'convert', t0, stream_data_frames_as_parquet,
+                      logger, data_frames, marketdata_ending, parquet_file_name, parquet_options)
+        del data_frames, parsed
+        
+        run_stage(stages, 'upload Parquet', t0, upload_market_data, s3, parquet_file_name, layout, ingest_entry)
+        if upload_zip:
+            zip_upload.result()
+    
+    # the job ends with whichever chain finishes last
+    chains = [['download', 'parse', 'convert', 'upload Parquet']]
+    if upload_zip:
+        chains.append(['download', 'upload ZIP'])
+    critical_path = max(chains, key=lambda chain: stages[chain[-1]][1])
+    logger.info("Critical path: %d ms (%s)" % (
+        stages[critical_path[-1]][1] * 1000,
+        ', '.join("%s %d-%d ms" % (name, stages[name][0] * 1000, stages[name][1] * 1000) for name in critical_path)))
+    for name in set(stages) - set(critical_path):
+        logger.info("Off critical path: %s %d-%d ms" % (name, stages[name][0] * 1000, stages[name][1] * 1000))
+
+
+
+def parse_zip_members(executor, stages, t0, job_id, logger, zip_path, extract_path, engine, threads,
+                      max_memory_mb=None):
+    """
+    This function will:
+    - submit the CSV members of the ZIP to executor, see read_csv_member(),
+      at most threads at a time and at most max_memory_mb of (uncompressed)
+      CSV input parsed but not yet consumed, but always at least one member
+    - yield the parsed members in ZIP order and submit the next ones as
+      they are consumed, so a slow consumer holds back the parsing instead
+      of piling up DataFrames
+    """
+    
+    max_bytes = max_memory_mb << 20 if max_memory_mb else None
+    
+    pending_files = list_zip_csv_files(zip_path)
+    pending_files.reverse()
+    running = []
+    running_bytes = 0
+    
+    while pending_files or running:
+        # submit as many members as the window allows
+        while pending_files and len(running) < threads:
+            csv_file, _ = pending_files[-1]
+            size = csv_file_size(csv_file, zip_path)
+            if running and max_bytes and running_bytes + size > max_bytes:
+                break
+            pending_files.pop()
+            running.append((executor.submit(run_stage, stages, 'parse', t0, read_csv_member,
+                                            job_id, logger, csv_file, zip_path, extract_path, engine), size))
+            running_bytes += size
+        
+        future, size = running.pop(0)
+        running_bytes -= size
+        yield future.result()
+
+
+
+def transfer_sftp_to_s3(logger, sftp_client, remote_path, s3, bucket, key, local_path=None,
+                        chunk_size=TRANSFER_CHUNK_SIZE, concurrency=TRANSFER_CONCURRENCY,
+                        max_retries=TRANSFER_MAX_RETRIES, upload_id=None):
+    """
+    This function will:
+    - read the remote file in chunks of chunk_size over the open SFTP
+      session, with up to concurrency read requests in flight (readv)
+    - upload each chunk as a part of a S3 multipart upload, up to
+      concurrency parts at a time, each part retried max_retries times
+    - write each chunk to local_path as well, when given
+    - complete the multipart upload
+    
+    Parts of an unfinished multipart upload of the same key (or upload_id)
+    that already have the right size are not uploaded again, so a failed
+    transfer resumes where it stopped. Only an upload started after the
+    last modification of the remote file is resumed (older ones are
+    aborted), and with local_path the MD5 of each re-read chunk must match
+    the ETag of its part.
+    """
+    
+    chunk_size = max(chunk_size, S3_MIN_PART_SIZE)
+    remote_stat = sftp_client.stat(remote_path)
+    size = remote_stat.st_size
+    if size == 0:
+        # a multipart upload needs at least one part
+        s3.put_object(Bucket=bucket, Key=key, Body=b'')
+        if local_path is not None:
+            open(local_path, 'wb').close()
+        return
+    chunks = [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+    
+    # resume unfinished multipart upload, if any, unless the remote file was
+    # modified after it was started (its parts may be of the old content)
+    uploads = s3.list_multipart_uploads(Bucket=bucket, Prefix=key).get('Uploads', [])
+    uploads = [upload for upload in uploads
+               if upload['Key'] == key and (upload_id is None or upload['UploadId'] == upload_id)]
+    resumable = []
+    for upload in uploads:
+        if upload['Initiated'].timestamp() <= remote_stat.st_mtime:
+            logger.info("Abort multipart upload %s, %s was modified after it was started" % (
+                upload['UploadId'], remote_path))
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload['UploadId'])
+        else:
+            resumable.append(upload['UploadId'])
+    upload_id = resumable[-1] if resumable else None
+    uploaded = {}
+    if upload_id is None:
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    else:
+        paginator = s3.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                uploaded[part['PartNumber']] = part
+        logger.info("Resume multipart upload %s, %d parts already uploaded" % (upload_id, len(uploaded)))
+    
+    etags = {}
+    for part_number, (offset, length) in enumerate(chunks, 1):
+        if part_number in uploaded and uploaded[part_number]['Size'] == length:
+            etags[part_number] = uploaded[part_number]['ETag']
+    
+    # without a local copy, parts uploaded before need not be read again
+    if local_path is None:
+        todo = [(i, chunk) for i, chunk in enumerate(chunks, 1) if i not in etags]
+    else:
+        todo = list(enumerate(chunks, 1))
+    
+    local_file = open(local_path, 'wb') if local_path is not None else None
+    try:
+        with sftp_client.open(remote_path, 'rb') as remote_file, \
+                ThreadPoolExecutor(max_workers=concurrency) as executor:
+            running = {}
+            for start in range(0, len(todo), concurrency):
+                window = todo[start:start + concurrency]
+                for (part_number, (offset, length)), data in zip(window, remote_file.readv([c for _, c in window])):
+                    if local_file is not None:
+                        local_file.seek(offset)
+                        local_file.write(data)
+                    if part_number in etags:
+                        if hashlib.md5(data).hexdigest() == etags[part_number].strip('"'):
+                            continue
+                        # content differs from the uploaded part (or the
+                        # ETag is no MD5, e.g. with SSE-KMS), upload again
+                        del etags[part_number]
+                    
+                    # keep at most concurrency parts (and their data) in flight
+                    if len(running) >= concurrency:
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            etags[running.pop(future)] = future.result()
+                    future = executor.submit(upload_part, s3, bucket, key, upload_id, part_number, data, max_retries)
+                    running[future] = part_number
+            for future in running:
+                etags[running[future]] = future.result()
+    finally:
+        if local_file is not None:
+            local_file.close()
+    
+    resumed = sum(1 for part_number in etags if uploaded.get(part_number, {}).get('ETag') == etags[part_number])
+    s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                 MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etags[n]} for n in sorted(etags)]})
+    logger.info("Transferred %d bytes in %d parts (%d resumed)" % (size, len(chunks), resumed))
+
+
+
+def upload_part(s3, bucket, key, upload_id, part_number, data, max_retries=TRANSFER_MAX_RETRIES):
+    """
+    Upload one part of a multipart upload, retry with exponential backoff.
+    Return ETag of the part.
+    """
+    
+    for attempt in range(max_retries + 1):
+        try:
+            response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data)
+            return response['ETag']
+        except Exception:
+            if attempt == max_retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
+
+_stages_lock = threading.Lock()
+
+
+
+def run_stage(stages, name, t0, function, *args):
+    """
+    Call function(*args) and widen stages[name] to cover this call, as
+    (start, end) seconds relative to t0. Stages run at several threads share
+    one entry.
+    """
+    
+    start = time.time() - t0
+    result = function(*args)
+    end = time.time() - t0
+    
+    with _stages_lock:
+        previous_start, previous_end = stages.get(name, (start, end))
+        stages[name] = (min(start, previous_start), max(end, previous_end))
+    return result
+
+
+
+def read_csv_member(job_id, logger, csv_file_path, zip_path, extract_path=None, engine='pandas'):
+    """
+    Read single ZIP member with read_a_csv_file() or, for engine='arrow',
+    read_a_csv_file_arrow(). With extract_path the member is extracted
+    there first.
+    """
+    
+    if extract_path is not None:
+        with ZipFile(zip_path, 'r') as zip_ref:
+            csv_file_path = zip_ref.extract(csv_file_path, extract_path)
+        zip_path = None
+    
+    if engine == 'arrow':
+        return read_a_csv_file_arrow(job_id, logger, csv_file_path, zip_path)
+    return read_a_csv_file(job_id, logger, csv_file_path, zip_path)
+
+
+
+def list_zip_csv_files(zip_path):
+    """
+    This function will:
+    - list CSV members of a ZIP archive without extracting them
+    - return list of (member name, ZIP path) tuples for convert_csv_to_parquet()
+    """
+    
+    with ZipFile(zip_path, 'r') as zip_ref:
+        return [(name, zip_path) for name in zip_ref.namelist() if name.endswith('.csv') and '/' not in name]
+
+
+
+@contextmanager
+def open_csv_file(csv_file_path, zip_path=None):
+    """
+    Open a CSV file in binary mode. When zip_path is given, csv_file_path is
+    the member name and the member is decompressed on the fly.
+    """
+    
+    if zip_path is None:
+        with open(csv_file_path, 'rb') as fp:
+            yield fp
+    else:
+        with ZipFile(zip_path, 'r') as zip_ref:
+            with zip_ref.open(csv_file_path, 'r') as fp:
+                yield fp
+
+
+
+def convert_csv_to_parquet(job_id, logger, marketdata_ending, current_date_str, parquet_file_name, csv_files=None,
+                           workers=None, max_memory_mb=None, parquet_options=None, layout='file'):
     """
     This function will:
     - read list of CSV files
     - utilize read_a_csv_file() function to get Pandas DataFrame of each CSV file
-    - concat all DataFrame to a single DataFrame
-    - save the single DataFrame to Parquet
+    - drop duplicates of each DataFrame as it is parsed, see drop_seen_duplicates()
+    - stream each DataFrame to Parquet, see stream_data_frames_as_parquet(),
+      or with layout='dataset' concat all DataFrame and save them with
+      write_market_data()
+    
+    csv_files is a list of (CSV path, ZIP path) tuples, see list_zip_csv_files().
+    By default all CSV files extracted to /tmp/<job_id>/extracted/ are used.
+    With workers set, the files are parsed by read_csv_files_parallel().
     """
     
-    csv_files = glob.glob("/tmp/%s/extracted/*.csv" % job_id)
+    if csv_files is None:
+        csv_files = [(csv_file, None) for csv_file in glob.glob("/tmp/%s/extracted/*.csv" % job_id)]
     
-    # open each CSV file and store it at single list
-    data_frames = []
-    for csv_file in csv_files:
-        data_frame = read_a_csv_file(job_id, logger, csv_file)
-        data_frames.append(data_frame)
+    # open each CSV file, without duplicates, in file order
+    if workers:
+        data_frames = read_csv_files_parallel(job_id, logger, csv_files, workers, max_memory_mb, deduplicate=True)
+    else:
+        data_frames = drop_duplicates_in_file_order(logger, (read_a_csv_file(job_id, logger, csv_file, zip_path)
+                                                             for csv_file, zip_path in csv_files))
+    
+    if layout == 'dataset':
+        # the dataset is partitioned over all rows, so they are combined first
+        save_data_frames_as_parquet(logger, list(data_frames), marketdata_ending, parquet_file_name, parquet_options,
+                                    layout, deduplicated=True)
+    else:
+        stream_data_frames_as_parquet(logger, data_frames, marketdata_ending, parquet_file_name, parquet_options)
+
+
+
+def drop_duplicates_in_file_order(logger, data_frames):
+    """
+    This function will:
+    - take DataFrames of read_a_csv_file() one at a time, in file order
+    - yield each of them without duplicates, see drop_seen_duplicates()
+    """
+    
+    seen_hashes = np.empty(0, dtype=np.uint64)
+    for data_frame in data_frames:
+        data_frame, seen_hashes = drop_seen_duplicates(data_frame, seen_hashes)
+        yield data_frame
+    logger.info("Unique keys: %d" % len(seen_hashes))
+
+
+
+def drop_seen_duplicates(data_frame, seen_hashes):
+    """
+    Incremental drop_duplicates(subset=DUPLICATE_SUBSET) over DataFrames
+    parsed one after another:
+    - hash the DUPLICATE_SUBSET columns of each row to 64 bits
+    - keep the first row of each hash that is not in seen_hashes yet
+    - return the filtered DataFrame and the new sorted array of seen hashes
+    
+    Concatenating the filtered DataFrames gives the same rows as
+    drop_duplicates() on the concatenated DataFrame, as long as no two
+    different keys share a hash (about n^2 / 2^65 for n unique keys, i.e.
+    below 1e-7 for 1e6 keys). The state between DataFrames is the sorted
+    hashes (8 bytes per unique key) instead of a hash table over the
+    concatenated frame. The unique rows themselves are only released early
+    when the filtered DataFrames are streamed to Parquet (see
+    stream_data_frames_as_parquet()), with layout='dataset' they are still
+    concatenated.
+    """
+    
+    hashes = pd.util.hash_pandas_object(data_frame[DUPLICATE_SUBSET], index=False).values
+    unique_hashes, first_rows = np.unique(hashes, return_index=True)
+    
+    # unique hashes of this DataFrame that were not seen at previous ones
+    positions = np.searchsorted(seen_hashes, unique_hashes)
+    seen = positions < len(seen_hashes)
+    seen[seen] = seen_hashes[positions[seen]] == unique_hashes[seen]
+    
+    # merge the new hashes into the sorted seen hashes at the positions
+    # found above, linear in the seen hashes instead of sorting them again
+    seen_hashes = np.insert(seen_hashes, positions[~seen], unique_hashes[~seen])
+    
+    if not seen.any() and len(unique_hashes) == len(hashes):
+        return data_frame, seen_hashes
+    
+    keep = np.zeros(len(hashes), dtype=bool)
+    keep[first_rows[~seen]] = True
+    return data_frame[keep], seen_hashes
+
+
+
+def save_data_frames_as_parquet(logger, data_frames, marketdata_ending, parquet_file_name, parquet_options=None,
+                                layout='file', deduplicated=False):
+    """
+    This function will:
+    - concat DataFrames of read_a_csv_file() to a single DataFrame
+    - drop duplicates (unless already done by drop_seen_duplicates(),
+      deduplicated=True), see format_market_data_frame()
+    - save the single DataFrame to Parquet, see write_market_data()
+    """
     
     # concat all DataFrame as new single DataFrame
     s = time.time()
@@ -115,17 +833,73 @@ def convert_csv_to_parquet(job_id, logger, marketdata_ending, current_date_str,
     logger.info("Time to pd.concat: %d" % (time.time() - s))
 
     # drop duplicates
+    if not deduplicated:
+        s = time.time()
+        combined_data_frame.drop_duplicates(subset=DUPLICATE_SUBSET, inplace=True)
+        logger.info("Time to remove duplicates: %d" % (time.time() - s))
+    
+    combined_data_frame = format_market_data_frame(logger, combined_data_frame, marketdata_ending)
+    
+    # save it as Parquet file
+    write_market_data(logger, pa.Table.from_pandas(combined_data_frame), parquet_file_name, parquet_options, layout)
+
+
+
+def stream_data_frames_as_parquet(logger, data_frames, marketdata_ending, parquet_file_name, parquet_options=None):
+    """
+    This function will:
+    - take DataFrames without duplicates (see drop_seen_duplicates()) one
+      at a time, so only the DataFrame being written is held in memory
+    - format each DataFrame with format_market_data_frame()
+    - append it to a single Parquet file with pyarrow.parquet.ParquetWriter,
+      one (or more, see PARQUET_OPTIONS) row group per DataFrame
+    
+    The rows are the same as save_data_frames_as_parquet(..., deduplicated=True)
+    writes. The schema is taken from the first DataFrame, string columns
+    without any value there are stored as string anyway.
+    """
+    
+    options = dict(PARQUET_OPTIONS)
+    options.update(parquet_options or {})
+    row_group_size = options.pop('row_group_size', None)
+    
     s = time.time()
-    combined_data_frame.drop_duplicates(subset=['consumption',
-                                                'zip',
-                                                'city',
-                                                'rank'],
-                                        inplace=True)
-    logger.info("Time to remove duplicates: %d" % (time.time() - s))
+    writer = None
+    try:
+        for data_frame in data_frames:
+            data_frame = format_market_data_frame(logger, data_frame, marketdata_ending)
+            if writer is None:
+                schema = pa.Schema.from_pandas(data_frame, preserve_index=True)
+                for i, field in enumerate(schema):
+                    if pa.types.is_null(field.type):
+                        schema = schema.set(i, field.with_type(pa.string()))
+                table = encode_categorical_columns(pa.Table.from_pandas(data_frame, schema=schema, preserve_index=True))
+                writer = pq.ParquetWriter(parquet_file_name, table.schema, **options)
+            else:
+                table = encode_categorical_columns(pa.Table.from_pandas(data_frame, schema=schema, preserve_index=True))
+            writer.write_table(table, row_group_size=row_group_size)
+            del data_frame, table
+    finally:
+        if writer is not None:
+            writer.close()
+    
+    if writer is None:
+        raise ValueError("No CSV files to save as Parquet")
+    logger.info("Time to stream Parquet file: %d" % (time.time() - s))
+
+
+
+def format_market_data_frame(logger, data_frame, marketdata_ending):
+    """
+    This function will:
+    - re-format date column from dd.mm.YYYY to YYYYmmdd
+    - add the file name based columns, see market_data_columns()
+    - select PARQUET_COLUMNS and divide kwhRate by 100
+    """
     
     # change date format
     s = time.time()
-    date_column_stats = combined_data_frame.groupby('date').size()
+    date_column_stats = data_frame.groupby('date').size()
     logger.info("Date uniqueness calculation time: %d" % (time.time() - s))
     
     s = time.time()
@@ -134,13 +908,142 @@ def convert_csv_to_parquet(job_id, logger, marketdata_ending, current_date_str,
         original_date = None
         for k,v in date_column_stats.items():
             original_date = k
-        combined_data_frame['date'] = datetime.strptime(original_date, '%d.%m.%Y').strftime('%Y%m%d')
+        data_frame['date'] = datetime.strptime(original_date, '%d.%m.%Y').strftime('%Y%m%d')
         logger.info("Time to reformate date column with optimized way: %d" % (time.time() - s))
     else:
         # fallback: re-format date column values one-by-one
-        combined_data_frame['date'] = pd.to_datetime(combined_data_frame['date'], format='%d.%m.%Y', errors='coerce').dt.strftime('%Y%m%d')
+        data_frame['date'] = pd.to_datetime(data_frame['date'], format='%d.%m.%Y', errors='coerce').dt.strftime('%Y%m%d')
         logger.info("Time to reformate date column: %d" % (time.time() - s))
     
+    type_column, targetGroup_column, pricesNet_column = market_data_columns(marketdata_ending)
+    
+    data_frame['type'] = type_column
+    data_frame['targetGroup'] = targetGroup_column
+    data_frame['pricesNet'] = pricesNet_column
+    
+    data_frame = data_frame[PARQUET_COLUMNS]
+    
+    # divide kwhRate by 100
+    data_frame['kwhRate'] = data_frame['kwhRate'] / 100
+    
+    return data_frame
+
+
+
+def write_market_data(logger, table, parquet_file_name, parquet_options=None, layout='file'):
+    """
+    Save market data Table as single Parquet file, or with layout='dataset'
+    as dataset at parquet_file_name without the .parquet extension.
+    """
+    
+    if layout == 'dataset':
+        write_parquet_dataset(logger, table, parquet_file_name[:-len('.parquet')], parquet_options)
+    else:
+        write_parquet_file(logger, table, parquet_file_name, parquet_options)
+
+
+
+def write_parquet_file(logger, table, parquet_file_name, parquet_options=None):
+    """
+    This function will:
+    - dictionary-encode the CATEGORICAL_COLUMNS of an Arrow Table, so
+      pandas reads them back as Categorical
+    - save the Table to Parquet with PARQUET_OPTIONS, updated by
+      parquet_options
+    """
+    
+    options = dict(PARQUET_OPTIONS)
+    options.update(parquet_options or {})
+    
+    s = time.time()
+    pq.write_table(encode_categorical_columns(table), parquet_file_name, **options)
+    logger.info("Time to save Parquet file: %d" % (time.time() - s))
+
+
+
+def encode_categorical_columns(table):
+    """
+    Dictionary-encode the string CATEGORICAL_COLUMNS of an Arrow Table, so
+    pandas reads them back as Categorical.
+    """
+    
+    for name in CATEGORICAL_COLUMNS:
+        i = table.schema.get_field_index(name)
+        if pa.types.is_string(table.schema.field(i).type):
+            table = table.set_column(i, name, pc.dictionary_encode(table[name]))
+    return table
+
+
+
+def write_parquet_dataset(logger, table, dataset_path, parquet_options=None):
+    """
+    This function will:
+    - split market data Table by zip_prefix (first two digits of zip) and
+      consumption_tier (see CONSUMPTION_TIERS)
+    - save each split with write_parquet_file() as
+      <dataset_path>/zip_prefix=<prefix>/consumption_tier=<tier>/part-0.parquet,
+      with the ROW_COLUMN position of each row in table
+    - save manifest of all partitions with row count and consumption range,
+      readers use it to download only the partitions they need
+    """
+    
+    s = time.time()
+    zip_prefix = pd.Series(pc.utf8_slice_codeunits(table['zip'], 0, 2).to_pandas()).fillna('__HIVE_DEFAULT_PARTITION__')
+    consumption = table['consumption'].to_numpy()
+    tiers = np.asarray(CONSUMPTION_TIERS)[np.maximum(np.searchsorted(CONSUMPTION_TIERS, consumption, 'right') - 1, 0)]
+    partitions = pd.DataFrame({'zip_prefix': zip_prefix, 'consumption_tier': tiers}).groupby(['zip_prefix', 'consumption_tier']).indices
+    
+    table = table.append_column(ROW_COLUMN, pa.array(np.arange(table.num_rows, dtype=np.int64)))
+    
+    manifest = {
+        'partition_columns': ['zip_prefix', 'consumption_tier'],
+        'row_column': ROW_COLUMN,
+        'consumption_tiers': CONSUMPTION_TIERS,
+        'rows': table.num_rows,
+        'partitions': [],
+    }
+    for (prefix, tier), indices in sorted(partitions.items()):
+        path = "zip_prefix=%s/consumption_tier=%d/part-0.parquet" % (prefix, tier)
+        os.makedirs(os.path.dirname(os.path.join(dataset_path, path)), exist_ok=True)
+        write_parquet_file(logger, table.take(indices), os.path.join(dataset_path, path), parquet_options)
+        manifest['partitions'].append({
+            'path': path,
+            'zip_prefix': prefix,
+            'consumption_tier': int(tier),
+            'consumption_min': int(consumption[indices].min()),
+            'consumption_max': int(consumption[indices].max()),
+            'rows': len(indices),
+        })
+    
+    with open(os.path.join(dataset_path, MANIFEST_NAME), 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    logger.info("Time to save Parquet dataset with %d partitions: %d" % (len(manifest['partitions']), time.time() - s))
+
+
+
+def upload_parquet_dataset(s3, bucket, dataset_path, manifest_extra_args=None):
+    """
+    Upload dataset saved by write_parquet_dataset() under the prefix
+    <dataset name>/, the manifest is uploaded last (with
+    manifest_extra_args).
+    """
+    
+    dataset_name = os.path.basename(dataset_path)
+    with open(os.path.join(dataset_path, MANIFEST_NAME)) as fp:
+        manifest = json.load(fp)
+    for partition in manifest['partitions']:
+        s3.upload_file(os.path.join(dataset_path, partition['path']), bucket, "%s/%s" % (dataset_name, partition['path']))
+    s3.upload_file(os.path.join(dataset_path, MANIFEST_NAME), bucket, "%s/%s" % (dataset_name, MANIFEST_NAME),
+                   ExtraArgs=manifest_extra_args)
+
+
+
+def market_data_columns(marketdata_ending):
+    """
+    Values of the type, targetGroup and pricesNet columns for a market data
+    file name.
+    """
+    
     type_column = 'Strom' if 'Strom' in marketdata_ending else 'Gas'
     targetGroup_column = None
     if 'Gewerbe' in marketdata_ending:
@@ -158,59 +1061,279 @@ def convert_csv_to_parquet(job_id, logger, marketdata_ending, current_date_str,
     elif 'Heiz' in marketdata_ending:
         pricesNet_column = False
     
-    combined_data_frame['type'] = type_column
-    combined_data_frame['targetGroup'] = targetGroup_column
-    combined_data_frame['pricesNet'] = pricesNet_column
-    
-    combined_data_frame = combined_data_frame[[
-        'date',
-        'type',
-        'targetGroup',
-        'pricesNet',
-        'consumption',
-        'zip',
-        'city',
-        'households',
-        'rank',
-        'provider',
-        'tariffName',
-        'priceSumNet',
-        'basicRate',
-        'kwhSum',
-        'NCbonus',
-        'Ibonus',
-        'kwhRate'
-        ]]
+    return type_column, targetGroup_column, pricesNet_column
+
+
+
+def convert_csv_to_parquet_arrow(job_id, logger, marketdata_ending, current_date_str, parquet_file_name, csv_files=None,
+                                 parquet_options=None, layout='file'):
+    """
+    Arrow-native variant of convert_csv_to_parquet(), this function will:
+    - read each CSV file with pyarrow.csv to an Arrow Table (multithreaded,
+      block-wise cp1252 transcoding, decimal comma)
+    - concat all Tables, drop duplicates and re-format the date column
+      with Arrow compute functions
+    - save the single Table to Parquet, no pandas DataFrame is built
+    
+    The Parquet file has the same columns as convert_csv_to_parquet(),
+    without the pandas index column.
+    """
+    
+    if csv_files is None:
+        csv_files = [(csv_file, None) for csv_file in glob.glob("/tmp/%s/extracted/*.csv" % job_id)]
+    
+    tables = []
+    for csv_file, zip_path in csv_files:
+        tables.append(read_a_csv_file_arrow(job_id, logger, csv_file, zip_path))
+    
+    save_tables_as_parquet(logger, tables, marketdata_ending, parquet_file_name, parquet_options, layout)
+
+
+
+def save_tables_as_parquet(logger, tables, marketdata_ending, parquet_file_name, parquet_options=None, layout='file'):
+    """
+    Arrow variant of save_data_frames_as_parquet() for Tables of
+    read_a_csv_file_arrow().
+    """
+    
+    # concat all Tables as new single Table
+    s = time.time()
+    table = pa.concat_tables(tables)
+    del tables
+    logger.info("Time to concat Arrow tables: %d" % (time.time() - s))
+    
+    # drop duplicates: keep first row of each key, in original order
+    # note: keys are hashed like drop_seen_duplicates() does, Table.group_by()
+    #       of several keys is wrong for string keys with nulls (empty zip or
+    #       city) at pyarrow 14
+    s = time.time()
+    hashes = pd.util.hash_pandas_object(table.select(DUPLICATE_SUBSET).to_pandas(), index=False).values
+    first_rows = np.unique(hashes, return_index=True)[1]
+    del hashes
+    table = table.take(np.sort(first_rows))
+    logger.info("Time to remove duplicates: %d" % (time.time() - s))
+    
+    # change date format
+    s = time.time()
+    dates = pc.unique(pc.drop_null(table['date']))
+    if len(dates) == 1:
+        # optimized date re-format: only assign one value
+        date = datetime.strptime(dates[0].as_py(), '%d.%m.%Y').strftime('%Y%m%d')
+        date_column = pa.repeat(date, table.num_rows)
+    else:
+        # fallback: re-format date column values one-by-one
+        date_column = pc.strftime(pc.strptime(table['date'], format='%d.%m.%Y', unit='s', error_is_null=True),
+                                  format='%Y%m%d')
+    table = table.set_column(table.schema.get_field_index('date'), 'date', date_column)
+    logger.info("Time to reformate date column: %d" % (time.time() - s))
+    
+    type_column, targetGroup_column, pricesNet_column = market_data_columns(marketdata_ending)
+    table = table.append_column('type', pa.repeat(type_column, table.num_rows))
+    table = table.append_column('targetGroup', pa.repeat(targetGroup_column, table.num_rows))
+    table = table.append_column('pricesNet', pa.repeat(pricesNet_column, table.num_rows))
     
     # divide kwhRate by 100
-    combined_data_frame['kwhRate'] = combined_data_frame['kwhRate'] / 100
+    table = table.set_column(table.schema.get_field_index('kwhRate'), 'kwhRate', pc.divide(table['kwhRate'], 100.0))
+    
+    table = table.select(PARQUET_COLUMNS)
     
     # save it as Parquet file
-    s = time.time()
-    combined_data_frame.to_parquet(parquet_file_name, engine='pyarrow', compression='gzip')
-    logger.info("Time to save Parquet file: %d" % (time.time() - s))
+    write_market_data(logger, table, parquet_file_name, parquet_options, layout)
 
 
 
-def read_a_csv_file(job_id, logger, csv_file_path):
+def read_a_csv_file_arrow(job_id, logger, csv_file_path, zip_path=None):
     """
     This function will:
-    - read single CSV file
-    - read selected columns
+    - read single CSV file (or ZIP member) with pyarrow.csv
+    - read selected columns, see resolve_csv_columns()
     - rename columns title to English
-    - return Pandas DataFrame of formatted CSV file
+    - return Arrow Table of formatted CSV file
     """
     
-    df_tmp = pd.read_csv(csv_file_path,
-                         encoding='cp1252',
-                         engine='c',
-                         sep=';',
-                         decimal=',',
-                         header=0,
-                         nrows=1)
+    s = time.time()
+    with open_csv_file(csv_file_path, zip_path) as fp:
+        columns = resolve_csv_columns(fp.readline(), 'Strom_' in csv_file_path)
+        fp.seek(0)
+        table = pv.read_csv(fp,
+                            read_options=pv.ReadOptions(encoding='cp1252'),
+                            parse_options=pv.ParseOptions(delimiter=';'),
+                            convert_options=pv.ConvertOptions(
+                                column_types={k: ARROW_CSV_TYPES[v[1]] for k, v in columns.items()},
+                                include_columns=list(columns),
+                                strings_can_be_null=True,
+                                decimal_point=','))
+    logger.info("Time to load CSV file with pyarrow: %d" % (time.time() - s))
+    
+    # change column title to English
+    return table.rename_columns([columns[name][0] for name in table.column_names])
+
+
+
+def benchmark_csv_to_parquet(job_id, logger, marketdata_ending, csv_files=None, engines=('pandas', 'arrow')):
+    """
+    This function will:
+    - run convert_csv_to_parquet() and convert_csv_to_parquet_arrow() on the
+      same CSV files, each engine in a fresh process
+    - check that all engines wrote the same market data (ValueError if not)
+    - log and return wall time (seconds) and peak RSS (MB) per engine
+    """
+    
+    current_date_str = datetime.now(timezone('Europe/Berlin')).strftime('%Y%m%d')
+    context = multiprocessing.get_context('spawn')
+    
+    results = {}
+    for engine in engines:
+        parquet_file_name = "/tmp/%s/benchmark_%s.parquet" % (job_id, engine)
+        with context.Pool(1) as pool:
+            wall_time, peak_rss = pool.apply(benchmark_engine,
+                                             (engine, job_id, marketdata_ending, current_date_str,
+                                              parquet_file_name, csv_files))
+        results[engine] = {'wall_time': wall_time, 'peak_rss_mb': peak_rss}
+        logger.info("Benchmark %s engine: %.2f s, peak RSS %d MB" % (engine, wall_time, peak_rss))
+    
+    # same rows in the same order, the pandas engine also writes its index
+    expected = None
+    for engine in engines:
+        market_data = pd.read_parquet("/tmp/%s/benchmark_%s.parquet" % (job_id, engine)).reset_index(drop=True)
+        if expected is None:
+            expected_engine, expected = engine, market_data
+        elif not expected.equals(market_data):
+            raise ValueError("Market data of %s engine (%d rows) differs from %s engine (%d rows)" % (
+                engine, len(market_data), expected_engine, len(expected)))
+    logger.info("Benchmark engines wrote the same market data")
+    
+    return results
+
+
+
+def benchmark_engine(engine, job_id, marketdata_ending, current_date_str, parquet_file_name, csv_files=None):
+    """
+    Worker of benchmark_csv_to_parquet(): convert once, return wall time and
+    peak RSS of this process.
+    """
+    
+    logger = logging.getLogger(__name__)
+    s = time.time()
+    if engine == 'arrow':
+        convert_csv_to_parquet_arrow(job_id, logger, marketdata_ending, current_date_str, parquet_file_name, csv_files)
+    else:
+        convert_csv_to_parquet(job_id, logger, marketdata_ending, current_date_str, parquet_file_name, csv_files)
+    wall_time = time.time() - s
+    
+    # ru_maxrss is in KB on Linux
+    return wall_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >> 10
+
+
+
+def read_csv_files_parallel(job_id, logger, csv_files, workers, max_memory_mb=None, deduplicate=False):
+    """
+    This function will:
+    - parse CSV files concurrently at a pool of worker processes
+    - keep at most max_memory_mb of (uncompressed) CSV input in flight,
+      but always at least one file
+    - receive each DataFrame as Arrow IPC stream instead of a pickled DataFrame
+    - with deduplicate=True, drop duplicates of the DataFrames in file order
+      as soon as they arrive, see drop_seen_duplicates()
+    - yield the DataFrames in the same order as csv_files, each as soon as
+      it and all previous files are parsed, so the result is identical to
+      the serial loop
+    """
+    
+    s = time.time()
+    max_bytes = max_memory_mb << 20 if max_memory_mb else None
+    
+    data_frames = [None] * len(csv_files)
+    pending_files = list(enumerate(csv_files))
+    pending_files.reverse()
+    running = {}
+    running_bytes = 0
+    yielded_files = 0
+    seen_hashes = np.empty(0, dtype=np.uint64)
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending_files or running:
+            # submit as many files as the memory cap allows
+            while pending_files and len(running) < workers:
+                i, (csv_file, zip_path) = pending_files[-1]
+                size = csv_file_size(csv_file, zip_path)
+                if running and max_bytes and running_bytes + size > max_bytes:
+                    break
+                pending_files.pop()
+                future = executor.submit(read_a_csv_file_as_arrow, job_id, csv_file, zip_path)
+                running[future] = (i, size)
+                running_bytes += size
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, size = running.pop(future)
+                running_bytes -= size
+                data_frames[i] = pa.ipc.open_stream(future.result()).read_all().to_pandas()
+            
+            # first occurrence wins, so duplicates are dropped in file order
+            while yielded_files < len(csv_files) and data_frames[yielded_files] is not None:
+                data_frame, data_frames[yielded_files] = data_frames[yielded_files], None
+                if deduplicate:
+                    data_frame, seen_hashes = drop_seen_duplicates(data_frame, seen_hashes)
+                yielded_files += 1
+                yield data_frame
+    
+    logger.info("Time to load %d CSV files with %d workers: %d" % (len(csv_files), workers, time.time() - s))
+    if deduplicate:
+        logger.info("Unique keys: %d" % len(seen_hashes))
+
+
+
+def read_a_csv_file_as_arrow(job_id, csv_file_path, zip_path=None):
+    """
+    Worker of read_csv_files_parallel(): read_a_csv_file() result serialized
+    as Arrow IPC stream.
+    """
+    
+    df = read_a_csv_file(job_id, logging.getLogger(__name__), csv_file_path, zip_path)
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+
+def csv_file_size(csv_file_path, zip_path=None):
+    """
+    Uncompressed size of a CSV file or ZIP member in bytes.
+    """
+    
+    if zip_path is None:
+        return os.path.getsize(csv_file_path)
+    with ZipFile(zip_path, 'r') as zip_ref:
+        return zip_ref.getinfo(csv_file_path).file_size
+
+
+
+# resolved CSV column mapping per (header line, Strom file) signature
+_csv_columns_cache = {}
+
+
+
+def resolve_csv_columns(header_line, is_strom):
+    """
+    This function will:
+    - decide netto vs brutto and the Strom HT column name from the raw
+      (cp1252 encoded) CSV header line
+    - return mapping of selected German column title to (English column
+      title, dtype), in the order of the output columns
+    - cache the mapping, so files with the same layout skip re-detection
+    """
+    
+    signature = (header_line, is_strom)
+    if signature in _csv_columns_cache:
+        return _csv_columns_cache[signature]
+    
+    header = [column.strip().strip('"') for column in header_line.decode('cp1252').split(';')]
     
     netto_brutto = 'netto'
-    if 'Gesamtkosten (brutto) in EUR pro Jahr' in df_tmp.columns:
+    if 'Gesamtkosten (brutto) in EUR pro Jahr' in header:
         netto_brutto = 'brutto'
     
     gesamtkosten    = "Gesamtkosten (%s) in EUR pro Jahr" % netto_brutto
@@ -220,67 +1343,57 @@ def read_a_csv_file(job_id, logger, csv_file_path):
     sofortbonus     = "Sofortbonus in EUR (%s)" % netto_brutto
     
     kwhRate_column_name = "Arbeitspreis in ct/kWh (%s)" % netto_brutto
-    if 'Strom_' in csv_file_path:
+    if is_strom:
         kwhRate_column_name = "Arbeitspreis HT in ct/kWh (%s)" % netto_brutto
     
-    # only read selected columns
+    columns = {
+        'Verbrauchsstufe in kWh': ('consumption', int),
+        'Postleitzahl': ('zip', str),
+        'Ort': ('city', str),
+        'Anzahl Haushalte': ('households', int),
+        'Platz': ('rank', int),
+        'Anbietername': ('provider', str),
+        'Tarifname': ('tariffName', str),
+        gesamtkosten: ('priceSumNet', float),
+        grundpreis: ('basicRate', float),
+        verbrauchspreis: ('kwhSum', float),
+        neukundenbonus: ('NCbonus', float),
+        sofortbonus: ('Ibonus', float),
+        kwhRate_column_name: ('kwhRate', float),
+        'Exportdatum': ('date', str),
+    }
+    
+    _csv_columns_cache[signature] = columns
+    return columns
+
+
+
+def read_a_csv_file(job_id, logger, csv_file_path, zip_path=None):
+    """
+    This function will:
+    - read single CSV file (or ZIP member, when zip_path is given)
+    - resolve selected columns from the header line, see resolve_csv_columns()
+    - read selected columns
+    - rename columns title to English
+    - return Pandas DataFrame of formatted CSV file
+    """
+    
+    # only read selected columns, the file is opened once
     s = time.time()
-    df = pd.read_csv(csv_file_path,
-                     encoding='cp1252',
-                     engine='c',
-                     sep=';', 
-                     decimal=',',
-                     header=0,
-                     dtype={
-                         'Verbrauchsstufe in kWh': int, 
-                         'Postleitzahl': str, 
-                         'Ort': str, 
-                         'Anzahl Haushalte': int, 
-                         'Platz': int, 
-                         'Anbietername': str, 
-                         'Tarifname': str, 
-                         gesamtkosten: float, 
-                         grundpreis: float, 
-                         verbrauchspreis: float, 
-                         neukundenbonus: float, 
-                         sofortbonus: float, 
-                         kwhRate_column_name: float,
-                         'Exportdatum': str,
-                     },
-                     usecols=[
-                         'Verbrauchsstufe in kWh', 
-                         'Postleitzahl', 
-                         'Ort', 
-                         'Anzahl Haushalte', 
-                         'Platz', 
-                         'Anbietername', 
-                         'Tarifname', 
-                         gesamtkosten, 
-                         grundpreis, 
-                         verbrauchspreis, 
-                         neukundenbonus, 
-                         sofortbonus, 
-                         kwhRate_column_name,
-                         'Exportdatum',
-                     ])
+    with open_csv_file(csv_file_path, zip_path) as fp:
+        columns = resolve_csv_columns(fp.readline(), 'Strom_' in csv_file_path)
+        fp.seek(0)
+        df = pd.read_csv(fp,
+                         encoding='cp1252',
+                         engine='c',
+                         sep=';', 
+                         decimal=',',
+                         header=0,
+                         dtype={k: v[1] for k, v in columns.items()},
+                         usecols=list(columns))
     logger.info("Time to load CSV file: %d" % (time.time() - s))
     
     # change column title to English
-    df.columns = [
-        'consumption',
-        'zip',
-        'city',
-        'households',
-        'rank',
-        'provider',
-        'tariffName',
-        'priceSumNet',
-        'basicRate',
-        'kwhSum',
-        'NCbonus',
-        'Ibonus',
-        'kwhRate',
-        'date'
-    ]
-    
-    return df
\ No newline at end of file
+    df.rename(columns={k: v[0] for k, v in columns.items()}, inplace=True)
+    
+    return df
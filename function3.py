@@ -1,16 +1,124 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
+from itertools import chain
 
+import cProfile
+import csv
+import fcntl
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import pstats
+import resource
+import shutil
+import sys
 import time
+import uuid
 
 import boto3
 import botocore
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import pymysql
 from pytz import timezone
 from sqlalchemy import create_engine
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+# name of the manifest file at the root of a market data dataset,
+# see write_parquet_dataset() at function1.py
+MANIFEST_NAME = '_manifest.json'
+
+# row position column of a dataset, see ROW_COLUMN at function1.py
+ROW_COLUMN = 'row'
+
+# zip_prefix of the dataset partitions of rows without zip, see
+# write_parquet_dataset() at function1.py
+MISSING_ZIP_PREFIX = '__HIVE_DEFAULT_PARTITION__'
+
+# market data of this provider is excluded at Step 2
+EXCLUDED_PROVIDER = 'E.ON Energie Deutschland GmbH'
+
+# reference queries run at the same time, each on its own connection
+REFERENCE_QUERY_WORKERS = 5
+
+# reference columns compared with market data strings (zip codes keep
+# leading zeros)
+REFERENCE_STRING_COLUMNS = {'areas': ['zip', 'city']}
+
+# reference queries filtered on DATE(NOW()), their results are cached per
+# calculation type and day, see read_reference_cache()
+REFERENCE_CACHED_QUERIES = ['tariff', 'costmodelinternal', 'costmodelprovision', 'areas']
+REFERENCE_CACHE_DIR = os.environ.get('REFERENCE_CACHE_DIR', '/tmp/reference_cache')
+REFERENCE_CACHE_TTL = int(os.environ.get('REFERENCE_CACHE_TTL', 3600))
+
+# host-level cache of market data files shared by all jobs, see
+# download_cached()
+MARKET_DATA_CACHE_DIR = os.environ.get('MARKET_DATA_CACHE_DIR', '/tmp/market_data_cache')
+MARKET_DATA_CACHE_MAX_BYTES = int(os.environ.get('MARKET_DATA_CACHE_MAX_BYTES', 20 << 30))
+
+# Steps 1-29 run per shard of areas by zip hash, see calculate_shards(); the
+# shards in flight are limited by worker processes and memory budget (bytes)
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', os.cpu_count()))
+SHARD_MEMORY_BUDGET = int(os.environ.get('SHARD_MEMORY_BUDGET', 8 << 30))
+
+# Step 30 writes bonus_results with DataFrame.to_sql ('to_sql') or with LOAD
+# DATA LOCAL INFILE into a staging table ('load_data', see load_result())
+# note: 'load_data' needs local_infile enabled at the server (off by default
+#       at MySQL 8) and CREATE/DROP TABLE privileges for the staging tables,
+#       compare the writers with benchmark_result_writers() before switching,
+#       it has not been run against a MySQL server yet, so there are no
+#       numbers in favour of 'load_data'
+RESULT_WRITER = os.environ.get('RESULT_WRITER', 'to_sql')
+
+# columns of bonus_results written by Step 30, in the order of the result
+RESULT_COLUMNS = ['consumption_from', 'consumption_until', 'nc', 'ib', 'zip', 'city', 'pid',
+                  'bonuscampaign_id', 'bonuscalculation1_id', 'date_calculated']
+
+# last calculation per bonuscalculation1_id (date, market data and
+# fingerprint of the reference data), the base of the incremental mode, see
+# plan_incremental()
+CALCULATION_STATE_PATH = os.environ.get('CALCULATION_STATE_PATH', '/tmp/function3_calculation_state.json')
+
+# market data columns read by Steps 1-3, see prepare_market_data()
+MARKET_DATA_COLUMNS = ['consumption', 'zip', 'city', 'rank', 'provider', 'priceSumNet']
+
+# market data columns compared by the incremental mode
+MARKET_DIFF_COLUMNS = ['consumption', 'zip', 'city', 'rank', 'provider', 'priceSumNet']
+
+# escapes of special characters in strings of a LOAD DATA file
+TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+# directory of the JSON profile reports (profile=True), see
+# write_profile_report(), and the number of functions kept of each step
+# profile (profile_capture), see end_step()
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/function3_profiles')
+PROFILE_CAPTURE_LINES = 30
+
+# directory of the sampled step traces (trace_rate > 0), see trace_step()
+TRACE_DIR = os.environ.get('TRACE_DIR', '/tmp/function3_traces')
+
+# Steps 1-3 result of Function3Batch(), its forked worker processes share it
+# (copy-on-write), see calculate_batch_bonus()
+_batch_market_data = None
+
 
 def round_up(value, step):
     rounded = np.ceil(value / step) * step
@@ -22,12 +130,14 @@ def round_down(value, step):
     return rounded
 
 
-def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata_ending, suffix):
-    # these variables used to store mapping of integer value from optimized
-    # DataFrames to original String value
+def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata_ending, suffix, bonus_engine='numpy',
+              shards=SHARD_COUNT, shard_workers=SHARD_WORKERS,
+              shard_memory_budget=SHARD_MEMORY_BUDGET, result_writer=RESULT_WRITER, incremental=False,
+              verify_incremental=False, profile=False, profile_capture=None, trace_rate=0):
+    # this variable used to store mapping of integer value from optimized
+    # DataFrames to original String value (value of id i at position i),
+    # see calculate_shard() for zip and city
     _col_pid = None
-    _col_zip = None
-    _col_city = None
     
     calculation_type = 'Strom' if marketdata_ending[0:5] == 'Strom' else 'Gas'
     
@@ -42,6 +152,13 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
     
     pd.set_option('display.max_columns', 500)
     
+    # per step wall/CPU time, memory and row counts of the job, see
+    # start_step() and end_step()
+    profile_report = new_profile_report(job_id, 'Function3', profile_capture) if profile else None
+    
+    # sampled zip/city groups of each step to Parquet, see trace_step()
+    trace = new_trace(job_id, trace_rate) if trace_rate > 0 else None
+    
     
     
     s3_resource = boto3.resource('s3')
@@ -54,34 +171,34 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
     current_date_str = current_date.strftime('%Y%m%d')
     yesterday_str = yesterday.strftime('%Y%m%d')
     
-    current_date_file = "%s_%s.parquet" % (current_date_str, marketdata_ending[:-4])
-    yesterday_file = "%s_%s.parquet" % (yesterday_str, marketdata_ending[:-4])
+    parquet_s3_key, parquet_s3_etag = find_market_data(bucket, marketdata_ending, [current_date_str, yesterday_str])
     
-    current_date_objs = list(bucket.objects.filter(Prefix=current_date_file))
-    yesterday_objs = list(bucket.objects.filter(Prefix=yesterday_file))
+    logger.info("parquet_s3_key: %s (ETag %s)" % (parquet_s3_key, parquet_s3_etag))
+    
+    # create work directory
+    os.mkdir("/tmp/%s" % job_id)
     
-    parquet_s3_key = None
+    conn = connect_mysql(local_infile=result_writer == 'load_data')
     
-    if len(current_date_objs) > 0:
-        parquet_s3_key = current_date_file
-    elif len(yesterday_objs) > 0:
-        parquet_s3_key = yesterday_file
-    else:
-        raise ValueError('No parquet file!')
     
-    logger.info("parquet_s3_key: %s" % parquet_s3_key)
     
-    # create work directory
-    os.mkdir("/tmp/%s" % job_id)
+    # start reference queries (see reference_queries()), the Parquet file
+    # downloads meanwhile
+    reference_data = read_sql_concurrently(logger, reference_queries(bonuscalculation1_id, calculation_type),
+                                           REFERENCE_STRING_COLUMNS,
+                                           cache_key=(calculation_type, current_date_str))
     
-    file_name = '/tmp/%s/%s' % (job_id, parquet_s3_key)
     
-    # download Parquet file
+    
+    # download Parquet file (or the dataset partitions matching areas and
+    # consumption bands of config and tariff)
     try:
         s = time.time()
-        s3_resource = boto3.resource('s3')
-        s3_resource.Bucket(os.environ['S3_BUCKET_PARQUET']).download_file(parquet_s3_key, file_name)
+        start_step(profile_report, 'download')
+        file_name = download_market_data(logger, bucket, parquet_s3_key, parquet_s3_etag, "/tmp/%s" % job_id,
+                                         reference_data)
         logger.info("Time to download Parquet from S3: %d" % (time.time() - s))
+        end_step(profile_report)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             logger.info("The object does not exist.")
@@ -89,165 +206,342 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
         else:
             raise
     
-    # load Parquet file
+    config, tariff, costmodelinternal, costmodelprovision, areas = [
+        reference_data[name].result() for name in ['config', 'tariff', 'costmodelinternal', 'costmodelprovision', 'areas']]
+    is_dataset = parquet_s3_key.endswith(MANIFEST_NAME)
+    
+    
+    
+    # incremental mode - recalculate only the zip/city groups whose market
+    # rows changed since yesterday's calculation and carry forward the rows
+    # of yesterday's bonus_results for all others, see plan_incremental()
+    calculation_entry = {'date': current_date_str,
+                         'market_key': parquet_s3_key,
+                         'market_etag': parquet_s3_etag,
+                         'reference_sha256': reference_fingerprint(
+                             [config, tariff, costmodelinternal, costmodelprovision, areas])}
+    changed_areas = None
+    if incremental or verify_incremental:
+        s = time.time()
+        start_step(profile_report, 'plan incremental')
+        changed_areas = plan_incremental(logger, bucket, "/tmp/%s" % job_id, bonuscalculation1_id,
+                                         calculation_entry, yesterday_str, file_name, reference_data)
+        logger.info("Time to plan incremental calculation: %d" % (time.time() - s))
+        end_step(profile_report, changed_areas)
+    
+    
+    
+    # tariff optimization
+    tariff['pid_id'], _col_pid = factorize_column(tariff['pid'])
+    log_conversion(logger, 'tariff', ['pid'], column_memory_usage(tariff, ['pid']),
+                   column_memory_usage(tariff, ['pid_id']))
+    tariff.drop(columns=['pid'], axis=1, inplace=True)
+    
+    
+    
+    # Steps 1-29 - Calculate the bonus per shard of areas, see calculate_shard()
+    # note: Step 3 joins market data and areas on zip and all later steps
+    #       group by zip, so shards of areas by zip hash are independent and
+    #       each shard reads only the market rows of its zips, see
+    #       split_market_data()
+    # note: rows of a pid/zip/city group with equal consumption_from keep
+    #       the order of the sort of Step 4, which is not stable, with several
+    #       shards Step 28 may give them their consumption_until in another
+    #       order
+    if changed_areas is None:
+        area_shards = shard_by_zip(areas, shards)
+    elif len(changed_areas) > 0:
+        area_shards = shard_by_zip(changed_areas, shards)
+    else:
+        area_shards = []
+    if not verify_incremental:
+        del areas
+    logger.info("Calculating %d shard(s) of areas" % len(area_shards))
+    
+    
+    
+    # Step 30 - Insert calculation result to MySQL, bonus_results table, see
+    #           write_results()
     s = time.time()
-    vxdata = pd.read_parquet(file_name,
-                             engine='pyarrow',
-                             columns=[
-                                 'consumption',
-                                 'zip',
-                                 'city',
-                                 'rank',
-                                 'provider',
-                                 'priceSumNet'
-                             ])
-    logger.info("Time to load Parquet to memory: %d" % (time.time() - s))
-    
-    conn = pymysql.connect(host=os.environ['SQL_HOST'],
-                           user=os.environ['SQL_USER'],
-                           password=os.environ['SQL_PASSWORD'],
-                           db=os.environ['SQL_DBNAME'],
-                           charset='utf8',
-                           cursorclass=pymysql.cursors.DictCursor)
     
+    # insert the result of each shard as soon as it is calculated, so only
+    # the shards in flight are held in memory
+    shard_args = [(job_id, logger, shard_file_name, shard_is_dataset, area_shard, config, tariff, costmodelinternal,
+                   costmodelprovision, bonus_engine, trace)
+                  for area_shard, (shard_file_name, shard_is_dataset) in zip(area_shards, split_market_data(
+                      logger, file_name, is_dataset, area_shards, "/tmp/%s/shards/" % job_id))]
+    del area_shards
+    results = calculate_shards(logger, shard_args, shard_workers, shard_memory_budget, profile_report)
+    if changed_areas is not None:
+        results = chain(results, read_carried_forward(logger, conn, bonuscalculation1_id, changed_areas, _col_pid))
+    
+    if verify_incremental and changed_areas is not None:
+        # recalculate all shards and compare, the incremental result is only
+        # written if both are the same
+        results = [pd.concat(list(results), ignore_index=True)]
+        area_shards = shard_by_zip(areas, shards)
+        shard_args = [(job_id, logger, shard_file_name, shard_is_dataset, area_shard, config, tariff,
+                       costmodelinternal, costmodelprovision, bonus_engine)
+                      for area_shard, (shard_file_name, shard_is_dataset) in zip(area_shards, split_market_data(
+                          logger, file_name, is_dataset, area_shards, "/tmp/%s/shards/verify_" % job_id))]
+        del area_shards
+        expected = pd.concat(list(calculate_shards(logger, shard_args, shard_workers, shard_memory_budget)),
+                             ignore_index=True)
+        compare_results(expected, results[0])
+        logger.info("Incremental result verified against a full recalculation (%d rows)" % len(expected))
+        del expected
+    
+    result_rows = write_results(conn, job_id, results, bonuscalculation1_id, bonuscampaign_id, _col_pid,
+                                result_writer, profile_report)
+    
+    del results
+    del shard_args
+    shutil.rmtree("/tmp/%s/shards" % job_id, ignore_errors=True)
+    del _col_pid
     
+    write_calculation_state(bonuscalculation1_id, calculation_entry)
     
-    # get SQL config
-    sql = """
-            SELECT
-                DISTINCT BC2M.consumption_from,
-                BC2M.consumption_until,
-                BC1.handle_area_types_diff,
-                BC2M.area_type,
-                BC2M.abssteps,
-                BC2M.max_bonus_sum_percentage,
-                BC2M.max_bonus_sum_abs,
-                BC2M.max_bonus_nc_abs,
-                BC2M.max_bonus_nc_percentage,
-                BC2M.min_bonus_ib_abs,
-                BC2M.max_bonus_ib_abs,
-                BC2M.lowest_rank,
-                BC2M.highest_rank,
-                BC2M.maxamortisation
-            FROM bonus_calculation_2_market BC2M
-            INNER JOIN bonus_calculation_1 BC1
-                ON BC2M.bonuscalculation1_id = BC1.bonuscalculation1_id
-            WHERE
-                BC2M.bonuscalculation1_id = %d
-            """ % bonuscalculation1_id
-    config = pd.read_sql(sql, conn)
+    logger.info("Time for Steps 1-30: %d" % (time.time() - s))
     
-    # save SQL to CSV for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'sql_1_config.csv')
-    # config.to_csv(path_or_buf=file_name, index=False)
     
     
+    insert_billing(conn, suffix, bonuscalculation1_id, result_rows)
     
-    # get SQL tariff
-    sql = """
-            SELECT
-                TA.pid,
-                TA.area_collection,
-                TA.basicrate,
-                TA.basicrate_margin,
-                TA.kwhrate,
-                TA.kwhrate_margin,
-                TA.consumption_from,
-                TA.consumption_until
-            FROM tariffs_available TA
-            INNER JOIN bonus_calculation_1 BC1
-            ON BC1.product_ext_name = TA.tariff_name
-            WHERE
-                BC1.bonuscalculation1_id = %d
-                AND TA.type = '%s'
-                AND DATE(NOW()) BETWEEN
-                    TA.available_bonus_from
-                    AND TA.available_bonus_until
-            """ % (bonuscalculation1_id, calculation_type)
-    tariff = pd.read_sql(sql, conn)
+    logger.info("Calculation info has been inserted to `billing` MySQL table")
+    write_profile_report(logger, profile_report)
+    logger.info("F3, done.")
     
-    # save SQL to CSV for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'sql_2_tariff.csv')
-    # tariff.to_csv(path_or_buf=file_name, index=False)
+    # end of Function3
+
+
+def Function3Batch(job_id, logger, calculations, marketdata_ending, suffix, workers=1, bonus_engine='numpy',
+                   result_writer=RESULT_WRITER, profile=False, profile_capture=None, trace_rate=0):
+    """
+    This function will:
+    - run Function3 for each (bonuscalculation1_id, bonuscampaign_id) of
+      calculations on the same market data
+    - download and load market data, query areas and run Steps 1-3 once for
+      all of them, see prepare_market_data()
+    - run Steps 4-30 of the calculations in turn, or at a pool of (at most
+      workers) forked processes which share the Steps 1-3 result
+    
+    Sharding and the incremental mode of Function3 are not supported.
+    """
+    
+    global _batch_market_data
     
+    calculation_type = 'Strom' if marketdata_ending[0:5] == 'Strom' else 'Gas'
     
+    logger.info("Start of Function3Batch. Parameters:")
+    logger.info('- - - - - - - - - - - - - -')
+    logger.info("calculations:         %s" % ', '.join("%d/%d" % calculation for calculation in calculations))
+    logger.info("marketdata_ending:    %s" % marketdata_ending)
+    logger.info("suffix:               %s" % suffix)
+    logger.info("calculation_type:     %s" % calculation_type)
+    logger.info('- - - - - - - - - - - - - -')
     
-    # tariff optimization
-    _col_pid = pd.DataFrame({'pid': tariff.pid.unique(), 'pid_id': range(len(tariff.pid.unique()))})
+    # per step wall/CPU time, memory and row counts of the job, the steps of
+    # Steps 4-30 are labeled with bonuscalculation1_id
+    profile_report = new_profile_report(job_id, 'Function3Batch', profile_capture) if profile else None
     
-    tariff = tariff.merge(_col_pid, on='pid', how='left')
-    tariff.drop(columns=['pid'], axis=1, inplace=True)
+    # sampled zip/city groups of each step to Parquet, Steps 4-29 of each
+    # calculation to a subdirectory named by bonuscalculation1_id
+    trace = new_trace(job_id, trace_rate) if trace_rate > 0 else None
     
+    s3_resource = boto3.resource('s3')
+    bucket = s3_resource.Bucket(os.environ['S3_BUCKET_PARQUET'])
     
+    germany = timezone('Europe/Berlin')
+    current_date_str = datetime.now(germany).strftime('%Y%m%d')
+    yesterday_str = (datetime.now(germany) - timedelta(1)).strftime('%Y%m%d')
     
-    # get SQL costmodelinternal
-    sql = """
-            SELECT
-                CMI.costmodelinternal_oneoff,
-                CMI.costmodelinternal_pa
-            FROM cost_model_internal CMI
-            INNER JOIN bonus_calculation_1 BC1
-                ON CMI.costmodelinternal_name = BC1.costmodelinternal_name
-            WHERE
-                BC1.bonuscalculation1_id = %d
-                AND DATE(NOW()) BETWEEN
-                    CMI.costmodelinternal_bonus_validfrom
-                    AND CMI.costmodelinternal_bonus_validuntil
-            """ % bonuscalculation1_id
-    costmodelinternal = pd.read_sql(sql, conn)
+    parquet_s3_key, parquet_s3_etag = find_market_data(bucket, marketdata_ending, [current_date_str, yesterday_str])
+    is_dataset = parquet_s3_key.endswith(MANIFEST_NAME)
+    logger.info("parquet_s3_key: %s (ETag %s)" % (parquet_s3_key, parquet_s3_etag))
     
-    # save SQL to CSV for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'sql_3_costmodelinternal.csv')
-    # costmodelinternal.to_csv(path_or_buf=file_name, index=False)
+    # create work directory
+    work_dir = "/tmp/%s" % job_id
+    os.mkdir(work_dir)
     
+    conn = connect_mysql(local_infile=result_writer == 'load_data')
     
     
-    # get SQL costmodelprovision
-    sql = """
-            SELECT
-                CMP.consumption_from,
-                CMP.consumption_until,
-                CMP.costmodelprovision_oneoff,
-                CMP.costmodelprovision_pa
-            FROM cost_model_provision CMP
-            INNER JOIN bonus_calculation_1 BC1
-                ON CMP.costmodelprovision_name = BC1.costmodelprovision_name
-            WHERE
-                BC1.bonuscalculation1_id = %d
-                AND DATE(NOW()) BETWEEN
-                    CMP.costmodelprovision_bonus_validfrom
-                    AND CMP.costmodelprovision_bonus_validuntil
-            """ % bonuscalculation1_id
-    costmodelprovision = pd.read_sql(sql, conn)
     
-    # save SQL to CSV for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'sql_4_costmodelprovision.csv')
-    # costmodelprovision.to_csv(path_or_buf=file_name, index=False)
+    # start reference queries, areas once for all calculations
+    queries = {'areas': reference_queries(calculations[0][0], calculation_type)['areas']}
+    for bonuscalculation1_id, _ in calculations:
+        for name, sql in reference_queries(bonuscalculation1_id, calculation_type).items():
+            if name != 'areas':
+                queries[(bonuscalculation1_id, name)] = sql
+    reference_data = read_sql_concurrently(logger, queries, REFERENCE_STRING_COLUMNS,
+                                           cache_key=(calculation_type, current_date_str))
     
     
     
-    # get SQL areas
-    sql = """
-            SELECT zip, city, AA.area_collection, area_type
-            FROM area_assignment AA
-            INNER JOIN area_definition AD
-                ON AA.area_collection = AD.area_collection
-            WHERE
-                AD.type = '%s'
-                AND DATE(NOW()) BETWEEN
-                    available_bonus_from
-                    AND available_bonus_until
-            """ % calculation_type
-    areas = pd.read_sql(sql, conn)
+    # download Parquet file (or the dataset partitions matching areas and
+    # consumption bands of any calculation)
+    try:
+        s = time.time()
+        start_step(profile_report, 'download')
+        if is_dataset:
+            consumption_ranges = [market_consumption_range(reference_data[(bonuscalculation1_id, 'config')].result(),
+                                                           reference_data[(bonuscalculation1_id, 'tariff')].result())
+                                  for bonuscalculation1_id, _ in calculations]
+            file_name = download_market_dataset(logger, bucket, parquet_s3_key, work_dir,
+                                                market_zip_prefixes(reference_data['areas'].result()['zip']),
+                                                (min(r[0] for r in consumption_ranges),
+                                                 max(r[1] for r in consumption_ranges)),
+                                                parquet_s3_etag)
+        else:
+            file_name = os.path.join(work_dir, parquet_s3_key)
+            download_cached(logger, bucket, parquet_s3_key, parquet_s3_etag, file_name)
+        logger.info("Time to download Parquet from S3: %d" % (time.time() - s))
+        end_step(profile_report)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "404":
+            logger.info("The object does not exist.")
+            return
+        else:
+            raise
+    
+    
+    
+    # Steps 1-3 - shared by all calculations
+    _batch_market_data = prepare_market_data(job_id, logger, file_name, is_dataset, reference_data['areas'].result(),
+                                             {}, profile_report, trace)
+    
+    
+    
+    # Steps 4-30 - per calculation
+    def calculation_args(bonuscalculation1_id):
+        config, tariff, costmodelinternal, costmodelprovision = [
+            reference_data[(bonuscalculation1_id, name)].result()
+            for name in ['config', 'tariff', 'costmodelinternal', 'costmodelprovision']]
+        
+        # tariff optimization
+        tariff['pid_id'], _col_pid = factorize_column(tariff['pid'])
+        log_conversion(logger, 'tariff', ['pid'], column_memory_usage(tariff, ['pid']),
+                       column_memory_usage(tariff, ['pid_id']))
+        tariff.drop(columns=['pid'], axis=1, inplace=True)
+        calculation_profile_report = None if profile_report is None else dict(profile_report, steps=[], _open=[])
+        calculation_trace = None if trace is None else dict(trace, dir=os.path.join(trace['dir'],
+                                                                                     str(bonuscalculation1_id)))
+        return _col_pid, (job_id, logger, config, tariff, costmodelinternal, costmodelprovision, bonus_engine,
+                          calculation_profile_report, calculation_trace)
+    
+    def write(bonuscalculation1_id, bonuscampaign_id, _col_pid, result, calculation_profile_report, s):
+        # s is the time the calculation started at, see calculate_batch_bonus()
+        result_rows = write_results(conn, job_id, [result], bonuscalculation1_id, bonuscampaign_id, _col_pid,
+                                    result_writer, calculation_profile_report)
+        add_profile_steps(profile_report, calculation_profile_report, bonuscalculation1_id=bonuscalculation1_id)
+        insert_billing(conn, suffix, bonuscalculation1_id, result_rows)
+        logger.info("Time for Steps 4-30 of bonuscalculation1_id %d (%d rows): %d" % (
+            bonuscalculation1_id, result_rows, time.time() - s))
+    
+    try:
+        if workers <= 1:
+            for bonuscalculation1_id, bonuscampaign_id in calculations:
+                _col_pid, args = calculation_args(bonuscalculation1_id)
+                write(bonuscalculation1_id, bonuscampaign_id, _col_pid, *calculate_batch_bonus(*args))
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(calculations)),
+                                     mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = {}
+                for bonuscalculation1_id, bonuscampaign_id in calculations:
+                    _col_pid, args = calculation_args(bonuscalculation1_id)
+                    futures[executor.submit(calculate_batch_bonus, *args)] = (bonuscalculation1_id,
+                                                                              bonuscampaign_id, _col_pid)
+                for future in as_completed(futures):
+                    write(*futures[future], *future.result())
+    finally:
+        _batch_market_data = None
+    
+    write_profile_report(logger, profile_report)
+    logger.info("F3 batch, done.")
+    
+    # end of Function3Batch
+
+
+def calculate_batch_bonus(job_id, logger, config, tariff, costmodelinternal, costmodelprovision,
+                          bonus_engine='numpy', profile_report=None, trace=None):
+    """
+    Steps 4-29 of a calculation of Function3Batch() on the shared Steps 1-3
+    result, see calculate_bonus(), return the result, profile_report with
+    the steps added and the time the calculation started at (a worker
+    process may start it long after it was submitted).
+    """
     
-    # save SQL to CSV for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'sql_5_areas.csv')
-    # areas.to_csv(path_or_buf=file_name, index=False)
+    s = time.time()
+    result = calculate_bonus(job_id, logger, _batch_market_data, config, tariff, costmodelinternal,
+                             costmodelprovision, {}, bonus_engine, profile_report=profile_report, trace=trace)
+    return result, profile_report, s
+
+
+def calculate_shard(job_id, logger, file_name, is_dataset, areas, config, tariff, costmodelinternal,
+                    costmodelprovision, bonus_engine='numpy', trace=None, profile_report=None):
+    """
+    This function will:
+    - load the market data of the zips in areas from file_name (Parquet
+      file, or dataset directory if is_dataset)
+    - run Steps 1-29 of Function3 on it, see prepare_market_data() and
+      calculate_bonus()
+    - return the result with zip and city decoded (their ids are local to
+      the shard) and pid still as pid_id of tariff, the memory usage of the
+      largest intermediate DataFrame in bytes and profile_report with the
+      steps of the shard added
+    """
+    
+    # memory usage of the main DataFrame after some steps, see log_memory_usage()
+    memory_report = {}
+    
+    result = prepare_market_data(job_id, logger, file_name, is_dataset, areas, memory_report, profile_report, trace)
+    result = calculate_bonus(job_id, logger, result, config, tariff, costmodelinternal, costmodelprovision,
+                             memory_report, bonus_engine, profile_report, trace)
+    
+    logger.info("Memory usage of result (MB): %s" % ', '.join(
+        "%s %.1f" % (step, usage / 1e6) for step, usage in memory_report.items()))
+    return result, max(memory_report.values()), profile_report
+
+
+def prepare_market_data(job_id, logger, file_name, is_dataset, areas, memory_report, profile_report=None,
+                        trace=None):
+    """
+    This function will:
+    - load the market data of the zips in areas from file_name (Parquet
+      file, or dataset directory if is_dataset)
+    - run Steps 1-3 and the sort of Step 4 on it, these only depend on
+      market data and areas
+    - return the result, calculate_bonus() does not modify it
+    """
+    
+    # load Parquet file, string columns as Categorical, only rows Step 2 and
+    # Step 3 keep
+    s = time.time()
+    start_step(profile_report, 'load')
+    vxdata = scan_market_data(file_name,
+                              MARKET_DATA_COLUMNS + ([ROW_COLUMN] if is_dataset else []),
+                              areas['zip'],
+                              ['zip', 'city', 'provider'])
+    if is_dataset:
+        # restore the row order of the single Parquet file, later steps
+        # depend on it for rows with equal sort keys
+        vxdata.sort_values(ROW_COLUMN, inplace=True)
+        vxdata.drop(columns=[ROW_COLUMN], inplace=True)
+    # the dictionary columns are compared with the object columns
+    # pd.read_parquet() used to return
+    converted_columns = ['zip', 'city', 'provider', 'rank']
+    before = column_memory_usage(vxdata, converted_columns, as_object=True)
+    vxdata['rank'] = pd.to_numeric(vxdata['rank'], downcast='integer')
+    log_conversion(logger, 'load', converted_columns, before, column_memory_usage(vxdata, converted_columns))
+    log_memory_usage(logger, memory_report, 'load', vxdata)
+    logger.info("Time to load Parquet to memory (%d rows): %d" % (len(vxdata), time.time() - s))
+    end_step(profile_report, vxdata)
     
     
     
     # Step 1 - Eliminate duplicates from vxdata
     s = time.time()
+    start_step(profile_report, 'Step 1', vxdata)
     vxdata.drop_duplicates(subset=['consumption',
                                    'zip',
                                    'city',
@@ -255,40 +549,79 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
                            inplace=True)
     
     logger.info("Time for Step 1: %d" % (time.time() - s))
-    # Step 2 - Save sample of DataFrame for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'step_01.csv')
-    # vxdata.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    end_step(profile_report, vxdata)
+    # Step 1 - Save sample of DataFrame for tracing
+    trace_step(trace, 'step_01', vxdata)
     
     
     
     # Step 2 - Delete rows where provider is E.ON Energie Deutschland GmbH
     s = time.time()
-    vxdata.query("provider != 'E.ON Energie Deutschland GmbH'", inplace=True)
+    start_step(profile_report, 'Step 2', vxdata)
+    vxdata.query("provider != @EXCLUDED_PROVIDER", inplace=True)
     vxdata.drop('provider', 1, inplace=True)
     
     logger.info("Time for Step 2: %d" % (time.time() - s))
+    end_step(profile_report, vxdata)
     # Step 2 - Save sample of DataFrame for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'step_02.csv')
-    # vxdata.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    trace_step(trace, 'step_02', vxdata)
     
     
     
     # Step 3 - Join vxdata (Parquet) with SQL areas & release memory from unused frames
+    # note: areas gets the categories of vxdata (plus its own), so both sides
+    #       are joined on Categorical codes
     s = time.time()
+    start_step(profile_report, 'Step 3', vxdata)
+    before = column_memory_usage(areas, ['zip', 'city']) + column_memory_usage(vxdata, ['zip', 'city'])
+    for column in ['city', 'zip']:
+        categories = vxdata[column].cat.categories.union(pd.Index(areas[column].dropna().unique()))
+        vxdata[column] = vxdata[column].cat.set_categories(categories)
+        areas[column] = areas[column].astype(vxdata[column].dtype)
+    log_conversion(logger, 'Step 3', ['zip', 'city'], before,
+                   column_memory_usage(areas, ['zip', 'city']) + column_memory_usage(vxdata, ['zip', 'city']))
     result = pd.merge(areas, vxdata, how='inner', on=['city', 'zip'])
     del areas
     del vxdata
     
     logger.info("Time for Step 3: %d" % (time.time() - s))
+    end_step(profile_report, result)
+    log_memory_usage(logger, memory_report, 'Step 3', result)
     # Step 3 - Save sample of DataFrame for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'step_03.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    trace_step(trace, 'step_03', result)
     
     
     
-    # Step 4 - Join result and config DataFrame
+    # Step 4 - Sort result for the join with config DataFrame
     s = time.time()
+    start_step(profile_report, 'Step 4, sort', result)
     result.sort_values(by=['consumption'], inplace=True)
+    
+    logger.info("Time for Step 4, sort: %d" % (time.time() - s))
+    end_step(profile_report, result)
+    return result
+
+
+def calculate_bonus(job_id, logger, result, config, tariff, costmodelinternal, costmodelprovision, memory_report,
+                    bonus_engine='numpy', profile_report=None, trace=None):
+    """
+    This function will:
+    - run Steps 4-29 of Function3 on the prepare_market_data() result, these
+      depend on the reference data of the calculation
+    - return the result with zip and city decoded and pid still as pid_id of
+      tariff
+    """
+    
+    # these variables used to store mapping of integer value from optimized
+    # DataFrames to original String value (value of id i at position i)
+    _col_zip = None
+    _col_city = None
+    
+    
+    
+    # Step 4 - Join result and config DataFrame
+    s = time.time()
+    start_step(profile_report, 'Step 4', result)
     config.sort_values(by=['consumption_until'], inplace=True)
     config_column_stats = config.groupby('area_type').size()
     if len(config_column_stats) == 0:
@@ -301,6 +634,7 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
                 axis=1,
                 inplace=True)
         logger.info("Time for Step 4, area difference False: %d" % (time.time() - s))
+        end_step(profile_report, result)
     else:
         # Merge on area_type and consumption
         result = pd.merge_asof(result, config,
@@ -312,9 +646,9 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
                 axis=1,
                 inplace=True)
         logger.info("Time for Step 4, area difference True: %d" % (time.time() - s))
+        end_step(profile_report, result)
     # Step 4 - Save sample of DataFrame for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'step_04.csv')
-    # result.head(n=1000000).to_csv(path_or_buf=file_name, index=False)
+    trace_step(trace, 'step_04', result)
     
     del config
     
@@ -329,34 +663,41 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
     # note: keep mapping of original String value to Integer for later use
     #       when inserting result to MySQL
     s = time.time()
-    _col_zip = pd.DataFrame({'zip': result.zip.unique(), 'zip_id': range(len(result.zip.unique()))})
-    _col_city = pd.DataFrame({'city': result.city.unique(), 'city_id': range(len(result.city.unique()))})
-    result = result.merge(_col_zip, on='zip', how='left')
-    result = result.merge(_col_city, on='city', how='left')
+    start_step(profile_report, 'Step 6', result)
+    result['zip_id'], _col_zip = factorize_column(result['zip'])
+    result['city_id'], _col_city = factorize_column(result['city'])
+    log_conversion(logger, 'Step 6', ['zip', 'city'], column_memory_usage(result, ['zip', 'city']),
+                   column_memory_usage(result, ['zip_id', 'city_id']))
     result.drop(columns=['zip', 'city'], axis=1, inplace=True)
     logger.info("Time for Step 6: %d" % (time.time() - s))
+    end_step(profile_report, result)
+    log_memory_usage(logger, memory_report, 'Step 6', result)
+    trace_step(trace, 'step_06', result, _col_zip, _col_city)
     
     
     
-    # Step 7 - Join tariff DataFrame to result DataFrame.
+    # Step 7 - Join tariff DataFrame to result DataFrame, only rows within
+    #          the consumption band of the tariff, see interval_merge()
     s = time.time()
-    result = pd.merge(result, tariff, how='inner', on='area_collection')
-    result.query('consumption_from <= consumption <= consumption_until', inplace=True)
+    start_step(profile_report, 'Step 7', result)
+    result = interval_merge(result, tariff, 'area_collection', 'consumption', 'consumption_from', 'consumption_until')
     result.drop(columns=['consumption_from'], axis=1, inplace=True)
     result.rename(columns={'consumption_until': 'consumption_until_from_tariff'}, inplace=True)
     
     # Step 7 - Release memory from unused variable(s)
     del tariff
     logger.info("Time for Step 7: %d" % (time.time() - s))
+    end_step(profile_report, result)
+    log_memory_usage(logger, memory_report, 'Step 7', result)
     
     # Step 7 - Save sample of DataFrame for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'step_07.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    trace_step(trace, 'step_07', result, _col_zip, _col_city)
     
     
     
     # Step 8 - Add two new columns
     s = time.time()
+    start_step(profile_report, 'Step 8', result)
     result['costmodelinternal_oneoff'] = costmodelinternal.iloc[0]['costmodelinternal_oneoff']
     result['costmodelinternal_pa'] = costmodelinternal.iloc[0]['costmodelinternal_pa']
     
@@ -364,326 +705,339 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
     del costmodelinternal
     
     logger.info("Time for Step 8: %d" % (time.time() - s))
-    # Step 8 - Save sample to CSV for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'step_08.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    end_step(profile_report, result)
+    # Step 8 - Save sample for tracing
+    trace_step(trace, 'step_08', result, _col_zip, _col_city)
     
     
     
     # Step 9 - Merging costmodelprovision to result
     s = time.time()
+    start_step(profile_report, 'Step 9', result)
     costmodelprovision.sort_values(by=['consumption_until'], inplace=True)
-    result.sort_values(by=['consumption'], inplace=True)
+    # note: Step 7 leaves result ordered by area_collection and within it by
+    #       consumption (the order of Step 4), a stable sort merges these runs
+    #       instead of sorting from scratch, rows with equal consumption keep
+    #       the order of Step 7
+    result.sort_values(by=['consumption'], kind='stable', inplace=True)
     result = pd.merge_asof(result, costmodelprovision, left_on='consumption', right_on='consumption_until', direction='forward')
     
     del costmodelprovision
     
     logger.info("Time for Step 9: %d" % (time.time() - s))
-    # Step 9 - Save sample to CSV for tracing
-    file_name = "/tmp/%s/%s" % (job_id, 'step_09.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    end_step(profile_report, result)
+    log_memory_usage(logger, memory_report, 'Step 9', result)
+    # Step 9 - Save sample for tracing
+    trace_step(trace, 'step_09', result, _col_zip, _col_city)
     
     
     
-    # Step 10 - Calculate eonprice column
+    # Steps 10-23 - Calculate bonus columns and drop rows without a valid
+    #               bonus, fused in bonus_kernel()
     s = time.time()
-    result.eval('eonprice = basicrate + consumption * kwhrate', inplace=True)
-    result['eonprice'].round(2)
+    start_step(profile_report, 'Steps 10-23', result)
+    result = bonus_kernel(result, bonus_engine)
+    logger.info("Time for Steps 10-23 (%s): %d" % (bonus_engine, time.time() - s))
+    end_step(profile_report, result)
+    log_memory_usage(logger, memory_report, 'Step 23', result)
+    trace_step(trace, 'step_23', result, _col_zip, _col_city)
     
-    logger.info("Time for Step 10: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_10.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
     
     
-    
-    # Step 11
-    # - pick smaller value of ( max_bonus_sum_abs , eonprice*max_bonus_sum_percentage )
-    # - then round_down with value from abssteps column
-    # - drop unused columns
+    # Step 24 - Keep all rows for pid/zip/city/consumption where rank is the lowest
+    # note: Steps 24-26 work on row positions of result, see keep_group_min_rows()
     s = time.time()
-    result.eval('tmp1 = eonprice * max_bonus_sum_percentage', inplace=True)
-    result['max_bonus_sum_abs'] = round_down(result[['tmp1', 'max_bonus_sum_abs']].min(axis=1), result['abssteps'])
-    result.drop(columns=['max_bonus_sum_percentage', 'tmp1'],
-                axis=1,
-                inplace=True)
+    start_step(profile_report, 'Step 24', result)
+    group_columns = ['pid_id', 'zip_id', 'city_id', 'consumption_from']
+    step24 = keep_group_min_rows(result, group_columns, 'rank')
     
-    logger.info("Time for Step 11: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_11.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    logger.info("Time for Step 24: %d" % (time.time() - s))
+    end_step(profile_report, step24)
+    trace_step(trace, 'step_24', result, _col_zip, _col_city, step24)
     
     
     
-    # Step 12
-    # - pick smaller value of ( max_bonus_nc_abs , eonprice*max_bonus_nc_percentage )
-    # - then round_down with value from abssteps column
+    # Step 25 - Keep all rows for pid/zip/city/consumption where bonus_needed <= max_bonus_pm_abs & rank <= lowest_rank
+    # 1. We filter for rank <= lowest_rank.
+    # 2. Calculate max_bonus_pm_abs - bonus_needed
+    # 3. Only keep where 2. is >= 0
     s = time.time()
-    result.eval('tmp1 = eonprice * max_bonus_nc_percentage', inplace=True)
-    result['tmp1'] = round_down(result['tmp1'], result['abssteps'])
-    result['max_bonus_nc_abs'] = result[['tmp1', 'max_bonus_nc_abs']].min(axis=1)
-    result.drop(columns=['max_bonus_nc_percentage', 'tmp1'],
-                axis=1,
-                inplace=True)
+    start_step(profile_report, 'Step 25', result)
+    step25 = np.flatnonzero(result.eval('rank <= lowest_rank & 0 >= max_bonus_pm_abs - bonus_needed').values)
+    
+    logger.info("Time for Step 25: %d" % (time.time() - s))
+    end_step(profile_report, step25)
+    trace_step(trace, 'step_25', result, _col_zip, _col_city, step25)
     
-    logger.info("Time for Step 12: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_12.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-     
     
     
-    # Step 13
-    # - redefine max_bonus_sum_abs
-    # - delete all rows where ( eonprice – max_bonus_sum_abs ) > priceSumNet
+    # Step 26
+    # Combine rows from steps 24 & 25 and keep where bonus_needed is minimal,
+    # then where rank is minimal.
+    # note: duplicates share group and values, so dropping them after the
+    #       filters keeps the same rows in the same order as before them
     s = time.time()
-    result.eval('tmp1 = max_bonus_nc_abs + max_bonus_ib_abs', inplace=True)
-    result['max_bonus_sum_abs'] = result[['tmp1', 'max_bonus_sum_abs']].min(axis=1)
-    result.query('(eonprice - max_bonus_sum_abs) <= priceSumNet', inplace=True)
-    result.drop(columns=['tmp1'],
-                axis=1,
-                inplace=True)
+    start_step(profile_report, 'Step 26', result)
+    rows = np.concatenate([step24, step25])
+    del step24
+    del step25
+    
+    rows = keep_group_min_rows(result, group_columns, 'bonus_needed', rows)
+    rows = keep_group_min_rows(result, group_columns, 'rank', rows)
     
-    logger.info("Time for Step 13: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_13.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    result = result.take(rows)
+    result = result[~result.duplicated().values]
+    result.reset_index(drop=True, inplace=True)
+    del rows
+    
+    logger.info("Time for Step 26: %d" % (time.time() - s))
+    end_step(profile_report, result)
+    log_memory_usage(logger, memory_report, 'Step 26', result)
+    trace_step(trace, 'step_26', result, _col_zip, _col_city)
     
     
     
-    # Step 14 - Delete all rows where rank < highest_rank
+    # Step 27
+    # Recalculate these columns in this order one after another:
+    # a. nc = smaller one of: (bonus_needed – ib), ( max_bonus_nc_abs )
+    # b. ib = bonus_needed – nc
     s = time.time()
-    result.query('rank >= highest_rank', inplace=True)
+    start_step(profile_report, 'Step 27', result)
+    result.eval('tmp = bonus_needed - ib', inplace=True)
+    result['nc'] = result[['max_bonus_nc_abs', 'tmp']].min(axis=1)
+    result.eval('ib = bonus_needed - nc')
     
-    logger.info("Time for Step 14: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_14.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    logger.info("Time for Step 27: %d" % (time.time() - s))
+    end_step(profile_report, result)
+    trace_step(trace, 'step_27', result, _col_zip, _col_city)
     
     
     
-    # Step 15
-    # - calculate max_bonus_pm_abs column
-    # - then round_down with value from abssteps column
+    # Step 28
+    # Set consumption_until like the next higher consumption_from
+    # in the pid-zip-city group minus 1.
+    # If it is the highest, keep the existing value.
     s = time.time()
-    result.eval('max_bonus_pm_abs = (maxamortisation * (basicrate_margin + consumption * kwhrate_margin - costmodelinternal_pa - costmodelprovision_pa)) - costmodelinternal_oneoff - costmodelprovision_oneoff', inplace=True)
-    result.eval('zero = 0', inplace=True)
-    result['max_bonus_pm_abs'] = result[['max_bonus_pm_abs', 'zero']].max(axis=1)
-    result['max_bonus_pm_abs'] = round_down(result['max_bonus_pm_abs'], result['abssteps'])
-    result.drop(columns=['zero'],
-                axis=1,
-                inplace=True)
+    start_step(profile_report, 'Step 28', result)
+    result = set_next_band_ends(result, ['pid_id', 'zip_id', 'city_id'])
     
-    logger.info("Time for Step 15: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_15.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    logger.info("Time for Step 28: %d" % (time.time() - s))
+    end_step(profile_report, result)
+    trace_step(trace, 'step_28', result, _col_zip, _col_city)
     
     
     
-    # Step 16 - Reduce result to less columns at the moment
+    # Step 29 - Reduce the result dataframe columns
     s = time.time()
-    select_columns = [
-        'pid_id',
-        'zip_id',
-        'city_id',
-        'rank',
-        'consumption',
-        'consumption_until_from_tariff',
-        'eonprice',
-        'priceSumNet',
-        'max_bonus_sum_abs',
-        'max_bonus_ib_abs',
-        'min_bonus_ib_abs',
-        'lowest_rank',
-        'max_bonus_pm_abs',
-        'abssteps',
-        'max_bonus_nc_abs'
-    ]
-    result = result[select_columns]
+    start_step(profile_report, 'Step 29', result)
+    result = result[['pid_id', 'zip_id', 'city_id', 'consumption_from', 'consumption_until', 'nc', 'ib']]
     
-    # Step 16 - Rename columns
-    result.rename(columns={'consumption': 'consumption_from', 'consumption_until_from_tariff': 'consumption_until'}, inplace=True)
-    logger.info("Time for Step 16: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_16.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    logger.info("Time for Step 29: %d" % (time.time() - s))
+    end_step(profile_report, result)
+    trace_step(trace, 'step_29', result, _col_zip, _col_city)
     
     
     
-    # Step 17 - Calculate bonus_needed column
-    s = time.time()
-    result.eval('bonus_needed = eonprice - priceSumNet', inplace=True)
-    result.eval('zero = 0', inplace=True)
-    result['bonus_needed'] = result[['bonus_needed', 'zero']].max(axis=1)
-    result['bonus_needed'] = round_up(result['bonus_needed'], result['abssteps'])
-    result.drop(columns=['zero'],
-                axis=1,
-                inplace=True)
-    logger.info("Time for Step 17: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_17.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-    
-    
-    
-    # Step 18 - Create result columns
-    s = time.time()
-    result.eval('zero = 0', inplace=True)
-    
-    # Step 19 - Find instant bonus (ib) based on minimum
-    result.eval('ib = min_bonus_ib_abs', inplace=True)
-    result['ib'] = round_up(result['ib'], result['abssteps'])
-    
-    # Step 20 - Find new customer bonus (nc) based on what's still needed after minimum ib
-    result.eval('nc = bonus_needed - ib', inplace=True)
-    result['nc'] = round_up(result['nc'], result['abssteps'])
-    
-    # Step 21 - Make sure, nc is not below 0 and not over maximum nc
-    result['nc'] = result[['nc', 'zero']].max(axis=1)
-    result['nc'] = result[['nc', 'max_bonus_nc_abs']].min(axis=1)
-    
-    # Step 22 - If there is bonus needed left, get it through instant bonus (ib)
-    result.eval('ib = bonus_needed - nc', inplace=True)
-    result['ib'] = round_up(result['ib'], result['abssteps'])
-    
-    result.drop(columns=['zero'],
-                axis=1,
-                inplace=True)
-    
-    logger.info("Time for Steps 18-22: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_22.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-    
-    
-    
-    # Step 23 - Drop all rows in result where: ( nc + ib ) < bonus_needed
-    s = time.time()
-    result.query('(nc + ib) >= bonus_needed', inplace=True)
-    
-    logger.info("Time for Step 23: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_23.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
+    # decode zip and city, see Step 6
+    result['zip'] = _col_zip.take(result['zip_id'].values)
+    result['city'] = _col_city.take(result['city_id'].values)
+    result.drop(columns=['zip_id', 'city_id'], axis=1, inplace=True)
+    log_memory_usage(logger, memory_report, 'Step 29', result)
     
+    del _col_zip
+    del _col_city
     
+    return result
 
-    # Step 24 - Keep all rows for pid/zip/city/consumption where rank is the lowest
-    s = time.time()
-    # COMMENTED IS THE BREAKING IMPLEMENTATION BY SUSHMIT
-    # groupby_columns = [
-    #                     pd.Grouper('pid_id', axis=1),
-    #                     pd.Grouper('zip_id', axis=1),
-    #                     pd.Grouper('city_id', axis=1),
-    #                     pd.Grouper('consumption_from', axis=1)
-    # ]
-    # step24 = result.groupby(groupby_columns, as_index=False)
-    # NEXT LINE IS THE OLD WORKING IMPLEMENTATION
-    step24 = result.groupby(['pid_id', 'zip_id', 'city_id', 'consumption_from'], as_index=False)
-    step24 = step24['rank'].min()
-    step24 = result.merge(step24, how='inner', on=['pid_id', 'zip_id', 'city_id', 'consumption_from', 'rank'])
-    
-    logger.info("Time for Step 24: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_24.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-    
-    
-    
-    # Step 25 - Keep all rows for pid/zip/city/consumption where bonus_needed <= max_bonus_pm_abs & rank <= lowest_rank
-    # 1. We filter for rank <= lowest_rank.
-    # 2. Calculate max_bonus_pm_abs - bonus_needed
-    # 3. Only keep where 2. is >= 0
-    s = time.time()
-    result.query('rank <= lowest_rank & 0 >= max_bonus_pm_abs - bonus_needed', inplace=True)
-    
-    logger.info("Time for Step 25: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_25.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-    
-    
-    
-    # Step 26
-    # Combine dataframes from steps 24 & 25 to new result DataFrame and keep where bonus_needed is minimal
-    s = time.time()
-    result = pd.concat([step24, result])
-    del step24
-    
-    result.drop_duplicates(inplace=True)
-    
-    # ROLLBACK ALSO HERE
-    tmp = result.groupby(['pid_id', 'zip_id', 'city_id', 'consumption_from'], as_index=False)
-    tmp = tmp['bonus_needed'].min()
-    result = result.merge(tmp, how='inner', on=['pid_id', 'zip_id', 'city_id', 'consumption_from', 'bonus_needed'])
-    del tmp
-    
-    # ROLLBACK ALSO HERE
-    tmp = result.groupby(['pid_id', 'zip_id', 'city_id', 'consumption_from'], as_index=False)
-    tmp = tmp['rank'].min()
-    result = result.merge(tmp, how='inner', on=['pid_id', 'zip_id', 'city_id', 'consumption_from', 'rank'])
-    del tmp
-    
-    logger.info("Time for Step 26: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_26.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-    
-    
-    
-    # Step 27
-    # Recalculate these columns in this order one after another:
-    # a. nc = smaller one of: (bonus_needed – ib), ( max_bonus_nc_abs )
-    # b. ib = bonus_needed – nc
-    s = time.time()
-    result.eval('tmp = bonus_needed - ib', inplace=True)
-    result['nc'] = result[['max_bonus_nc_abs', 'tmp']].min(axis=1)
-    result.eval('ib = bonus_needed - nc')
-    
-    logger.info("Time for Step 27: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_27.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-    
-    
-    
-    # Step 28
-    # Set consumption_until like the next higher consumption_from
-    # in the pid-zip-city group minus 1.
-    # If it is the highest, keep the existing value.
-    s = time.time()
-    
-    # for each group of pid-zip-city, sort rows by consumption_from (ascending)
-    # COMMENTED IS THE BREAKING IMPLEMENTATION BY SUSHMIT
-    # pid_zip_city_columns = [
-    #                         pd.Grouper('pid_id', axis=1),
-    #                         pd.Grouper('zip_id', axis=1),
-    #                         pd.Grouper('city_id', axis=1)
-    # ]
-    # result = result.groupby(pid_zip_city_columns).apply(pd.DataFrame.sort_values, 'consumption_from')
-    # FOLLOWING LINE IS THE ROLLBACK TO THE WORKING VERSION
-    result = result.groupby(['pid_id', 'zip_id', 'city_id']).apply(pd.DataFrame.sort_values, 'consumption_from')
-    
-    # WRONG ONE AGAIN
-    # result['consumption_until_new'] = result.groupby(pid_zip_city_columns)['consumption_from'].shift(-1)
-    
-    # WORKING ONE
-    result['consumption_until_new'] = result.groupby(['pid_id', 'zip_id', 'city_id'])['consumption_from'].shift(-1)
-    result['consumption_until_new'] -= 1
-    result['consumption_until_new'] = result['consumption_until_new'].fillna(result['consumption_until'])
-    result.drop(['consumption_until'], inplace=True, axis=1)
-    result.rename(index=str, inplace=True, columns={'consumption_until_new': 'consumption_until'})
-    
-    logger.info("Time for Step 28: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_28.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-    
-    
+
+def shard_by_zip(areas, shards):
+    """
+    This function will:
+    - split areas into (at most) shards DataFrames by a hash of zip, all
+      rows of a zip (missing zips too) are in the same shard
+    - return the non-empty shards, or areas itself for a single shard
+    """
+    
+    if shards <= 1 or len(areas) == 0:
+        return [areas]
+    shard = pd.util.hash_pandas_object(areas['zip'], index=False).values % shards
+    return [areas[shard == i] for i in np.unique(shard)]
+
+
+def split_market_data(logger, file_name, is_dataset, area_shards, shard_path):
+    """
+    This function will:
+    - scan the market data rows of the zips of all area_shards once, see
+      scan_market_table()
+    - write the rows of each area shard (by zip, missing zips too) to its
+      own Parquet file <shard_path><i>.parquet, in the row order of the
+      market data file
+    - return (file name, is_dataset) of the market data of each area shard,
+      file_name itself for a single shard
+    
+    Row groups and partitions of the market data are not split by zip hash,
+    so without this every shard would scan all of the market data.
+    """
+    
+    if len(area_shards) <= 1:
+        return [(file_name, is_dataset)] * len(area_shards)
     
-    # Step 29 - Reduce the result dataframe columns
     s = time.time()
-    result = result[['pid_id', 'zip_id', 'city_id', 'consumption_from', 'consumption_until', 'nc', 'ib']]
-    
-    logger.info("Time for Step 29: %d" % (time.time() - s))
-    file_name = "/tmp/%s/%s" % (job_id, 'step_29.csv')
-    # result.head(n=100000).to_csv(path_or_buf=file_name, index=False)
-    
-    
+    zips = pd.concat([area_shard['zip'] for area_shard in area_shards])
+    table = scan_market_table(file_name, MARKET_DATA_COLUMNS + ([ROW_COLUMN] if is_dataset else []), zips,
+                              ['zip', 'city', 'provider'])
+    if is_dataset:
+        # restore the row order of the single Parquet file, see
+        # prepare_market_data()
+        table = table.take(pc.sort_indices(table[ROW_COLUMN])).drop([ROW_COLUMN])
+    
+    # shard of each row by its zip, shard_by_zip() puts all rows of a zip
+    # into the same area shard
+    shard_of_zip = pd.concat([pd.Series(i, index=area_shard['zip'].dropna().unique())
+                              for i, area_shard in enumerate(area_shards)])
+    missing_zip_shard = [i for i, area_shard in enumerate(area_shards) if area_shard['zip'].isna().any()]
+    row_zips = pd.Categorical(table['zip'].to_pandas())
+    shard_of_category = shard_of_zip.reindex(row_zips.categories).fillna(-1).values.astype(np.int64)
+    row_shard = np.where(row_zips.codes >= 0, shard_of_category[row_zips.codes],
+                         missing_zip_shard[0] if missing_zip_shard else -1)
+    
+    os.makedirs(shard_path, exist_ok=True)
+    shard_files = []
+    for i in range(len(area_shards)):
+        shard_file_name = "%s%d.parquet" % (shard_path, i)
+        pq.write_table(table.filter(pa.array(row_shard == i)), shard_file_name)
+        shard_files.append((shard_file_name, False))
+    
+    logger.info("Time to split market data (%d rows) into %d shards: %d" % (len(table), len(area_shards),
+                                                                             time.time() - s))
+    return shard_files
+
+
+def calculate_shards(logger, shard_args, workers=SHARD_WORKERS, memory_budget=SHARD_MEMORY_BUDGET,
+                     profile_report=None):
+    """
+    This function will:
+    - run calculate_shard() with each tuple of arguments of shard_args, in
+      this process for a single shard, otherwise in a pool of worker processes
+    - keep only as many shards in flight as fit memory_budget (bytes), judged
+      by the largest DataFrame of a finished shard (one shard until the first
+      one is finished)
+    - yield the result of each shard as soon as it is finished
+    - add the steps of the shards to profile_report (if any), labeled with
+      the index of the shard when run in the pool
+    """
+    
+    if len(shard_args) <= 1:
+        for args in shard_args:
+            yield calculate_shard(*args, profile_report=profile_report)[0]
+        return
+    
+    pending = list(reversed(list(enumerate(shard_args))))
+    running = {}
+    shard_usage = None
+    with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+        while pending or running:
+            in_flight = 1 if shard_usage is None else max(1, memory_budget // max(shard_usage, 1))
+            while pending and len(running) < in_flight:
+                shard, args = pending.pop()
+                shard_profile_report = None if profile_report is None else dict(profile_report, steps=[], _open=[])
+                running[executor.submit(calculate_shard, *args, profile_report=shard_profile_report)] = shard
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard = running.pop(future)
+                result, usage, shard_profile_report = future.result()
+                shard_usage = max(shard_usage or 0, usage)
+                add_profile_steps(profile_report, shard_profile_report, shard=shard)
+                yield result
+                del result
+
+
+def write_results(conn, job_id, results, bonuscalculation1_id, bonuscampaign_id, _col_pid, result_writer,
+                  profile_report=None):
+    """
+    This function will:
+    - write the calculate_shard() results (any iterable) of a calculation
+      to bonus_results, replacing today's rows of bonuscalculation1_id
+    - return the number of rows written
+    """
     
-    # Step 30 - Insert calculation result to MySQL, bonus_results table
     # Pre: 
     #    Delete existing rows at bonus_results (if any), that:
     #    (date_calculated = today) for current bonuscalculation1_id
-    s = time.time()
+    # note: with result_writer 'load_data' the rows are loaded into a staging
+    #       table first and replace the existing rows in one transaction, see
+    #       publish_result(), so readers (Function6) never see a partly
+    #       written calculation
+    # note: with result_writer 'to_sql' the rows are deleted once the first
+    #       result is calculated (results may be a lazy generator of shards),
+    #       so they stay in place while Steps 1-29 run and if the first
+    #       shard fails; a failure of a later shard leaves today's rows of
+    #       the calculation partly written
+    deleted = False
+    if result_writer == 'load_data':
+        staging_table = create_staging_table(conn, bonuscalculation1_id)
+        tsv_file_name = "/tmp/%s/%s" % (job_id, 'bonus_results.tsv')
+    else:
+        connection_string = "mysql+mysqlconnector://%s:%s@%s:3306/%s" % (os.environ['SQL_USER'], os.environ['SQL_PASSWORD'], os.environ['SQL_HOST'], os.environ['SQL_DBNAME'])
+        engine = create_engine(connection_string, echo=False, pool_recycle=30)
+    
+    result_rows = 0
+    for result in results:
+        start_step(profile_report, 'Step 30', result)
+        result['pid'] = _col_pid.take(result['pid_id'].values)
+        result.drop(columns=['pid_id'], axis=1, inplace=True)
+        result['bonuscampaign_id'] = bonuscampaign_id
+        result['bonuscalculation1_id'] = bonuscalculation1_id
+        result['date_calculated'] = pd.to_datetime('today')
+        if result_writer == 'load_data':
+            load_result(conn, staging_table, result, tsv_file_name)
+        else:
+            if not deleted:
+                # Pre - delete existing rows
+                delete_result(conn, bonuscalculation1_id)
+                conn.commit()
+                deleted = True
+            result.to_sql(name='bonus_results', con=engine, if_exists='append', index=False, chunksize=30000)
+        result_rows += result.shape[0]
+        end_step(profile_report, result)
+        del result
+    
+    if result_writer == 'load_data':
+        start_step(profile_report, 'Step 30, publish')
+        publish_result(conn, staging_table, bonuscalculation1_id)
+        end_step(profile_report)
+    elif not deleted:
+        # no result rows, only delete existing rows
+        delete_result(conn, bonuscalculation1_id)
+        conn.commit()
+    
+    return result_rows
+
+
+def insert_billing(conn, suffix, bonuscalculation1_id, rows):
+    """
+    Insert the billing row of a calculation of rows bonus_results rows.
+    """
+    
+    sql = """
+            INSERT INTO `billing` (
+                `inserted`,
+                `department_responsible`,
+                `billing_name`,
+                `amount`
+            ) VALUES (NOW(), '%s', 'bonuscalculation %s', %d)
+            """ % (suffix, bonuscalculation1_id, rows)
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        conn.commit()
+
+
+def delete_result(conn, bonuscalculation1_id):
+    """
+    Delete the rows of bonus_results calculated today for
+    bonuscalculation1_id, the caller commits.
+    """
     
-    # Pre - delete existing rows
     sql = """
             DELETE FROM bonus_results
             WHERE 
@@ -692,42 +1046,1302 @@ def Function3(job_id, logger, bonuscalculation1_id, bonuscampaign_id, marketdata
             """ % bonuscalculation1_id
     with conn.cursor() as cursor:
         cursor.execute(sql)
+
+
+def create_staging_table(conn, bonuscalculation1_id):
+    """
+    This function will:
+    - (re)create an empty staging table like bonus_results for
+      bonuscalculation1_id, a left over one of a failed job is dropped
+    - return its name
+    """
+    
+    staging_table = 'bonus_results_staging_%d' % bonuscalculation1_id
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS `%s`" % staging_table)
+        cursor.execute("CREATE TABLE `%s` LIKE bonus_results" % staging_table)
+    conn.commit()
+    return staging_table
+
+
+def load_result(conn, staging_table, result, tsv_file_name):
+    """
+    This function will:
+    - write the RESULT_COLUMNS of result as a TSV file in the default format
+      of LOAD DATA (missing values as \\N, backslash, tab and newlines of
+      strings escaped)
+    - load it into staging_table with LOAD DATA LOCAL INFILE and remove it
+    """
+    
+    escaped = {column: result[column].str.translate(TSV_ESCAPES)
+               for column in result[RESULT_COLUMNS].select_dtypes(include='object').columns}
+    result[RESULT_COLUMNS].assign(**escaped).to_csv(tsv_file_name, sep='\t', header=False, index=False,
+                                                    na_rep='\\N', quoting=csv.QUOTE_NONE,
+                                                    date_format='%Y-%m-%d %H:%M:%S.%f')
+    
+    sql = """
+            LOAD DATA LOCAL INFILE '%s'
+            INTO TABLE `%s`
+            CHARACTER SET utf8
+            (%s)
+            """ % (tsv_file_name, staging_table, ', '.join(RESULT_COLUMNS))
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+    conn.commit()
+    os.remove(tsv_file_name)
+
+
+def publish_result(conn, staging_table, bonuscalculation1_id):
+    """
+    This function will:
+    - replace the rows of bonus_results calculated today for
+      bonuscalculation1_id by the rows of staging_table, in one transaction
+    - drop staging_table
+    
+    bonus_results holds all calculations, so a table rename or partition
+    exchange would publish more than this calculation. The rows are copied
+    on the server instead, readers see the old or the new rows.
+    """
+    
+    columns = ', '.join(RESULT_COLUMNS)
+    try:
+        conn.begin()
+        delete_result(conn, bonuscalculation1_id)
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO bonus_results (%s) SELECT %s FROM `%s`" % (columns, columns, staging_table))
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     
-    connection_string = "mysql+mysqlconnector://%s:%s@%s:3306/%s" % (os.environ['SQL_USER'], os.environ['SQL_PASSWORD'], os.environ['SQL_HOST'], os.environ['SQL_DBNAME'])
-    engine = create_engine(connection_string, echo=False, pool_recycle=30)
-    result = result.merge(_col_zip, how='inner', on='zip_id')
-    result = result.merge(_col_city, how='inner', on='city_id')
-    result = result.merge(_col_pid, how='inner', on='pid_id')
-    result.drop(columns=['zip_id', 'city_id', 'pid_id'], axis=1, inplace=True)
-    result['bonuscampaign_id'] = bonuscampaign_id
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE `%s`" % staging_table)
+    conn.commit()
+
+
+def benchmark_result_writers(logger, rows=1000000, bonuscalculation1_id=0, work_dir='/tmp'):
+    """
+    This function will:
+    - write rows synthetic result rows for bonuscalculation1_id (no real
+      calculation must use it) to bonus_results of the SQL_* database, once
+      with DataFrame.to_sql as Step 30 did and once with
+      load_result()/publish_result()
+    - delete the rows again and return the seconds of each writer
+    """
+    
+    rng = np.random.RandomState(0)
+    result = pd.DataFrame({'consumption_from': rng.randint(0, 100000, rows),
+                           'consumption_until': rng.randint(0, 100000, rows).astype(np.float64),
+                           'nc': rng.randint(0, 200, rows).astype(np.float64),
+                           'ib': rng.randint(0, 200, rows).astype(np.float64),
+                           'zip': pd.Series(rng.randint(1000, 99999, rows)).map('%05d'.__mod__),
+                           'city': pd.Series(rng.choice(['München', 'Köln', 'Berlin'], rows)),
+                           'pid': pd.Series(rng.randint(0, 5000, rows)).map('P%d'.__mod__)})
+    result['bonuscampaign_id'] = 0
     result['bonuscalculation1_id'] = bonuscalculation1_id
     result['date_calculated'] = pd.to_datetime('today')
-    result.to_sql(name='bonus_results', con=engine, if_exists='append', index=False, chunksize=30000)
     
-    del _col_zip
-    del _col_city
-    del _col_pid
+    conn = connect_mysql(local_infile=True)
+    connection_string = "mysql+mysqlconnector://%s:%s@%s:3306/%s" % (os.environ['SQL_USER'], os.environ['SQL_PASSWORD'], os.environ['SQL_HOST'], os.environ['SQL_DBNAME'])
+    engine = create_engine(connection_string, echo=False, pool_recycle=30)
+    timings = {}
+    try:
+        s = time.time()
+        delete_result(conn, bonuscalculation1_id)
+        conn.commit()
+        result.to_sql(name='bonus_results', con=engine, if_exists='append', index=False, chunksize=30000)
+        timings['to_sql'] = time.time() - s
+        
+        s = time.time()
+        staging_table = create_staging_table(conn, bonuscalculation1_id)
+        load_result(conn, staging_table, result, os.path.join(work_dir, 'bonus_results_benchmark.tsv'))
+        publish_result(conn, staging_table, bonuscalculation1_id)
+        timings['load_data'] = time.time() - s
+    finally:
+        delete_result(conn, bonuscalculation1_id)
+        conn.commit()
+        conn.close()
+    
+    logger.info("Time to write %d rows to bonus_results: %s" % (
+        rows, ', '.join("%s %.1f" % (writer, seconds) for writer, seconds in timings.items())))
+    return timings
+
+
+def reference_fingerprint(frames):
+    """
+    SHA-256 of columns and values of the reference DataFrames.
+    """
+    
+    digest = hashlib.sha256()
+    for df in frames:
+        digest.update(json.dumps([str(c) for c in df.columns]).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def read_calculation_state(bonuscalculation1_id):
+    """
+    Entry of the last calculation of bonuscalculation1_id at the host-local
+    calculation state, or None.
+    """
+    
+    if not os.path.exists(CALCULATION_STATE_PATH):
+        return None
+    with open(CALCULATION_STATE_PATH) as fp:
+        return json.load(fp).get(str(bonuscalculation1_id))
+
+
+def write_calculation_state(bonuscalculation1_id, calculation_entry):
+    """
+    Add or replace the entry of bonuscalculation1_id at the host-local
+    calculation state. Concurrent jobs are serialized with a file lock.
+    """
+    
+    with open(CALCULATION_STATE_PATH + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = {}
+        if os.path.exists(CALCULATION_STATE_PATH):
+            with open(CALCULATION_STATE_PATH) as fp:
+                state = json.load(fp)
+        state[str(bonuscalculation1_id)] = calculation_entry
+        with open(CALCULATION_STATE_PATH + '.tmp', 'w') as fp:
+            json.dump(state, fp, indent=1)
+        os.replace(CALCULATION_STATE_PATH + '.tmp', CALCULATION_STATE_PATH)
+
+
+def plan_incremental(logger, bucket, work_dir, bonuscalculation1_id, calculation_entry, yesterday_str, file_name,
+                     reference_data):
+    """
+    This function will:
+    - look up the last calculation of bonuscalculation1_id at the
+      calculation state, it must be of yesterday_str and with the same
+      reference data as calculation_entry
+    - download its market data (unless unchanged) and compare it with the
+      market data at file_name on MARKET_DIFF_COLUMNS
+    - return the rows of areas whose zip/city pair has changed market rows,
+      or None if yesterday's bonus_results can not be carried forward
+    """
+    
+    previous_entry = read_calculation_state(bonuscalculation1_id)
+    if previous_entry is None or previous_entry['date'] != yesterday_str:
+        logger.info("No calculation of %s, calculating all zip/city pairs" % yesterday_str)
+        return None
+    if previous_entry['reference_sha256'] != calculation_entry['reference_sha256']:
+        logger.info("Reference data changed since %s, calculating all zip/city pairs" % yesterday_str)
+        return None
+    
+    areas = reference_data['areas'].result()
+    if (previous_entry['market_key'], previous_entry['market_etag']) == (calculation_entry['market_key'],
+                                                                         calculation_entry['market_etag']):
+        logger.info("Market data unchanged since %s" % yesterday_str)
+        return areas.iloc[:0]
     
-    logger.info("Time for Step 30: %d" % (time.time() - s))
+    try:
+        etag = bucket.meta.client.head_object(Bucket=bucket.name, Key=previous_entry['market_key'])['ETag'].strip('"')
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            logger.info("Market data of %s deleted, calculating all zip/city pairs" % yesterday_str)
+            return None
+        raise
+    if etag != previous_entry['market_etag']:
+        logger.info("Market data of %s replaced, calculating all zip/city pairs" % yesterday_str)
+        return None
+    previous_file_name = download_market_data(logger, bucket, previous_entry['market_key'], etag, work_dir,
+                                              reference_data)
+    
+    dictionary_columns = ['zip', 'city', 'provider']
+    market_data = scan_market_data(file_name, MARKET_DIFF_COLUMNS, areas['zip'], dictionary_columns)
+    previous_market_data = scan_market_data(previous_file_name, MARKET_DIFF_COLUMNS, areas['zip'], dictionary_columns)
+    changed_pairs = changed_zip_cities(market_data, previous_market_data)
+    del market_data
+    del previous_market_data
+    
+    changed = np.isin(pd.util.hash_pandas_object(areas[['zip', 'city']], index=False).values, changed_pairs)
+    logger.info("Market data of %d of %d area rows changed since %s" % (changed.sum(), len(areas), yesterday_str))
+    return areas[changed]
+
+
+def changed_zip_cities(market_data, previous_market_data):
+    """
+    Hashes (see pandas.util.hash_pandas_object) of the zip/city pairs of
+    market rows that are in only one of both market data DataFrames.
+    """
+    
+    row_hashes = [pd.util.hash_pandas_object(df[MARKET_DIFF_COLUMNS], index=False).values
+                  for df in [market_data, previous_market_data]]
+    pairs = []
+    for df, hashes, other_hashes in [(market_data, row_hashes[0], row_hashes[1]),
+                                     (previous_market_data, row_hashes[1], row_hashes[0])]:
+        changed = ~np.isin(hashes, other_hashes)
+        pairs.append(pd.util.hash_pandas_object(df.loc[changed, ['zip', 'city']], index=False).values)
+    return np.unique(np.concatenate(pairs))
+
+
+def read_carried_forward(logger, conn, bonuscalculation1_id, changed_areas, _col_pid, chunksize=500000):
+    """
+    This function will:
+    - read yesterday's bonus_results of bonuscalculation1_id in chunks
+    - drop the rows of zip/city pairs of changed_areas
+    - yield the chunks like calculate_shard() results (pid as pid_id)
+    """
     
+    sql = """
+            SELECT pid, consumption_from, consumption_until, nc, ib, zip, city
+            FROM bonus_results
+            WHERE 
+                date_calculated = DATE(NOW() - INTERVAL 1 DAY)
+                AND bonuscalculation1_id = %d
+            """ % bonuscalculation1_id
+    changed_pairs = pd.util.hash_pandas_object(changed_areas[['zip', 'city']], index=False).values
+    pids = pd.Index(_col_pid)
+    rows = 0
+    for result in pd.read_sql(sql, conn, chunksize=chunksize):
+        changed = np.isin(pd.util.hash_pandas_object(result[['zip', 'city']], index=False).values, changed_pairs)
+        result = result.drop(index=result.index[changed])
+        result['pid'] = pids.get_indexer(result['pid'])
+        if (result['pid'] < 0).any():
+            raise ValueError('pid of yesterday\'s bonus_results not in tariff')
+        result.rename(columns={'pid': 'pid_id'}, inplace=True)
+        rows += len(result)
+        yield result
+    logger.info("Carried forward %d rows of bonus_results" % rows)
+
+
+def compare_results(expected, result):
+    """
+    Raise ValueError unless both results have the same rows in any order.
+    Rows of a pid/zip/city group with equal consumption_from may get their
+    consumption_until in another order (see Step 28), so it is compared
+    apart from nc and ib.
+    """
+    
+    key = ['pid_id', 'zip', 'city', 'consumption_from']
+    for columns in [key + ['nc', 'ib'], key + ['consumption_until']]:
+        dtypes = dict({'pid_id': np.int64}, **{c: np.float64 for c in columns[3:]})
+        a, b = [df[columns].astype(dtypes).sort_values(columns).reset_index(drop=True) for df in [expected, result]]
+        if not a.equals(b):
+            raise ValueError('Column(s) %s differ' % ', '.join(columns[4:]))
+
+
+def find_market_data(bucket, marketdata_ending, date_strs):
+    """
+    This function will:
+    - look up the market data of marketdata_ending for each date of
+      date_strs in turn, a single Parquet file or a partitioned dataset with
+      manifest (see Function1(layout='dataset'))
+    - return S3 key and ETag of the first one found
+    """
+    
+    for date_str in date_strs:
+        for key in ["%s_%s.parquet" % (date_str, marketdata_ending[:-4]),
+                    "%s_%s/%s" % (date_str, marketdata_ending[:-4], MANIFEST_NAME)]:
+            try:
+                etag = bucket.meta.client.head_object(Bucket=bucket.name, Key=key)['ETag'].strip('"')
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+                    continue
+                raise
+            return key, etag
+    raise ValueError('No parquet file!')
+
+
+def download_market_data(logger, bucket, key, etag, work_dir, reference_data):
+    """
+    This function will:
+    - download the market data at key to work_dir, a Parquet file or the
+      partitions of a dataset matching areas and the consumption bands of
+      config and tariff (waits for these reference queries)
+    - return the local file name (dataset directory)
+    """
+    
+    if key.endswith(MANIFEST_NAME):
+        config, tariff, areas = [reference_data[name].result() for name in ['config', 'tariff', 'areas']]
+        return download_market_dataset(logger, bucket, key, work_dir, market_zip_prefixes(areas['zip']),
+                                       market_consumption_range(config, tariff), etag)
+    
+    file_name = os.path.join(work_dir, key)
+    download_cached(logger, bucket, key, etag, file_name)
+    return file_name
+
+
+def market_zip_prefixes(zips):
+    """
+    zip_prefix of the dataset partitions holding the market rows of zips,
+    MISSING_ZIP_PREFIX for missing zips.
+    """
     
+    return set(zips.str[:2].fillna(MISSING_ZIP_PREFIX))
+
+
+def market_consumption_range(config, tariff):
+    """
+    Consumption range (inclusive bounds) of the market rows a calculation
+    uses, other rows are dropped at Step 7 (tariff) or Step 13 (no config
+    band).
+    """
+    
+    return (tariff['consumption_from'].min(),
+            min(config['consumption_until'].max(), tariff['consumption_until'].max()))
+
+
+def download_market_dataset(logger, bucket, manifest_key, work_dir, zip_prefixes, consumption_range,
+                            manifest_etag=None):
+    """
+    This function will:
+    - download manifest of a market data dataset
+    - download only partitions whose zip_prefix is in zip_prefixes and whose
+      consumption range overlaps consumption_range (inclusive bounds)
+    - return local dataset directory for pyarrow.dataset, see
+      scan_market_data()
+    
+    note: pd.read_parquet() can not read the directory at pyarrow 14, the
+          partition of rows without zip has an all-null dictionary column
+          (ArrowInvalid "Cannot yet unify dictionaries with nulls")
+    
+    With manifest_etag, manifest and partitions go through download_cached().
+    The manifest is uploaded last, so its ETag also identifies the partitions.
+    """
+    
+    dataset_name = manifest_key[:-len(MANIFEST_NAME) - 1]
+    dataset_path = os.path.join(work_dir, dataset_name)
+    os.makedirs(dataset_path, exist_ok=True)
+    
+    def download(key, path):
+        if manifest_etag is None:
+            bucket.download_file(key, path)
+        else:
+            download_cached(logger, bucket, key, manifest_etag, path, if_match=key == manifest_key)
+    
+    download(manifest_key, os.path.join(dataset_path, MANIFEST_NAME))
+    with open(os.path.join(dataset_path, MANIFEST_NAME)) as fp:
+        manifest = json.load(fp)
+    
+    consumption_from, consumption_until = consumption_range
+    partitions = [p for p in manifest['partitions']
+                  if p['zip_prefix'] in zip_prefixes
+                  and p['consumption_max'] >= consumption_from
+                  and p['consumption_min'] <= consumption_until]
+    
+    # keep one partition if none matches, so the schema of the (then empty)
+    # market data is known
+    if len(partitions) == 0:
+        partitions = manifest['partitions'][:1]
+    
+    for partition in partitions:
+        path = os.path.join(dataset_path, partition['path'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        download("%s/%s" % (dataset_name, partition['path']), path)
+    os.remove(os.path.join(dataset_path, MANIFEST_NAME))
+    
+    logger.info("Downloaded %d of %d market data partitions, %d of %d rows" % (
+        len(partitions), len(manifest['partitions']), sum(p['rows'] for p in partitions), manifest['rows']))
+    return dataset_path
+
+
+def download_cached(logger, bucket, key, etag, file_name, if_match=True):
+    """
+    This function will:
+    - look up the S3 object in the host-level market data cache
+      (MARKET_DATA_CACHE_DIR), the entry is named after bucket, key and ETag
+    - download it into the cache on a miss, one job per entry at a time (the
+      others wait for its lock and then reuse the file), only if the object
+      still has this ETag (IfMatch), otherwise botocore raises ClientError
+      with code PreconditionFailed; if_match=False when etag is not the
+      ETag of the object itself (partitions of a dataset)
+    - hard-link the entry to file_name, so eviction never removes a file a
+      job is still reading
+    - evict least recently used entries above MARKET_DATA_CACHE_MAX_BYTES
+    
+    note: bucket.download_file() does not accept IfMatch in ExtraArgs (it
+          only pins the ETag of its own HeadObject request), so the entry is
+          downloaded with a single conditional GetObject.
+    """
+    
+    os.makedirs(MARKET_DATA_CACHE_DIR, exist_ok=True)
+    entry = hashlib.sha256(("%s/%s/%s" % (bucket.name, key, etag)).encode()).hexdigest()
+    entry_path = os.path.join(MARKET_DATA_CACHE_DIR, entry + '.parquet')
+    
+    with lock_cache_entry(os.path.join(MARKET_DATA_CACHE_DIR, entry + '.lock')):
+        if os.path.exists(entry_path):
+            os.utime(entry_path)
+            logger.info("Market data cache hit: %s" % key)
+        else:
+            try:
+                if if_match:
+                    body = bucket.Object(key).get(IfMatch=etag)['Body']
+                    with open(entry_path + '.tmp', 'wb') as fp:
+                        shutil.copyfileobj(body, fp, 8 << 20)
+                else:
+                    bucket.download_file(key, entry_path + '.tmp')
+            except Exception:
+                if os.path.exists(entry_path + '.tmp'):
+                    os.remove(entry_path + '.tmp')
+                raise
+            os.replace(entry_path + '.tmp', entry_path)
+            logger.info("Market data cache miss: %s" % key)
+        
+        try:
+            os.link(entry_path, file_name)
+        except OSError:
+            # work directory on another file system
+            shutil.copyfile(entry_path, file_name)
+    
+    evict_market_data_cache(logger, keep=entry_path)
+
+
+def lock_cache_entry(lock_path):
+    """
+    Open lock_path and take an exclusive flock on it, return the open file.
+    Eviction removes the lock file of an entry, so a lock taken on a file
+    that was removed meanwhile is dropped and taken again on the new file.
+    """
+    
+    while True:
+        lock = open(lock_path, 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def evict_market_data_cache(logger, keep=None):
+    """
+    Remove least recently used (by mtime) cache entries, with their lock
+    file, until the cache holds at most MARKET_DATA_CACHE_MAX_BYTES, but
+    never the entry keep. Lock files without entry (failed downloads) are
+    removed too.
+    """
+    
+    with open(os.path.join(MARKET_DATA_CACHE_DIR, '.evict.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        names = set(os.listdir(MARKET_DATA_CACHE_DIR))
+        for name in names:
+            if name.endswith('.lock') and not name.startswith('.') and name[:-len('.lock')] + '.parquet' not in names:
+                remove_cache_entry(os.path.join(MARKET_DATA_CACHE_DIR, name[:-len('.lock')] + '.parquet'), orphan=True)
+        
+        entries = []
+        for name in names:
+            if name.endswith('.parquet'):
+                path = os.path.join(MARKET_DATA_CACHE_DIR, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        
+        cache_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if cache_bytes <= MARKET_DATA_CACHE_MAX_BYTES:
+                break
+            if path == keep:
+                continue
+            if not remove_cache_entry(path):
+                continue
+            cache_bytes -= size
+            logger.info("Evicted market data cache entry %s (%d bytes)" % (os.path.basename(path), size))
+
+
+def remove_cache_entry(path, orphan=False):
+    """
+    Remove cache entry path and its lock file, unless a job is downloading
+    or linking it right now. With orphan=True only the lock file of a
+    missing entry is removed. Return whether it was removed.
+    """
+    
+    lock_path = path[:-len('.parquet')] + '.lock'
+    with open(lock_path, 'w') as entry_lock:
+        try:
+            fcntl.flock(entry_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        if os.path.exists(path):
+            if orphan:
+                # the entry was downloaded meanwhile
+                return False
+            os.remove(path)
+        # jobs waiting for this lock file take the lock again, see lock_cache_entry()
+        os.remove(lock_path)
+    return True
+
+
+def scan_market_data(file_name, columns, zips, dictionary_columns):
+    """
+    scan_market_table() as pandas DataFrame, dictionary_columns as
+    Categorical.
+    """
     
+    return scan_market_table(file_name, columns, zips, dictionary_columns).to_pandas()
+
+
+def scan_market_table(file_name, columns, zips, dictionary_columns):
+    """
+    This function will:
+    - scan Parquet file (or dataset directory) with pyarrow.dataset
+    - read only columns, dictionary_columns dictionary-encoded
+    - push the zip filter of Step 3 (zips of areas) down to the scan, so
+      row groups without matching rows are skipped
+    - apply the row filters of Step 2 (provider) and Step 3 to the Arrow
+      Table and return it, so dropped rows never become a pandas DataFrame
+    
+    Filtering before Step 1 keeps the same rows, as Function1 already
+    removed all duplicates of the Step 1 key. Missing values are kept like
+    the pandas query and merge of Step 2 and Step 3 do.
+    
+    note: is_null() in a scan filter matches no row of a dictionary-encoded
+          chunk (file, row group or partition) whose values are all null at
+          pyarrow 14, so only filters without missing values are pushed down
+    """
+    
+    parquet_format = ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=dictionary_columns))
+    dataset = ds.dataset(file_name, format=parquet_format, partitioning='hive')
+    
+    zip_values = pa.array(zips.dropna().unique(), type=pa.string())
+    keep_missing_zip = zips.isna().any()
+    
+    table = dataset.to_table(columns=columns, filter=None if keep_missing_zip else ds.field('zip').isin(zip_values))
+    
+    keep = pc.or_kleene(pc.not_equal(table['provider'], EXCLUDED_PROVIDER), pc.is_null(table['provider']))
+    if keep_missing_zip:
+        keep = pc.and_kleene(keep, pc.or_kleene(pc.is_in(table['zip'], value_set=zip_values), pc.is_null(table['zip'])))
+    return table.filter(keep)
+
+
+def connect_mysql(local_infile=False):
+    """
+    New pymysql connection to the SQL_* database, with local_infile for
+    LOAD DATA LOCAL INFILE (see load_result()).
+    """
+    
+    return pymysql.connect(host=os.environ['SQL_HOST'],
+                           user=os.environ['SQL_USER'],
+                           password=os.environ['SQL_PASSWORD'],
+                           db=os.environ['SQL_DBNAME'],
+                           charset='utf8',
+                           cursorclass=pymysql.cursors.DictCursor,
+                           local_infile=local_infile)
+
+
+def reference_queries(bonuscalculation1_id, calculation_type):
+    """
+    SQL of the reference data queries of a calculation (name -> SQL), see
+    read_sql_concurrently(). areas only depends on calculation_type.
+    """
+    
+    reference_sql = {}
+    
+    # get SQL config
     sql = """
-            INSERT INTO `billing` (
-                `inserted`,
-                `department_responsible`,
-                `billing_name`,
-                `amount`
-            ) VALUES (NOW(), '%s', 'bonuscalculation %s', %d)
-            """ % (suffix, bonuscalculation1_id, result.shape[0])
-    with conn.cursor() as cursor:
-        cursor.execute(sql)
-        conn.commit()
+            SELECT
+                DISTINCT BC2M.consumption_from,
+                BC2M.consumption_until,
+                BC1.handle_area_types_diff,
+                BC2M.area_type,
+                BC2M.abssteps,
+                BC2M.max_bonus_sum_percentage,
+                BC2M.max_bonus_sum_abs,
+                BC2M.max_bonus_nc_abs,
+                BC2M.max_bonus_nc_percentage,
+                BC2M.min_bonus_ib_abs,
+                BC2M.max_bonus_ib_abs,
+                BC2M.lowest_rank,
+                BC2M.highest_rank,
+                BC2M.maxamortisation
+            FROM bonus_calculation_2_market BC2M
+            INNER JOIN bonus_calculation_1 BC1
+                ON BC2M.bonuscalculation1_id = BC1.bonuscalculation1_id
+            WHERE
+                BC2M.bonuscalculation1_id = %d
+            """ % bonuscalculation1_id
+    reference_sql['config'] = sql
     
-    del result
+    # get SQL tariff
+    sql = """
+            SELECT
+                TA.pid,
+                TA.area_collection,
+                TA.basicrate,
+                TA.basicrate_margin,
+                TA.kwhrate,
+                TA.kwhrate_margin,
+                TA.consumption_from,
+                TA.consumption_until
+            FROM tariffs_available TA
+            INNER JOIN bonus_calculation_1 BC1
+            ON BC1.product_ext_name = TA.tariff_name
+            WHERE
+                BC1.bonuscalculation1_id = %d
+                AND TA.type = '%s'
+                AND DATE(NOW()) BETWEEN
+                    TA.available_bonus_from
+                    AND TA.available_bonus_until
+            """ % (bonuscalculation1_id, calculation_type)
+    reference_sql['tariff'] = sql
     
-    logger.info("Calculation info has been inserted to `billing` MySQL table")
-    logger.info("F3, done.")
+    # get SQL costmodelinternal
+    sql = """
+            SELECT
+                CMI.costmodelinternal_oneoff,
+                CMI.costmodelinternal_pa
+            FROM cost_model_internal CMI
+            INNER JOIN bonus_calculation_1 BC1
+                ON CMI.costmodelinternal_name = BC1.costmodelinternal_name
+            WHERE
+                BC1.bonuscalculation1_id = %d
+                AND DATE(NOW()) BETWEEN
+                    CMI.costmodelinternal_bonus_validfrom
+                    AND CMI.costmodelinternal_bonus_validuntil
+            """ % bonuscalculation1_id
+    reference_sql['costmodelinternal'] = sql
     
-    # end of Function3
+    # get SQL costmodelprovision
+    sql = """
+            SELECT
+                CMP.consumption_from,
+                CMP.consumption_until,
+                CMP.costmodelprovision_oneoff,
+                CMP.costmodelprovision_pa
+            FROM cost_model_provision CMP
+            INNER JOIN bonus_calculation_1 BC1
+                ON CMP.costmodelprovision_name = BC1.costmodelprovision_name
+            WHERE
+                BC1.bonuscalculation1_id = %d
+                AND DATE(NOW()) BETWEEN
+                    CMP.costmodelprovision_bonus_validfrom
+                    AND CMP.costmodelprovision_bonus_validuntil
+            """ % bonuscalculation1_id
+    reference_sql['costmodelprovision'] = sql
+    
+    # get SQL areas
+    sql = """
+            SELECT zip, city, AA.area_collection, area_type
+            FROM area_assignment AA
+            INNER JOIN area_definition AD
+                ON AA.area_collection = AD.area_collection
+            WHERE
+                AD.type = '%s'
+                AND DATE(NOW()) BETWEEN
+                    available_bonus_from
+                    AND available_bonus_until
+            """ % calculation_type
+    reference_sql['areas'] = sql
+    
+    return reference_sql
+
+
+def read_sql_concurrently(logger, queries, string_columns=None, workers=REFERENCE_QUERY_WORKERS, cache_key=None):
+    """
+    This function will:
+    - run the SQL queries (name, or (id, name) for several calculations,
+      -> SQL) at a pool of at most workers threads, each query on its own
+      connection
+    - with cache_key ((calculation type, date)), read REFERENCE_CACHED_QUERIES
+      from the reference cache and only query them on a miss
+    - cast string_columns (name -> columns) to str, missing values stay
+      missing
+    - log latency and row count per query
+    - return name -> Future of the DataFrame right away, so the caller can
+      do other work (e.g. the Parquet download) meanwhile
+    """
+    
+    string_columns = string_columns or {}
+    
+    def read_sql(key, sql):
+        name = key[-1] if isinstance(key, tuple) else key
+        s = time.time()
+        cache_path = None
+        if cache_key is not None and name in REFERENCE_CACHED_QUERIES:
+            cache_path = reference_cache_path(name, cache_key[0], cache_key[1], sql)
+            df = read_reference_cache(cache_path)
+            if df is not None:
+                logger.info("Time for query %s (%d rows, cached): %d ms" % (key, len(df), (time.time() - s) * 1000))
+                return df
+        
+        query_conn = connect_mysql()
+        try:
+            df = pd.read_sql(sql, query_conn)
+        finally:
+            query_conn.close()
+        for column in string_columns.get(name, []):
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+        if cache_path is not None:
+            write_reference_cache(df, cache_path)
+        logger.info("Time for query %s (%d rows): %d ms" % (key, len(df), (time.time() - s) * 1000))
+        return df
+    
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(queries)))
+    futures = {key: executor.submit(read_sql, key, sql) for key, sql in queries.items()}
+    executor.shutdown(wait=False)
+    return futures
+
+
+def reference_cache_path(name, calculation_type, date_str, sql):
+    """
+    Snapshot path of a reference query result:
+    <REFERENCE_CACHE_DIR>/<date>/<calculation type>/<name>_<SQL digest>.parquet.
+    The digest covers the ids in the SQL (e.g. bonuscalculation1_id).
+    """
+    
+    digest = hashlib.sha256(sql.encode()).hexdigest()[:16]
+    return os.path.join(REFERENCE_CACHE_DIR, date_str, calculation_type, "%s_%s.parquet" % (name, digest))
+
+
+def read_reference_cache(cache_path, ttl=REFERENCE_CACHE_TTL):
+    """
+    DataFrame of a reference snapshot younger than ttl seconds, otherwise None.
+    """
+    
+    try:
+        if time.time() - os.path.getmtime(cache_path) > ttl:
+            return None
+        return pq.read_table(cache_path).to_pandas()
+    except FileNotFoundError:
+        return None
+
+
+def write_reference_cache(df, cache_path):
+    """
+    Save reference snapshot, atomically replacing an older one.
+    """
+    
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+    os.replace(tmp_path, cache_path)
+
+
+def invalidate_reference_cache(name=None, calculation_type=None, date_str=None):
+    """
+    Invalidation hook for jobs that change reference tables: remove the
+    snapshots of query name (e.g. 'areas'), calculation_type and date_str,
+    None matches all. Returns the number of removed snapshots.
+    """
+    
+    pattern = os.path.join(REFERENCE_CACHE_DIR, date_str or '*', calculation_type or '*',
+                           "%s_*.parquet" % (name or '*'))
+    removed = 0
+    for cache_path in glob.glob(pattern):
+        try:
+            os.remove(cache_path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def interval_merge(left, right, on, value, lower, upper):
+    """
+    Same result (rows, order, index labels) as
+        pd.merge(left, right, how='inner', on=on).query('lower <= value <= upper')
+    without building the pairs outside of the interval:
+    - group left rows by key and sort them by value
+    - for each right row, find the left rows of its key with
+      lower <= value <= upper by binary search
+    - order the matching pairs like pd.merge() does (key in order of first
+      appearance at left, missing key last, then left row, then right row)
+      and label them with their position in the full merge
+    """
+    
+    def merge_and_query():
+        return pd.merge(left, right, how='inner', on=on).query('%s <= %s <= %s' % (lower, value, upper))
+    
+    if len(left) == 0 or len(right) == 0:
+        return merge_and_query()
+    
+    # key codes in order of first appearance at left, right rows are mapped
+    # to them and the key order is taken from pd.merge() of the unique keys,
+    # so missing keys are matched and ordered exactly like pd.merge() does
+    left_codes = left.groupby(on, sort=False, dropna=False).ngroup().values
+    n_codes = left_codes.max() + 1
+    left_keys = pd.DataFrame({on: left[on].values[~left[on].duplicated().values], '_code': np.arange(n_codes)})
+    right_keys = pd.merge(pd.DataFrame({on: right[on].values, '_row': np.arange(len(right))}), left_keys, on=on)
+    right_codes = np.full(len(right), -1, dtype=np.int64)
+    right_codes[right_keys['_row'].values] = right_keys['_code'].values
+    key_order = pd.merge(left_keys, right[[on]].drop_duplicates(), on=on)['_code'].values
+    
+    # left rows grouped by key, sorted by value within group (missing value last)
+    left_values = left[value].values
+    left_order = np.lexsort((left_values, left_codes))
+    left_counts = np.bincount(left_codes, minlength=n_codes)
+    left_starts = np.concatenate([[0], np.cumsum(left_counts)])
+    
+    # position of each pair at pd.merge(): rows of a key follow the key order,
+    # left rows in left order, for each of them right rows in right order
+    left_rank = np.empty(len(left), dtype=np.int64)
+    left_by_key = np.argsort(left_codes, kind='stable')
+    left_rank[left_by_key] = np.arange(len(left)) - left_starts[left_codes[left_by_key]]
+    right_known = right_codes >= 0
+    right_counts = np.bincount(right_codes[right_known], minlength=n_codes)
+    right_rank = np.zeros(len(right), dtype=np.int64)
+    for code in key_order:
+        rows = np.flatnonzero(right_codes == code)
+        right_rank[rows] = np.arange(len(rows))
+    merge_offsets = np.zeros(n_codes, dtype=np.int64)
+    merge_offsets[key_order] = np.concatenate([[0], np.cumsum((left_counts * right_counts)[key_order])[:-1]])
+    if len(key_order) == 0:
+        # no common key, the merge is empty anyway
+        return merge_and_query()
+    
+    # right rows with a missing bound match no left row (comparisons with
+    # NaN are False at query()), they only count for the merge positions
+    left_rows = []
+    right_rows = []
+    right_lower = right[lower].values
+    right_upper = right[upper].values
+    right_bounded = right_known & pd.notna(right_lower) & pd.notna(right_upper)
+    for j in np.flatnonzero(right_bounded):
+        code = right_codes[j]
+        group = left_order[left_starts[code]:left_starts[code + 1]]
+        group_values = left_values[group]
+        first = np.searchsorted(group_values, right_lower[j], side='left')
+        last = np.searchsorted(group_values, right_upper[j], side='right')
+        if first < last:
+            left_rows.append(group[first:last])
+            right_rows.append(np.full(last - first, j))
+    
+    left_rows = np.concatenate(left_rows) if left_rows else np.empty(0, dtype=np.int64)
+    right_rows = np.concatenate(right_rows) if right_rows else np.empty(0, dtype=np.int64)
+    codes = left_codes[left_rows]
+    labels = merge_offsets[codes] + left_rank[left_rows] * right_counts[codes] + right_rank[right_rows]
+    order = np.argsort(labels, kind='stable')
+    left_rows, right_rows, labels = left_rows[order], right_rows[order], labels[order]
+    
+    right = right.drop(columns=[on])
+    overlap = set(left.columns) & set(right.columns)
+    left_part = left.rename(columns={c: c + '_x' for c in overlap}).take(left_rows)
+    right_part = right.rename(columns={c: c + '_y' for c in overlap}).take(right_rows)
+    left_part.index = pd.Index(labels)
+    right_part.index = left_part.index
+    return pd.concat([left_part, right_part], axis=1)
+
+
+# expressions of Steps 10 and 15, evaluated by numpy or numexpr
+EONPRICE_EXPRESSION = 'basicrate + consumption * kwhrate'
+MAX_BONUS_PM_EXPRESSION = ('(maxamortisation * (basicrate_margin + consumption * kwhrate_margin'
+                           ' - costmodelinternal_pa - costmodelprovision_pa))'
+                           ' - costmodelinternal_oneoff - costmodelprovision_oneoff')
+
+
+def bonus_kernel(result, engine='numpy'):
+    """
+    Steps 10-23 of Function3 fused on NumPy arrays:
+    - compute Steps 10-13 for all rows, then select the rows kept by Step 13
+      and Step 14 with one combined mask
+    - compute Steps 15-22 for these rows only, then apply the Step 23 mask
+    - build the Step 23 DataFrame (same columns, index labels and values as
+      the step chain) with a single take
+    
+    DataFrame[[a, b]].min(axis=1)/max(axis=1) skip missing values, like
+    np.fmin()/np.fmax(). With engine='numexpr' the long arithmetic
+    expressions are evaluated by numexpr. Operations and their order are the
+    same as in the step chain, so the results are bit-for-bit identical, see
+    tests/test_function3.py.
+    """
+    
+    if engine == 'numexpr' and numexpr is None:
+        raise ValueError('numexpr is not installed')
+    
+    def evaluate(expression, rows=None):
+        arrays = {c: result[c].values if rows is None else result[c].values[rows]
+                  for c in result.columns if c in expression}
+        if engine == 'numexpr':
+            return numexpr.evaluate(expression, local_dict=arrays)
+        return eval(expression, {}, arrays)
+    
+    def column(name, rows=None):
+        values = result[name].values
+        return values if rows is None else values[rows]
+    
+    abssteps = column('abssteps')
+    
+    # Step 10 - eonprice (the result of round(2) was never assigned)
+    eonprice = evaluate(EONPRICE_EXPRESSION)
+    
+    # Step 11 - smaller of max_bonus_sum_abs and eonprice * max_bonus_sum_percentage, rounded down
+    max_bonus_sum_abs = round_down(np.fmin(eonprice * column('max_bonus_sum_percentage'), column('max_bonus_sum_abs')),
+                                   abssteps)
+    
+    # Step 12 - smaller of max_bonus_nc_abs and eonprice * max_bonus_nc_percentage rounded down
+    max_bonus_nc_abs = np.fmin(round_down(eonprice * column('max_bonus_nc_percentage'), abssteps),
+                               column('max_bonus_nc_abs'))
+    
+    # Step 13 - max_bonus_sum_abs at most max_bonus_nc_abs + max_bonus_ib_abs
+    max_bonus_sum_abs = np.fmin(max_bonus_nc_abs + column('max_bonus_ib_abs'), max_bonus_sum_abs)
+    
+    # Step 13 and Step 14 filters
+    rows = np.flatnonzero(((eonprice - max_bonus_sum_abs) <= column('priceSumNet'))
+                          & (column('rank') >= column('highest_rank')))
+    eonprice = eonprice[rows]
+    max_bonus_sum_abs = max_bonus_sum_abs[rows]
+    max_bonus_nc_abs = max_bonus_nc_abs[rows]
+    abssteps = abssteps[rows]
+    
+    # Step 15 - max_bonus_pm_abs, at least 0, rounded down
+    max_bonus_pm_abs = round_down(np.fmax(evaluate(MAX_BONUS_PM_EXPRESSION, rows), 0), abssteps)
+    
+    # Step 17 - bonus_needed, at least 0, rounded up
+    bonus_needed = round_up(np.fmax(eonprice - column('priceSumNet', rows), 0), abssteps)
+    
+    # Steps 19-22 - instant bonus (ib) and new customer bonus (nc)
+    ib = round_up(column('min_bonus_ib_abs', rows), abssteps)
+    nc = round_up(bonus_needed - ib, abssteps)
+    nc = np.fmin(np.fmax(nc, 0), max_bonus_nc_abs)
+    ib = round_up(bonus_needed - nc, abssteps)
+    
+    # Step 23 filter
+    keep = (nc + ib) >= bonus_needed
+    
+    # Step 16 columns, then bonus_needed, ib and nc
+    select_columns = [
+        'pid_id',
+        'zip_id',
+        'city_id',
+        'rank',
+        'consumption',
+        'consumption_until_from_tariff',
+        'eonprice',
+        'priceSumNet',
+        'max_bonus_sum_abs',
+        'max_bonus_ib_abs',
+        'min_bonus_ib_abs',
+        'lowest_rank',
+        'max_bonus_pm_abs',
+        'abssteps',
+        'max_bonus_nc_abs'
+    ]
+    computed = {
+        'eonprice': eonprice,
+        'max_bonus_sum_abs': max_bonus_sum_abs,
+        'max_bonus_pm_abs': max_bonus_pm_abs,
+        'max_bonus_nc_abs': max_bonus_nc_abs,
+    }
+    rows = rows[keep]
+    output = pd.DataFrame({c: computed[c][keep] if c in computed else column(c, rows) for c in select_columns},
+                          index=result.index[rows])
+    output.rename(columns={'consumption': 'consumption_from', 'consumption_until_from_tariff': 'consumption_until'},
+                  inplace=True)
+    output['bonus_needed'] = bonus_needed[keep]
+    output['ib'] = ib[keep]
+    output['nc'] = nc[keep]
+    return output
+
+
+def keep_group_min_rows(df, by, column, rows=None):
+    """
+    Positions of the rows of df (or of rows, positions into df) whose column
+    is the minimum of their by group. Same rows in the same order as
+        df.merge(df.groupby(by, as_index=False)[column].min(), on=by + [column])
+    without the merge:
+    - group codes by hashing (groupby().ngroup()), rows with a missing group
+      key are dropped like groupby() does
+    - one lexsort by group and value gives the minimum of each group, a
+      missing value only if the whole group is missing (then it matches)
+    - kept rows are ordered by the first kept row of their group, then by
+      position, like pd.merge() orders by first appearance of the key
+    """
+    
+    if rows is None:
+        rows = np.arange(len(df))
+    if len(rows) == 0:
+        return rows
+    
+    codes = df[by].take(rows).groupby(by, sort=False).ngroup().values
+    valid = ~pd.isna(codes)
+    if not valid.any():
+        return rows[:0]
+    codes = np.where(valid, codes, -1).astype(np.int64)
+    values = df[column].values[rows]
+    
+    # minimum per group: first value of each group after sorting (missing last)
+    order = np.lexsort((values, codes))
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_codes[1:] != sorted_codes[:-1]]))
+    group_min = np.empty(sorted_codes[-1] + 1, dtype=values.dtype)
+    group_min[sorted_codes[starts][sorted_codes[starts] >= 0]] = values[order[starts[sorted_codes[starts] >= 0]]]
+    
+    row_min = group_min[codes]
+    keep = valid & ((values == row_min) | (pd.isna(values) & pd.isna(row_min)))
+    kept = np.flatnonzero(keep)
+    
+    # groups in order of their first kept row
+    group_first = np.zeros(len(group_min), dtype=np.int64)
+    kept_groups, first_kept = np.unique(codes[kept], return_index=True)
+    group_first[kept_groups] = first_kept
+    kept = kept[np.argsort(group_first[codes[kept]], kind='stable')]
+    return rows[kept]
+
+
+def set_next_band_ends(result, group_columns):
+    """
+    Step 28 on arrays, same rows and order as
+        result.groupby(group_columns).apply(pd.DataFrame.sort_values, 'consumption_from')
+    followed by the shift(-1) of consumption_from per group:
+    - sort rows once by group and consumption_from (ascending, stable, so
+      rows with equal consumption_from keep their order)
+    - take the next consumption_from of the same group minus 1 as
+      consumption_until by shifting the arrays, the last row of each group
+      keeps its consumption_until
+    - return the sorted DataFrame (str index, consumption_until last)
+    """
+    
+    order = np.lexsort([result['consumption_from'].values] + [result[c].values for c in reversed(group_columns)])
+    result = result.take(order)
+    
+    same_group_as_next = np.ones(max(len(result) - 1, 0), dtype=bool)
+    for c in group_columns:
+        values = result[c].values
+        same_group_as_next &= values[1:] == values[:-1]
+    last_in_group = np.ones(len(result), dtype=bool)
+    last_in_group[:-1] = ~same_group_as_next
+    
+    consumption_until_new = np.empty(len(result), dtype=np.float64)
+    consumption_until_new[:-1] = result['consumption_from'].values[1:]
+    consumption_until_new -= 1
+    consumption_until_new[last_in_group] = result['consumption_until'].values[last_in_group]
+    result['consumption_until_new'] = consumption_until_new
+    result.drop(['consumption_until'], inplace=True, axis=1)
+    result.rename(index=str, inplace=True, columns={'consumption_until_new': 'consumption_until'})
+    return result
+
+
+def factorize_column(values):
+    """
+    Integer ids of values in order of first appearance (like
+    values.unique()), missing values get an id as well. Returns the int32
+    ids and a NumPy array with the value of id i at position i, decode with
+    take().
+    """
+    
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=object if uniques.dtype.kind not in 'iufb' else uniques.dtype)
+    missing = codes == -1
+    if missing.any():
+        # ids before the first missing value are 0..k-1
+        first_missing = np.flatnonzero(missing)[0]
+        k = codes[:first_missing].max() + 1 if first_missing > 0 else 0
+        codes = np.where(codes >= k, codes + 1, codes)
+        codes[missing] = k
+        uniques = np.insert(uniques.astype(object), k, np.nan)
+    return codes.astype(np.int32), uniques
+
+
+def column_memory_usage(df, columns, as_object=False):
+    """
+    Memory usage of columns of df in bytes (including strings). With
+    as_object, Categorical columns count as the object columns they replace
+    (a pointer per row to its string), without building these.
+    """
+    
+    usage = 0
+    for column in columns:
+        values = df[column]
+        if as_object and isinstance(values.dtype, pd.CategoricalDtype):
+            # missing values (code -1) take the size of the last entry, NaN
+            sizes = np.array([sys.getsizeof(value) for value in values.cat.categories] + [sys.getsizeof(np.nan)],
+                             dtype=np.int64)
+            usage += 8 * len(values) + sizes[values.cat.codes.values].sum()
+        else:
+            usage += values.memory_usage(deep=True, index=False)
+    return int(usage)
+
+
+def log_conversion(logger, step, columns, before, after):
+    """
+    Log memory usage of columns (bytes, see column_memory_usage()) before
+    and after their conversion to Categorical or a smaller dtype at step.
+    """
+    
+    logger.info("Memory of %s at %s: %.1f MB -> %.1f MB (%+.1f MB)" % (
+        ', '.join(columns), step, before / 1e6, after / 1e6, (after - before) / 1e6))
+
+
+def log_memory_usage(logger, memory_report, step, df):
+    """
+    Log memory usage of df (including strings) and the peak RSS of the job,
+    and add it to memory_report (step -> bytes).
+    """
+    
+    usage = df.memory_usage(deep=True).sum()
+    memory_report[step] = usage
+    logger.info("Memory after %s: %.1f MB for %d rows, peak RSS %d MB" % (
+        step, usage / 1e6, len(df), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >> 10))
+
+
+def new_profile_report(job_id, function, capture=None):
+    """
+    This function will:
+    - return an empty profile report of job_id for start_step() and
+      end_step(), written by write_profile_report()
+    - with capture 'cprofile' or 'pyinstrument' also keep the profile of each
+      step (top functions by cumulative time)
+    """
+    
+    if capture not in (None, 'cprofile', 'pyinstrument'):
+        raise ValueError("Unknown profile capture: %s" % capture)
+    if capture == 'pyinstrument' and pyinstrument is None:
+        raise ValueError("Profile capture pyinstrument needs the pyinstrument package")
+    return {'job_id': job_id, 'function': function, 'capture': capture, 'steps': [], '_open': []}
+
+
+def start_step(profile_report, step, df=None):
+    """
+    Start measuring step of profile_report (nothing if profile_report is
+    None), df is the input of the step (DataFrame or array) for its row count.
+    """
+    
+    if profile_report is None:
+        return
+    
+    profiler = None
+    if profile_report['capture'] == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile_report['capture'] == 'pyinstrument':
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    profile_report['_open'].append({'step': step,
+                                    'rows_in': None if df is None else len(df),
+                                    'wall': time.perf_counter(),
+                                    'cpu': time.process_time(),
+                                    'rss': current_rss(),
+                                    'profiler': profiler})
+
+
+def end_step(profile_report, df=None):
+    """
+    This function will:
+    - end the last started step of profile_report (nothing if profile_report
+      is None), df is the output of the step (DataFrame or array)
+    - add wall and CPU time (ms), RSS, RSS delta and peak RSS of the process
+      (MB), rows in and out and the memory of df (MB) to its steps
+    """
+    
+    if profile_report is None:
+        return
+    
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    step = profile_report['_open'].pop()
+    
+    capture = None
+    profiler = step['profiler']
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_CAPTURE_LINES)
+        capture = stream.getvalue()
+    elif profiler is not None:
+        profiler.stop()
+        capture = profiler.output_text()
+    
+    rss = current_rss()
+    if isinstance(df, pd.DataFrame):
+        frame_mb = df.memory_usage(deep=True).sum() / 1e6
+    elif isinstance(df, np.ndarray):
+        frame_mb = df.nbytes / 1e6
+    else:
+        frame_mb = None
+    profile_report['steps'].append({
+        'step': step['step'],
+        'pid': os.getpid(),
+        'wall_ms': round((wall - step['wall']) * 1000, 3),
+        'cpu_ms': round((cpu - step['cpu']) * 1000, 3),
+        'rss_mb': None if rss is None else round(rss / (1 << 20), 1),
+        'rss_delta_mb': None if rss is None or step['rss'] is None else round((rss - step['rss']) / (1 << 20), 1),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >> 10,
+        'rows_in': step['rows_in'],
+        'rows_out': None if df is None else len(df),
+        'frame_mb': None if frame_mb is None else round(frame_mb, 1),
+        'capture': capture})
+
+
+def add_profile_steps(profile_report, other_profile_report, **labels):
+    """
+    Add the steps of other_profile_report (e.g. of a worker process) to
+    profile_report with labels (nothing if either is None).
+    """
+    
+    if profile_report is None or other_profile_report is None:
+        return
+    profile_report['steps'].extend(dict(step, **labels) for step in other_profile_report['steps'])
+
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes (None if
+    /proc/self/statm is not available).
+    """
+    
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def write_profile_report(logger, profile_report, profile_dir=PROFILE_DIR):
+    """
+    Write profile_report (nothing if None) as JSON to
+    <profile_dir>/<job_id>.json.
+    """
+    
+    if profile_report is None:
+        return
+    
+    os.makedirs(profile_dir, exist_ok=True)
+    file_name = os.path.join(profile_dir, '%s.json' % profile_report['job_id'])
+    with open(file_name, 'w') as f:
+        json.dump({key: value for key, value in profile_report.items() if key != '_open'}, f, indent=1)
+    logger.info("Profile report of %d steps written to %s" % (len(profile_report['steps']), file_name))
+
+
+def new_trace(job_id, rate, trace_dir=TRACE_DIR):
+    """
+    This function will:
+    - return the trace of job_id for trace_step(), which keeps the rows of
+      about a fraction rate (0-1] of the zip/city groups at each step
+    - the sample is taken by a hash of zip and city, so the same groups are
+      kept (with all their pids) at every step, in every shard and every job
+    """
+    
+    if not 0 < rate <= 1:
+        raise ValueError("Trace rate must be in (0, 1]: %s" % rate)
+    return {'dir': os.path.join(trace_dir, str(job_id)), 'rate': rate}
+
+
+def trace_step(trace, step, df, zips=None, cities=None, rows=None):
+    """
+    This function will:
+    - keep the rows of df (only rows, if given row positions) of the sampled
+      zip/city groups of trace (nothing if trace is None)
+    - take zip and city from the zip and city columns of df, or, if zips and
+      cities are given (after Step 6), from their values at zip_id and city_id
+    - write them with zip and city as zstd compressed Parquet file to
+      <trace dir>/<step>/, one file per call (shards write their own files)
+    """
+    
+    if trace is None:
+        return
+    
+    if rows is not None:
+        df = df.take(rows)
+    if zips is None:
+        zip_hash = pd.util.hash_pandas_object(df['zip'], index=False).values
+        city_hash = pd.util.hash_pandas_object(df['city'], index=False).values
+    else:
+        zip_hash = pd.util.hash_pandas_object(pd.Series(zips, dtype=object), index=False).values.take(
+            df['zip_id'].values)
+        city_hash = pd.util.hash_pandas_object(pd.Series(cities, dtype=object), index=False).values.take(
+            df['city_id'].values)
+    
+    # uint64 arithmetic wraps, the top 24 bits of the group hash are uniform
+    group_hash = zip_hash ^ (city_hash * np.uint64(0x9E3779B97F4A7C15))
+    sample = df[(group_hash >> np.uint64(40)) < trace['rate'] * (1 << 24)]
+    if zips is not None:
+        sample = sample.assign(zip=zips.take(sample['zip_id'].values), city=cities.take(sample['city_id'].values))
+    
+    step_dir = os.path.join(trace['dir'], step)
+    os.makedirs(step_dir, exist_ok=True)
+    sample.to_parquet(os.path.join(step_dir, '%s.parquet' % uuid.uuid4().hex), index=False, compression='zstd')
@@ -0,0 +1,41 @@
+import os
+import sys
+import zipfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+CSV_COLUMNS = ['Verbrauchsstufe in kWh', 'Postleitzahl', 'Ort', 'Anzahl Haushalte', 'Platz', 'Anbietername',
+               'Tarifname', 'Gesamtkosten (netto) in EUR pro Jahr', 'Grundpreis (netto) in EUR pro Jahr',
+               'Verbrauchspreis (netto) in EUR pro Jahr', 'Neukundenbonus in EUR (netto)',
+               'Sofortbonus in EUR (netto)', 'Arbeitspreis HT in ct/kWh (netto)', 'Exportdatum']
+
+
+def write_market_zip(path, seed, files=3, rows=400, missing=0.1):
+    """
+    Write a ZIP of market data CSV files like the SFTP export, a fraction
+    missing (or missing[f] of file f) of zips and cities is empty.
+    """
+    
+    rng = np.random.default_rng(seed)
+    if np.isscalar(missing):
+        missing = [missing] * files
+    
+    def price(low, high):
+        return ('%.2f' % rng.uniform(low, high)).replace('.', ',')
+    
+    with zipfile.ZipFile(path, 'w') as z:
+        for f in range(files):
+            lines = [';'.join(CSV_COLUMNS)]
+            for _ in range(rows):
+                lines.append(';'.join([
+                    str(rng.choice([1000, 2000, 3000])),
+                    '' if rng.random() < missing[f] else '%05d' % rng.integers(1000, 1010),
+                    '' if rng.random() < missing[f] else str(rng.choice(['München', 'Köln', 'Berlin'])),
+                    str(rng.integers(1, 900)), str(rng.integers(1, 5)),
+                    str(rng.choice(['Stadtwerke München', 'Vattenfall'])), 'Tarif %d' % rng.integers(1, 3),
+                    price(300, 2000), price(50, 200), price(200, 1800), price(0, 100), price(0, 100),
+                    price(20, 40), '01.10.2026']))
+            z.writestr('Strom_Privat_%d.csv' % f, ('\r\n'.join(lines) + '\r\n').encode('cp1252'))
@@ -0,0 +1,333 @@
+import io
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+import moto
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pytest
+
+import function1
+from conftest import write_market_zip
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_arrow_engine_equals_pandas_engine(tmp_path, seed):
+    zip_path = str(tmp_path / 'Strom_Privat.zip')
+    write_market_zip(zip_path, seed)
+    csv_files = function1.list_zip_csv_files(zip_path)
+    
+    function1.convert_csv_to_parquet('job', logger, 'Strom_Privat.zip', '20261018',
+                                     str(tmp_path / 'pandas.parquet'), csv_files)
+    function1.convert_csv_to_parquet_arrow('job', logger, 'Strom_Privat.zip', '20261018',
+                                           str(tmp_path / 'arrow.parquet'), csv_files)
+    
+    expected = pd.read_parquet(tmp_path / 'pandas.parquet').reset_index(drop=True)
+    result = pd.read_parquet(tmp_path / 'arrow.parquet')
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+@pytest.mark.parametrize('missing', [0.1, [1.0, 0.1, 0.1]])
+def test_streamed_parquet_equals_concatenated(tmp_path, workers, missing):
+    zip_path = str(tmp_path / 'Strom_Privat.zip')
+    write_market_zip(zip_path, 0, missing=missing)
+    csv_files = function1.list_zip_csv_files(zip_path)
+    
+    data_frames = [function1.read_a_csv_file('job', logger, csv_file, zip_path) for csv_file, zip_path in csv_files]
+    function1.save_data_frames_as_parquet(logger, data_frames, 'Strom_Privat.zip', str(tmp_path / 'concat.parquet'))
+    function1.convert_csv_to_parquet('job', logger, 'Strom_Privat.zip', '20261018', str(tmp_path / 'stream.parquet'),
+                                     csv_files, workers=workers)
+    
+    expected = pd.read_parquet(tmp_path / 'concat.parquet')
+    result = pd.read_parquet(tmp_path / 'stream.parquet')
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_drop_seen_duplicates_equals_drop_duplicates():
+    rng = np.random.default_rng(0)
+    data_frames = [pd.DataFrame({'consumption': rng.integers(0, 5, 300), 'zip': rng.choice(['01067', None], 300),
+                                 'city': rng.choice(['Dresden', 'Köln', None], 300), 'rank': rng.integers(0, 9, 300),
+                                 'n': np.arange(300) + 300 * i})
+                   for i in range(20)]
+    
+    result = []
+    seen_hashes = np.empty(0, dtype=np.uint64)
+    for data_frame in data_frames:
+        data_frame, seen_hashes = function1.drop_seen_duplicates(data_frame, seen_hashes)
+        result.append(data_frame)
+    
+    expected = pd.concat(data_frames).drop_duplicates(subset=function1.DUPLICATE_SUBSET)
+    pd.testing.assert_frame_equal(pd.concat(result), expected)
+    assert len(seen_hashes) == len(expected) and (np.diff(seen_hashes) > 0).all()
+
+
+class LocalSFTPFile(io.FileIO):
+    """
+    paramiko SFTPFile stand-in over a local file.
+    """
+    
+    def readv(self, chunks):
+        for offset, length in chunks:
+            self.seek(offset)
+            yield self.read(length)
+
+
+class LocalSFTPClient:
+    """
+    paramiko SFTPClient stand-in over the local file system.
+    """
+    
+    def stat(self, path):
+        return os.stat(path)
+    
+    def open(self, path, mode='r'):
+        return LocalSFTPFile(path, mode.replace('b', ''))
+    
+    def get(self, path, local_path):
+        shutil.copyfile(path, local_path)
+    
+    def close(self):
+        pass
+
+
+class LocalSSHClient:
+    """
+    paramiko SSHClient stand-in, its SFTP client is a LocalSFTPClient.
+    """
+    
+    def set_missing_host_key_policy(self, policy):
+        pass
+    
+    def connect(self, **kwargs):
+        pass
+    
+    def open_sftp(self):
+        return LocalSFTPClient()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-central-1')
+    with moto.mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='origin', CreateBucketConfiguration={'LocationConstraint': 'eu-central-1'})
+        yield s3
+
+
+# modification time of a remote file before the multipart uploads of the
+# tests were started, moto reports 2010-11-10 as Initiated of all uploads
+BEFORE_UPLOAD = datetime(2009, 1, 1).timestamp()
+
+
+def write_remote_file(path, seed, mtime):
+    data = np.random.default_rng(seed).bytes(2 * function1.S3_MIN_PART_SIZE + 12345)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.utime(path, (mtime, mtime))
+    return data
+
+
+def upload_first_part(s3, data):
+    """
+    Unfinished multipart upload with the first part of data, like a failed
+    transfer leaves it.
+    """
+    
+    upload_id = s3.create_multipart_upload(Bucket='origin', Key='market.zip')['UploadId']
+    s3.upload_part(Bucket='origin', Key='market.zip', UploadId=upload_id, PartNumber=1,
+                   Body=data[:function1.S3_MIN_PART_SIZE])
+    return upload_id
+
+
+def transfer(s3, tmp_path, local_path):
+    function1.transfer_sftp_to_s3(logger, LocalSFTPClient(), str(tmp_path / 'remote.zip'), s3, 'origin', 'market.zip',
+                                  local_path, chunk_size=function1.S3_MIN_PART_SIZE)
+
+
+def transferred(s3):
+    return s3.get_object(Bucket='origin', Key='market.zip')['Body'].read()
+
+
+@pytest.mark.parametrize('with_local_path', [False, True])
+def test_transfer_sftp_to_s3(tmp_path, s3, with_local_path):
+    data = write_remote_file(tmp_path / 'remote.zip', 0, BEFORE_UPLOAD)
+    local_path = str(tmp_path / 'local.zip') if with_local_path else None
+    
+    transfer(s3, tmp_path, local_path)
+    
+    assert transferred(s3) == data
+    if with_local_path:
+        assert (tmp_path / 'local.zip').read_bytes() == data
+
+
+@pytest.mark.parametrize('with_local_path', [False, True])
+def test_transfer_sftp_to_s3_resumes_upload(tmp_path, s3, caplog, with_local_path):
+    data = write_remote_file(tmp_path / 'remote.zip', 0, BEFORE_UPLOAD)
+    upload_first_part(s3, data)
+    local_path = str(tmp_path / 'local.zip') if with_local_path else None
+    
+    with caplog.at_level(logging.INFO):
+        transfer(s3, tmp_path, local_path)
+    
+    assert transferred(s3) == data
+    assert '3 parts (1 resumed)' in caplog.text
+    assert s3.list_multipart_uploads(Bucket='origin').get('Uploads', []) == []
+
+
+@pytest.mark.parametrize('with_local_path', [False, True])
+def test_transfer_sftp_to_s3_does_not_resume_modified_file(tmp_path, s3, with_local_path):
+    # the remote file is replaced (same size) after the failed transfer
+    upload_first_part(s3, write_remote_file(tmp_path / 'remote.zip', 0, BEFORE_UPLOAD))
+    data = write_remote_file(tmp_path / 'remote.zip', 1, time.time())
+    local_path = str(tmp_path / 'local.zip') if with_local_path else None
+    
+    transfer(s3, tmp_path, local_path)
+    
+    assert transferred(s3) == data
+
+
+def test_transfer_sftp_to_s3_checks_md5_of_resumed_parts(tmp_path, s3):
+    # the remote file is replaced (same size) but keeps an older mtime, the
+    # re-read chunk does not match the uploaded part
+    upload_first_part(s3, write_remote_file(tmp_path / 'remote.zip', 0, BEFORE_UPLOAD))
+    data = write_remote_file(tmp_path / 'remote.zip', 1, BEFORE_UPLOAD)
+    
+    transfer(s3, tmp_path, str(tmp_path / 'local.zip'))
+    
+    assert transferred(s3) == data
+    assert (tmp_path / 'local.zip').read_bytes() == data
+
+
+@pytest.fixture
+def function1_env(s3, tmp_path, monkeypatch):
+    for name in ['SFTP_HOST', 'SFTP_USER', 'SFTP_PASSWORD']:
+        monkeypatch.setenv(name, 'local')
+    monkeypatch.setenv('S3_BUCKET_ORIGIN', 'origin')
+    monkeypatch.setenv('S3_BUCKET_PARQUET', 'parquet')
+    monkeypatch.setattr(function1.paramiko, 'SSHClient', LocalSSHClient)
+    monkeypatch.setattr(function1, 'INGEST_MANIFEST_PATH', str(tmp_path / 'ingest.json'))
+    s3.create_bucket(Bucket='parquet', CreateBucketConfiguration={'LocationConstraint': 'eu-central-1'})
+    return s3
+
+
+def test_skip_unchanged_converts_again_without_previous_market_data(function1_env, tmp_path):
+    s3 = function1_env
+    remote_path = str(tmp_path / 'Strom_Privat.zip')
+    write_market_zip(remote_path, 0)
+    
+    function1.Function1(uuid.uuid4().hex, logger, remote_path, 'Strom_Privat.zip', skip_unchanged=True)
+    key = json.loads((tmp_path / 'ingest.json').read_text())[remote_path]['parquet_key']
+    
+    # the manifest points at a previous key that was removed meanwhile
+    manifest = json.loads((tmp_path / 'ingest.json').read_text())
+    manifest[remote_path]['parquet_key'] = '20000101_Strom_Privat.parquet'
+    (tmp_path / 'ingest.json').write_text(json.dumps(manifest))
+    s3.delete_object(Bucket='parquet', Key=key)
+    
+    function1.Function1(uuid.uuid4().hex, logger, remote_path, 'Strom_Privat.zip', skip_unchanged=True)
+    
+    assert s3.head_object(Bucket='parquet', Key=key)['Metadata']['remote-path'] == remote_path
+    assert json.loads((tmp_path / 'ingest.json').read_text())[remote_path]['parquet_key'] == key
+
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+@pytest.mark.parametrize('max_memory_mb', [None, 1])
+def test_pipelined_parquet_equals_convert_csv_to_parquet(function1_env, tmp_path, streaming, max_memory_mb):
+    s3 = function1_env
+    remote_path = str(tmp_path / 'Strom_Privat.zip')
+    write_market_zip(remote_path, 0, files=4, rows=4000)
+    function1.convert_csv_to_parquet('job', logger, 'Strom_Privat.zip', '20261018', str(tmp_path / 'serial.parquet'),
+                                     function1.list_zip_csv_files(remote_path))
+    
+    function1.Function1(uuid.uuid4().hex, logger, remote_path, 'Strom_Privat.zip', streaming=streaming, workers=2,
+                        max_memory_mb=max_memory_mb, pipelined=True)
+    
+    key, = [o['Key'] for o in s3.list_objects_v2(Bucket='parquet')['Contents']]
+    s3.download_file('parquet', key, str(tmp_path / 'pipelined.parquet'))
+    expected = pd.read_parquet(tmp_path / 'serial.parquet')
+    result = pd.read_parquet(tmp_path / 'pipelined.parquet')
+    pd.testing.assert_frame_equal(result, expected)
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers)
+        self.submitted = 0
+    
+    def submit(self, *args):
+        self.submitted += 1
+        return super().submit(*args)
+
+
+@pytest.mark.parametrize('max_memory_mb', [None, 1, 2])
+def test_parse_zip_members_bounds_members_in_flight(tmp_path, max_memory_mb):
+    zip_path = str(tmp_path / 'Strom_Privat.zip')
+    write_market_zip(zip_path, 0, files=5, rows=4000)
+    csv_files = function1.list_zip_csv_files(zip_path)
+    sizes = [function1.csv_file_size(csv_file, zip_path) for csv_file, _ in csv_files]
+    
+    with RecordingExecutor(max_workers=3) as executor:
+        parsed = function1.parse_zip_members(executor, {}, time.time(), 'job', logger, zip_path, None, 'pandas', 3,
+                                             max_memory_mb)
+        for i, data_frame in enumerate(parsed):
+            # members i .. submitted - 1 are parsed but not yet consumed
+            in_flight = sizes[i:executor.submitted]
+            assert 1 <= len(in_flight) <= 3
+            assert max_memory_mb is None or len(in_flight) == 1 or sum(in_flight) <= max_memory_mb << 20
+            expected = function1.read_a_csv_file('job', logger, csv_files[i][0], zip_path)
+            pd.testing.assert_frame_equal(data_frame, expected)
+
+
+def read_without_categories(path):
+    """
+    Read Parquet file or dataset back with pyarrow.dataset in the order of
+    the rows before they were split, categorical columns as plain strings.
+    """
+    
+    table = ds.dataset(path, format='parquet', partitioning='hive').to_table()
+    if function1.ROW_COLUMN in table.column_names:
+        table = table.take(pc.sort_indices(table[function1.ROW_COLUMN]))
+    df = table.to_pandas()
+    return df.astype({name: object for name in function1.CATEGORICAL_COLUMNS})
+
+
+@pytest.mark.parametrize('layout', ['file', 'dataset'])
+@pytest.mark.parametrize('missing', [0.1, [1.0, 0.1, 0.1]])
+def test_categorical_parquet_equals_plain_parquet(tmp_path, monkeypatch, layout, missing):
+    zip_path = str(tmp_path / 'Strom_Privat.zip')
+    write_market_zip(zip_path, 0, missing=missing)
+    csv_files = function1.list_zip_csv_files(zip_path)
+    
+    function1.convert_csv_to_parquet('job', logger, 'Strom_Privat.zip', '20261018', str(tmp_path / 'categorical.parquet'),
+                                     csv_files, layout=layout)
+    with monkeypatch.context() as m:
+        m.setattr(function1, 'encode_categorical_columns', lambda table: table)
+        function1.convert_csv_to_parquet('job', logger, 'Strom_Privat.zip', '20261018', str(tmp_path / 'plain.parquet'),
+                                         csv_files, layout=layout)
+    
+    name = 'categorical.parquet' if layout == 'file' else 'categorical'
+    result = ds.dataset(str(tmp_path / name), format='parquet', partitioning='hive').to_table()
+    assert all(pa.types.is_dictionary(result.schema.field(c).type) for c in function1.CATEGORICAL_COLUMNS)
+    
+    expected = read_without_categories(str(tmp_path / name.replace('categorical', 'plain')))
+    result = read_without_categories(str(tmp_path / name))
+    assert expected['zip'].isna().any()
+    pd.testing.assert_frame_equal(result, expected)
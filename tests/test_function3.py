@@ -0,0 +1,985 @@
+import logging
+import os
+import time
+from concurrent.futures import Future
+
+import boto3
+import botocore
+import moto
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import function1
+import function3
+from conftest import write_market_zip
+
+
+logger = logging.getLogger(__name__)
+
+
+def random_bands(rng, n_left, n_right, missing):
+    """
+    Random market rows (left) and tariff bands (right) for interval_merge(),
+    a fraction missing of keys, values and band bounds is NaN.
+    """
+    
+    def with_missing(values):
+        values = values.astype(np.float64)
+        values[rng.random(len(values)) < missing] = np.nan
+        return values
+    
+    left = pd.DataFrame({'area_collection': with_missing(rng.integers(0, 5, n_left)),
+                         'consumption': with_missing(rng.integers(0, 100, n_left)),
+                         'rank': rng.integers(1, 10, n_left)})
+    left.index = rng.permutation(n_left) + 1000
+    consumption_from = rng.integers(0, 100, n_right)
+    right = pd.DataFrame({'area_collection': with_missing(rng.integers(0, 6, n_right)),
+                          'consumption_from': with_missing(consumption_from),
+                          'consumption_until': with_missing(consumption_from + rng.integers(0, 50, n_right)),
+                          'rank': rng.integers(1, 10, n_right)})
+    return left, right
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_interval_merge_equals_merge_and_query(seed):
+    rng = np.random.default_rng(seed)
+    left, right = random_bands(rng, int(rng.integers(0, 60)), int(rng.integers(0, 12)), rng.choice([0, 0.1, 0.4]))
+    
+    expected = pd.merge(left, right, how='inner', on='area_collection').query(
+        'consumption_from <= consumption <= consumption_until')
+    result = function3.interval_merge(left, right, 'area_collection', 'consumption', 'consumption_from',
+                                      'consumption_until')
+    
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_interval_merge_open_ended_band():
+    left = pd.DataFrame({'area_collection': [1, 1, 1], 'consumption': [100, 5000, 90000]})
+    right = pd.DataFrame({'area_collection': [1, 1],
+                          'consumption_from': [0, 4000],
+                          'consumption_until': [3999, np.nan]})
+    
+    result = function3.interval_merge(left, right, 'area_collection', 'consumption', 'consumption_from',
+                                      'consumption_until')
+    
+    assert result['consumption'].tolist() == [100]
+
+
+def bonus_steps_stepwise(result):
+    """
+    Steps 10-23 of Function3 one by one, as they were before bonus_kernel().
+    """
+    
+    # Step 10 - Calculate eonprice column
+    result.eval('eonprice = basicrate + consumption * kwhrate', inplace=True)
+    result['eonprice'].round(2)
+    
+    
+    
+    # Step 11
+    # - pick smaller value of ( max_bonus_sum_abs , eonprice*max_bonus_sum_percentage )
+    # - then round_down with value from abssteps column
+    # - drop unused columns
+    result.eval('tmp1 = eonprice * max_bonus_sum_percentage', inplace=True)
+    result['max_bonus_sum_abs'] = function3.round_down(result[['tmp1', 'max_bonus_sum_abs']].min(axis=1), result['abssteps'])
+    result.drop(columns=['max_bonus_sum_percentage', 'tmp1'],
+                axis=1,
+                inplace=True)
+    
+    
+    
+    # Step 12
+    # - pick smaller value of ( max_bonus_nc_abs , eonprice*max_bonus_nc_percentage )
+    # - then round_down with value from abssteps column
+    result.eval('tmp1 = eonprice * max_bonus_nc_percentage', inplace=True)
+    result['tmp1'] = function3.round_down(result['tmp1'], result['abssteps'])
+    result['max_bonus_nc_abs'] = result[['tmp1', 'max_bonus_nc_abs']].min(axis=1)
+    result.drop(columns=['max_bonus_nc_percentage', 'tmp1'],
+                axis=1,
+                inplace=True)
+    
+    
+    
+    # Step 13
+    # - redefine max_bonus_sum_abs
+    # - delete all rows where ( eonprice – max_bonus_sum_abs ) > priceSumNet
+    result.eval('tmp1 = max_bonus_nc_abs + max_bonus_ib_abs', inplace=True)
+    result['max_bonus_sum_abs'] = result[['tmp1', 'max_bonus_sum_abs']].min(axis=1)
+    result.query('(eonprice - max_bonus_sum_abs) <= priceSumNet', inplace=True)
+    result.drop(columns=['tmp1'],
+                axis=1,
+                inplace=True)
+    
+    
+    
+    # Step 14 - Delete all rows where rank < highest_rank
+    result.query('rank >= highest_rank', inplace=True)
+    
+    
+    
+    # Step 15
+    # - calculate max_bonus_pm_abs column
+    # - then round_down with value from abssteps column
+    result.eval('max_bonus_pm_abs = (maxamortisation * (basicrate_margin + consumption * kwhrate_margin - costmodelinternal_pa - costmodelprovision_pa)) - costmodelinternal_oneoff - costmodelprovision_oneoff', inplace=True)
+    result.eval('zero = 0', inplace=True)
+    result['max_bonus_pm_abs'] = result[['max_bonus_pm_abs', 'zero']].max(axis=1)
+    result['max_bonus_pm_abs'] = function3.round_down(result['max_bonus_pm_abs'], result['abssteps'])
+    result.drop(columns=['zero'],
+                axis=1,
+                inplace=True)
+    
+    
+    
+    # Step 16 - Reduce result to less columns at the moment
+    select_columns = [
+        'pid_id',
+        'zip_id',
+        'city_id',
+        'rank',
+        'consumption',
+        'consumption_until_from_tariff',
+        'eonprice',
+        'priceSumNet',
+        'max_bonus_sum_abs',
+        'max_bonus_ib_abs',
+        'min_bonus_ib_abs',
+        'lowest_rank',
+        'max_bonus_pm_abs',
+        'abssteps',
+        'max_bonus_nc_abs'
+    ]
+    result = result[select_columns]
+    
+    # Step 16 - Rename columns
+    result.rename(columns={'consumption': 'consumption_from', 'consumption_until_from_tariff': 'consumption_until'}, inplace=True)
+    
+    
+    
+    # Step 17 - Calculate bonus_needed column
+    result.eval('bonus_needed = eonprice - priceSumNet', inplace=True)
+    result.eval('zero = 0', inplace=True)
+    result['bonus_needed'] = result[['bonus_needed', 'zero']].max(axis=1)
+    result['bonus_needed'] = function3.round_up(result['bonus_needed'], result['abssteps'])
+    result.drop(columns=['zero'],
+                axis=1,
+                inplace=True)
+    
+    
+    
+    # Step 18 - Create result columns
+    result.eval('zero = 0', inplace=True)
+    
+    # Step 19 - Find instant bonus (ib) based on minimum
+    result.eval('ib = min_bonus_ib_abs', inplace=True)
+    result['ib'] = function3.round_up(result['ib'], result['abssteps'])
+    
+    # Step 20 - Find new customer bonus (nc) based on what's still needed after minimum ib
+    result.eval('nc = bonus_needed - ib', inplace=True)
+    result['nc'] = function3.round_up(result['nc'], result['abssteps'])
+    
+    # Step 21 - Make sure, nc is not below 0 and not over maximum nc
+    result['nc'] = result[['nc', 'zero']].max(axis=1)
+    result['nc'] = result[['nc', 'max_bonus_nc_abs']].min(axis=1)
+    
+    # Step 22 - If there is bonus needed left, get it through instant bonus (ib)
+    result.eval('ib = bonus_needed - nc', inplace=True)
+    result['ib'] = function3.round_up(result['ib'], result['abssteps'])
+    
+    result.drop(columns=['zero'],
+                axis=1,
+                inplace=True)
+    
+    
+    
+    # Step 23 - Drop all rows in result where: ( nc + ib ) < bonus_needed
+    result.query('(nc + ib) >= bonus_needed', inplace=True)
+    
+    
+    return result
+
+
+def compare_bitwise(expected, result):
+    """
+    Assert both DataFrames have the same index, columns, dtypes and bit
+    patterns of all values.
+    """
+    
+    assert expected.index.equals(result.index)
+    assert list(expected.columns) == list(result.columns)
+    for c in expected.columns:
+        a, b = expected[c].values, result[c].values
+        assert a.dtype == b.dtype, c
+        assert a.tobytes() == b.tobytes(), c
+
+
+def random_bonus_input(rng, n):
+    """
+    Random Step 9 result for Steps 10-23, with missing values, signed zeros
+    and zero abssteps.
+    """
+    
+    def choice(values):
+        return rng.choice(np.array(values, dtype=np.float64), n)
+    
+    return pd.DataFrame({'pid_id': rng.integers(0, 5, n),
+                         'zip_id': rng.integers(0, 5, n),
+                         'city_id': rng.integers(0, 5, n),
+                         'rank': rng.integers(1, 10, n),
+                         'consumption': rng.integers(0, 5000, n),
+                         'consumption_until_from_tariff': rng.integers(0, 9000, n),
+                         'basicrate': choice([0, -0.0, 10.5, 100, np.nan]),
+                         'kwhrate': rng.random(n) * 0.4,
+                         'basicrate_margin': rng.normal(0, 50, n),
+                         'kwhrate_margin': rng.normal(0, 0.05, n),
+                         'priceSumNet': rng.normal(800, 400, n),
+                         'max_bonus_sum_percentage': choice([0, 0.1, 0.3, np.nan]),
+                         'max_bonus_sum_abs': choice([0, 50, 100, np.nan]),
+                         'max_bonus_nc_percentage': choice([0, 0.2, np.nan]),
+                         'max_bonus_nc_abs': choice([0, -0.0, 80, np.nan]),
+                         'max_bonus_ib_abs': choice([0, 30, np.nan]),
+                         'min_bonus_ib_abs': choice([0, -0.0, 5, np.nan]),
+                         'lowest_rank': rng.integers(1, 10, n),
+                         'highest_rank': rng.integers(1, 5, n),
+                         'abssteps': choice([1, 5, 10, 0]),
+                         'maxamortisation': choice([1, 2]),
+                         'costmodelinternal_pa': 12.0,
+                         'costmodelinternal_oneoff': 3.0,
+                         'costmodelprovision_pa': choice([1, 2]),
+                         'costmodelprovision_oneoff': choice([0, 4])},
+                        index=rng.permutation(n))
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('engine', ['numpy', pytest.param('numexpr', marks=pytest.mark.skipif(
+    function3.numexpr is None, reason='numexpr is not installed'))])
+@pytest.mark.parametrize('seed', range(100))
+def test_bonus_kernel_equals_step_chain_bitwise(seed, engine):
+    rng = np.random.default_rng(seed)
+    result = random_bonus_input(rng, int(rng.integers(0, 500)))
+    
+    expected = bonus_steps_stepwise(result.copy())
+    
+    compare_bitwise(expected, function3.bonus_kernel(result, engine))
+
+
+class RecordingConnection:
+    """
+    pymysql connection stand-in, records executed SQL and commits in events.
+    """
+    
+    def __init__(self, events):
+        self.events = events
+    
+    def cursor(self):
+        connection = self
+        
+        class Cursor:
+            def __enter__(self):
+                return self
+            
+            def __exit__(self, *args):
+                return False
+            
+            def execute(self, sql, *args):
+                connection.events.append(' '.join(sql.split()).split(' ')[0])
+        
+        return Cursor()
+    
+    def begin(self):
+        self.events.append('BEGIN')
+    
+    def commit(self):
+        self.events.append('COMMIT')
+    
+    def rollback(self):
+        self.events.append('ROLLBACK')
+    
+    def close(self):
+        self.events.append('CLOSE')
+
+
+def shard_results(events, shards, fail_at=None):
+    for shard in range(shards):
+        if shard == fail_at:
+            raise RuntimeError('shard failed')
+        events.append('shard %d' % shard)
+        yield pd.DataFrame({'consumption_from': [0.0], 'consumption_until': [10.0], 'nc': [1.0], 'ib': [1.0],
+                            'zip': ['01067'], 'city': ['Dresden'], 'pid_id': np.array([0], dtype=np.int32)})
+
+
+@pytest.fixture
+def to_sql_events(monkeypatch):
+    events = []
+    monkeypatch.setenv('SQL_USER', 'user')
+    monkeypatch.setenv('SQL_PASSWORD', 'password')
+    monkeypatch.setenv('SQL_HOST', 'localhost')
+    monkeypatch.setenv('SQL_DBNAME', 'db')
+    monkeypatch.setattr(function3, 'create_engine', lambda *args, **kwargs: None)
+    monkeypatch.setattr(pd.DataFrame, 'to_sql', lambda self, *args, **kwargs: events.append('INSERT'))
+    return events
+
+
+def test_write_results_to_sql_deletes_after_first_result(to_sql_events):
+    rows = function3.write_results(RecordingConnection(to_sql_events), 'job', shard_results(to_sql_events, 2), 7, 3,
+                                   np.array(['P1'], dtype=object), 'to_sql')
+    
+    assert rows == 2
+    assert to_sql_events == ['shard 0', 'DELETE', 'COMMIT', 'INSERT', 'shard 1', 'INSERT']
+
+
+def test_write_results_to_sql_keeps_rows_if_first_result_fails(to_sql_events):
+    with pytest.raises(RuntimeError):
+        function3.write_results(RecordingConnection(to_sql_events), 'job', shard_results(to_sql_events, 2, 0), 7, 3,
+                                np.array(['P1'], dtype=object), 'to_sql')
+    
+    assert to_sql_events == []
+
+
+def test_write_results_to_sql_deletes_without_results(to_sql_events):
+    rows = function3.write_results(RecordingConnection(to_sql_events), 'job', shard_results(to_sql_events, 0), 7, 3,
+                                   np.array(['P1'], dtype=object), 'to_sql')
+    
+    assert rows == 0
+    assert to_sql_events == ['DELETE', 'COMMIT']
+
+
+def test_benchmark_result_writers_removes_its_rows(to_sql_events, monkeypatch, tmp_path):
+    monkeypatch.setattr(function3, 'connect_mysql', lambda local_infile=False: RecordingConnection(to_sql_events))
+    
+    timings = function3.benchmark_result_writers(logger, rows=1000, work_dir=str(tmp_path))
+    
+    assert sorted(timings) == ['load_data', 'to_sql']
+    assert to_sql_events == ['DELETE', 'COMMIT', 'INSERT',
+                             'DROP', 'CREATE', 'COMMIT', 'LOAD', 'COMMIT',
+                             'BEGIN', 'DELETE', 'INSERT', 'COMMIT', 'DROP', 'COMMIT',
+                             'DELETE', 'COMMIT', 'CLOSE']
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.fixture
+def bucket(monkeypatch, tmp_path):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'eu-central-1')
+    monkeypatch.setattr(function3, 'MARKET_DATA_CACHE_DIR', str(tmp_path / 'cache'))
+    with moto.mock_aws():
+        bucket = boto3.resource('s3').Bucket('parquet')
+        bucket.create(CreateBucketConfiguration={'LocationConstraint': 'eu-central-1'})
+        yield bucket
+
+
+def put_market_data(bucket, key, data):
+    return bucket.put_object(Key=key, Body=data).e_tag
+
+
+def cache_files():
+    return sorted(os.listdir(function3.MARKET_DATA_CACHE_DIR))
+
+
+def test_download_cached_reuses_entry(bucket, tmp_path):
+    etag = put_market_data(bucket, 'a.parquet', b'version 1')
+    function3.download_cached(logger, bucket, 'a.parquet', etag, str(tmp_path / 'job1.parquet'))
+    bucket.Object('a.parquet').delete()
+    function3.download_cached(logger, bucket, 'a.parquet', etag, str(tmp_path / 'job2.parquet'))
+    
+    assert (tmp_path / 'job2.parquet').read_bytes() == b'version 1'
+
+
+def test_download_cached_rejects_changed_object(bucket, tmp_path):
+    etag = put_market_data(bucket, 'a.parquet', b'version 1')
+    put_market_data(bucket, 'a.parquet', b'version 2')
+    
+    with pytest.raises(botocore.exceptions.ClientError) as e:
+        function3.download_cached(logger, bucket, 'a.parquet', etag, str(tmp_path / 'job.parquet'))
+    assert e.value.response['Error']['Code'] == 'PreconditionFailed'
+    assert not [name for name in cache_files() if name.endswith(('.parquet', '.tmp'))]
+    
+    # the lock file of the failed download is removed by the next eviction
+    function3.evict_market_data_cache(logger)
+    assert cache_files() == ['.evict.lock']
+
+
+def test_evict_market_data_cache_removes_lock_files(bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(function3, 'MARKET_DATA_CACHE_MAX_BYTES', 15)
+    old_etag = put_market_data(bucket, 'a.parquet', b'version 1')
+    function3.download_cached(logger, bucket, 'a.parquet', old_etag, str(tmp_path / 'job1.parquet'))
+    old_entry = [name for name in cache_files() if name.endswith('.parquet')][0]
+    os.utime(os.path.join(function3.MARKET_DATA_CACHE_DIR, old_entry), (0, 0))
+    
+    etag = put_market_data(bucket, 'b.parquet', b'version 1')
+    function3.download_cached(logger, bucket, 'b.parquet', etag, str(tmp_path / 'job2.parquet'))
+    
+    entry = [name for name in cache_files() if name.endswith('.parquet')]
+    assert entry != [old_entry] and len(entry) == 1
+    assert cache_files() == sorted(['.evict.lock', entry[0], entry[0][:-len('.parquet')] + '.lock'])
+    assert (tmp_path / 'job1.parquet').read_bytes() == b'version 1'
+
+
+def write_market_data(tmp_path, seed, layout, missing=(1.0, 0.1, 0.1)):
+    """
+    Market data file (or dataset directory) of write_market_zip() as
+    Function1 writes it, the first CSV file has no zip and city at all.
+    """
+    
+    os.makedirs(tmp_path, exist_ok=True)
+    zip_path = str(tmp_path / 'Strom_Privat.zip')
+    write_market_zip(zip_path, seed, missing=list(missing))
+    parquet_file_name = str(tmp_path / '20261001_Strom_Privat.parquet')
+    function1.convert_csv_to_parquet('job', logger, 'Strom_Privat.zip', '20261001', parquet_file_name,
+                                     function1.list_zip_csv_files(zip_path), layout=layout)
+    return parquet_file_name if layout == 'file' else parquet_file_name[:-len('.parquet')]
+
+
+@pytest.mark.parametrize('layout', ['file', 'dataset'])
+@pytest.mark.parametrize('zips', [['01000', '01003', None], ['01000', '01003']])
+def test_scan_market_data_keeps_missing_zips(tmp_path, monkeypatch, layout, zips):
+    monkeypatch.setattr(function3, 'EXCLUDED_PROVIDER', 'Vattenfall')
+    market = pd.read_parquet(write_market_data(tmp_path / 'file', 0, 'file'))
+    file_name = write_market_data(tmp_path, 0, layout)
+    columns = ['consumption', 'zip', 'city', 'rank', 'provider']
+    
+    result = function3.scan_market_data(file_name, columns + ([function3.ROW_COLUMN] if layout == 'dataset' else []),
+                                        pd.Series(zips, dtype=object), ['zip', 'city', 'provider'])
+    if layout == 'dataset':
+        result = result.sort_values(function3.ROW_COLUMN).drop(columns=[function3.ROW_COLUMN])
+    
+    keep = (market['provider'] != 'Vattenfall') & (market['zip'].isin(zips) | (market['zip'].isna() & (None in zips)))
+    expected = market.loc[keep, columns].astype({c: object for c in ['zip', 'city', 'provider']})
+    result = result.astype({c: object for c in ['zip', 'city', 'provider']})
+    assert market['zip'].isna().sum() > 0
+    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True))
+
+
+def random_reference(rng):
+    """
+    Random areas (some with missing zip or city), config, tariff (with
+    pid_id) and cost models for the zips and cities of write_market_zip().
+    """
+    
+    rows = []
+    for zip_code in ['%05d' % z for z in range(1000, 1010)] + [None]:
+        for city in ['München', 'Köln', 'Berlin', None]:
+            if rng.random() < 0.7:
+                rows.append((zip_code, city, 'AC%d' % rng.integers(0, 4), 'T%d' % rng.integers(0, 2)))
+    areas = pd.DataFrame(rows, columns=['zip', 'city', 'area_collection', 'area_type'])
+    
+    config = pd.DataFrame([dict(consumption_from=low, consumption_until=high, handle_area_types_diff=1,
+                                area_type=area_type, abssteps=float(rng.choice([1, 5, 10])),
+                                max_bonus_sum_percentage=rng.uniform(0.1, 0.4),
+                                max_bonus_sum_abs=float(rng.integers(50, 300)),
+                                max_bonus_nc_abs=float(rng.integers(20, 200)),
+                                max_bonus_nc_percentage=rng.uniform(0.05, 0.3),
+                                min_bonus_ib_abs=float(rng.integers(0, 40)),
+                                max_bonus_ib_abs=float(rng.integers(40, 200)), lowest_rank=int(rng.integers(2, 5)),
+                                highest_rank=int(rng.integers(1, 3)), maxamortisation=float(rng.uniform(1, 3)))
+                           for area_type in ['T0', 'T1']
+                           for low, high in [(0, 1999), (2000, 3499), (3500, 100000)]])
+    
+    tariff = pd.DataFrame([dict(pid=pid, area_collection='AC%d' % area_collection,
+                                basicrate=rng.uniform(50, 150), basicrate_margin=rng.uniform(10, 60),
+                                kwhrate=rng.uniform(0.2, 0.35), kwhrate_margin=rng.uniform(0.01, 0.05),
+                                consumption_from=low, consumption_until=high)
+                           for area_collection in range(4)
+                           for pid in rng.choice(['P1', 'P2', 'P3', 'P4'], size=3, replace=False)
+                           for low, high in [(0, 2499), (2500, 99999)]])
+    tariff['pid_id'], _ = function3.factorize_column(tariff['pid'])
+    tariff.drop(columns=['pid'], inplace=True)
+    
+    costmodelinternal = pd.DataFrame([dict(costmodelinternal_oneoff=20.0, costmodelinternal_pa=10.0)])
+    costmodelprovision = pd.DataFrame([dict(consumption_from=0, consumption_until=2999,
+                                            costmodelprovision_oneoff=15.0, costmodelprovision_pa=5.0),
+                                       dict(consumption_from=3000, consumption_until=200000,
+                                            costmodelprovision_oneoff=25.0, costmodelprovision_pa=8.0)])
+    return areas, config, tariff, costmodelinternal, costmodelprovision
+
+
+def join_steps_stepwise(result, config, tariff):
+    """
+    Steps 4-7 of Function3 as they were before factorize_column() and
+    interval_merge(), returns the result and the zip and city lookup frames.
+    The sort of Step 4 is left to prepare_market_data() (or
+    prepare_market_data_stepwise()).
+    """
+    
+    # Step 4
+    config.sort_values(by=['consumption_until'], inplace=True)
+    result = pd.merge_asof(result, config, left_on='consumption', right_on='consumption_until', by='area_type',
+                           direction='forward')
+    result.drop(columns=['consumption_from', 'consumption_until', 'area_type'], axis=1, inplace=True)
+    
+    
+    
+    # Step 6
+    _col_zip = pd.DataFrame({'zip': result.zip.unique(), 'zip_id': range(len(result.zip.unique()))})
+    _col_city = pd.DataFrame({'city': result.city.unique(), 'city_id': range(len(result.city.unique()))})
+    result = result.merge(_col_zip, on='zip', how='left')
+    result = result.merge(_col_city, on='city', how='left')
+    result.drop(columns=['zip', 'city'], axis=1, inplace=True)
+    
+    
+    
+    # Step 7
+    result = pd.merge(result, tariff, how='inner', on='area_collection')
+    result.query('consumption_from <= consumption <= consumption_until', inplace=True)
+    result.drop(columns=['consumption_from'], axis=1, inplace=True)
+    result.rename(columns={'consumption_until': 'consumption_until_from_tariff'}, inplace=True)
+    return result, _col_zip, _col_city
+
+
+def calculate_bonus_stepwise(result, config, tariff, costmodelinternal, costmodelprovision):
+    """
+    Steps 4-29 of Function3 as they were before interval_merge(),
+    bonus_kernel() and set_next_band_ends(), zip and city decoded.
+    """
+    
+    result, _col_zip, _col_city = join_steps_stepwise(result, config, tariff)
+    
+    
+    
+    # Steps 8-9
+    result['costmodelinternal_oneoff'] = costmodelinternal.iloc[0]['costmodelinternal_oneoff']
+    result['costmodelinternal_pa'] = costmodelinternal.iloc[0]['costmodelinternal_pa']
+    costmodelprovision.sort_values(by=['consumption_until'], inplace=True)
+    result.sort_values(by=['consumption'], inplace=True)
+    result = pd.merge_asof(result, costmodelprovision, left_on='consumption', right_on='consumption_until',
+                           direction='forward')
+    
+    
+    
+    # Steps 10-23
+    result = bonus_steps_stepwise(result)
+    
+    
+    
+    # Steps 24-26
+    group_columns = ['pid_id', 'zip_id', 'city_id', 'consumption_from']
+    step24 = result.groupby(group_columns, as_index=False)['rank'].min()
+    step24 = result.merge(step24, how='inner', on=group_columns + ['rank'])
+    result.query('rank <= lowest_rank & 0 >= max_bonus_pm_abs - bonus_needed', inplace=True)
+    result = pd.concat([step24, result])
+    result.drop_duplicates(inplace=True)
+    for column in ['bonus_needed', 'rank']:
+        tmp = result.groupby(group_columns, as_index=False)[column].min()
+        result = result.merge(tmp, how='inner', on=group_columns + [column])
+    
+    
+    
+    # Step 27
+    result.eval('tmp = bonus_needed - ib', inplace=True)
+    result['nc'] = result[['max_bonus_nc_abs', 'tmp']].min(axis=1)
+    
+    
+    
+    # Step 28
+    result = result.groupby(['pid_id', 'zip_id', 'city_id'], group_keys=False).apply(pd.DataFrame.sort_values,
+                                                                                      'consumption_from')
+    result['consumption_until_new'] = result.groupby(['pid_id', 'zip_id', 'city_id'])['consumption_from'].shift(-1)
+    result['consumption_until_new'] -= 1
+    result['consumption_until_new'] = result['consumption_until_new'].fillna(result['consumption_until'])
+    result.drop(['consumption_until'], inplace=True, axis=1)
+    result.rename(index=str, inplace=True, columns={'consumption_until_new': 'consumption_until'})
+    
+    
+    
+    # Step 29
+    result = result[['pid_id', 'zip_id', 'city_id', 'consumption_from', 'consumption_until', 'nc', 'ib']]
+    result = result.merge(_col_zip, how='inner', on='zip_id')
+    result = result.merge(_col_city, how='inner', on='city_id')
+    return result.drop(columns=['zip_id', 'city_id'])
+
+
+def assert_equal_up_to_step28_ties(expected, result):
+    """
+    Assert both results have the same rows, except that rows of a
+    pid/zip/city group with equal consumption_from may have their
+    consumption_until in another order (Step 28 of the old code depended on
+    the quicksort order of Step 9 for these).
+    """
+    
+    def rows(df, columns):
+        df = df[columns].astype({'zip': object, 'city': object})
+        return df.sort_values(columns).reset_index(drop=True)
+    
+    group_columns = ['pid_id', 'zip', 'city', 'consumption_from']
+    assert len(expected) > 0
+    for columns in [group_columns + ['nc', 'ib'], group_columns + ['consumption_until']]:
+        pd.testing.assert_frame_equal(rows(result, columns), rows(expected, columns))
+
+
+@pytest.mark.parametrize('ties', [False, True])
+@pytest.mark.parametrize('seed', range(10))
+def test_set_next_band_ends_equals_groupby_sort_shift(seed, ties):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(0, 400))
+    result = pd.DataFrame({'pid_id': rng.integers(0, 5, n),
+                           'zip_id': rng.integers(0, 5, n),
+                           'city_id': rng.integers(0, 5, n),
+                           'consumption_from': (rng.choice([1000, 2000, 3000], n) if ties else
+                                                rng.choice(10 ** 6, n, replace=False)),
+                           'nc': rng.random(n)},
+                          index=rng.permutation(n))
+    # rows with equal consumption_from have equal consumption_until
+    result.insert(4, 'consumption_until', result['consumption_from'] + 499.0)
+    
+    expected = result.groupby(['pid_id', 'zip_id', 'city_id'], group_keys=False).apply(pd.DataFrame.sort_values,
+                                                                                        'consumption_from')
+    expected['consumption_until_new'] = expected.groupby(['pid_id', 'zip_id', 'city_id'])['consumption_from'].shift(-1)
+    expected['consumption_until_new'] -= 1
+    expected['consumption_until_new'] = expected['consumption_until_new'].fillna(expected['consumption_until'])
+    expected.drop(['consumption_until'], inplace=True, axis=1)
+    expected.rename(index=str, inplace=True, columns={'consumption_until_new': 'consumption_until'})
+    
+    result = function3.set_next_band_ends(result, ['pid_id', 'zip_id', 'city_id'])
+    
+    if not ties:
+        pd.testing.assert_frame_equal(result, expected, check_index_type=False)
+    # the old sort per group does not keep rows with equal consumption_from in
+    # a defined order, so only their consumption_until values match
+    group_columns = ['pid_id', 'zip_id', 'city_id', 'consumption_from']
+    for columns in [group_columns + ['nc'], group_columns + ['consumption_until']]:
+        pd.testing.assert_frame_equal(result[columns].sort_values(columns).reset_index(drop=True),
+                                      expected[columns].sort_values(columns).reset_index(drop=True))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_calculate_bonus_step7_equals_merge_and_query(tmp_path, monkeypatch, seed):
+    rng = np.random.default_rng(seed)
+    areas, config, tariff, costmodelinternal, costmodelprovision = random_reference(rng)
+    market = function3.prepare_market_data('job', logger, write_market_data(tmp_path, seed, 'file', (0.2, 0.2, 0.2)),
+                                           False, areas.copy(), {})
+    steps = {}
+    monkeypatch.setattr(function3, 'trace_step', lambda trace, step, df, zips=None, cities=None, rows=None:
+                        steps.setdefault(step, (df.copy(), zips, cities)))
+    
+    expected, _col_zip, _col_city = join_steps_stepwise(market.astype({'zip': object, 'city': object}),
+                                                        config.copy(), tariff.copy())
+    function3.calculate_bonus('job', logger, market.copy(), config.copy(), tariff.copy(), costmodelinternal,
+                              costmodelprovision.copy(), {})
+    result, zips, cities = steps['step_07']
+    
+    # same rows, order and index labels, Step 9 keeps this order for rows
+    # with equal consumption; ids in order of first appearance, missing
+    # zip and city included
+    assert expected['zip_id'].isin(_col_zip.loc[_col_zip['zip'].isna(), 'zip_id']).any()
+    assert expected['city_id'].isin(_col_city.loc[_col_city['city'].isna(), 'city_id']).any()
+    pd.testing.assert_series_equal(pd.Series(zips, dtype=object), _col_zip['zip'], check_names=False)
+    pd.testing.assert_series_equal(pd.Series(cities, dtype=object), _col_city['city'], check_names=False)
+    pd.testing.assert_frame_equal(result, expected[list(result.columns)], check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_calculate_bonus_equals_step_chain(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    areas, config, tariff, costmodelinternal, costmodelprovision = random_reference(rng)
+    market = function3.prepare_market_data('job', logger, write_market_data(tmp_path, seed, 'file', (0.2, 0.2, 0.2)),
+                                           False, areas.copy(), {})
+    
+    expected = calculate_bonus_stepwise(market.astype({'zip': object, 'city': object}), config.copy(),
+                                        tariff.copy(), costmodelinternal, costmodelprovision.copy())
+    result = function3.calculate_bonus('job', logger, market.copy(), config.copy(), tariff.copy(),
+                                       costmodelinternal, costmodelprovision.copy(), {})
+    
+    assert expected['zip'].isna().any() and expected['city'].isna().any()
+    assert_equal_up_to_step28_ties(expected, result)
+
+
+@pytest.mark.parametrize('layout', ['file', 'dataset'])
+@pytest.mark.parametrize('seed', range(3))
+def test_split_market_data_shards_equal_unsharded(tmp_path, layout, seed):
+    rng = np.random.default_rng(seed)
+    areas, config, tariff, costmodelinternal, costmodelprovision = random_reference(rng)
+    file_name = write_market_data(tmp_path, seed, layout, (0.2, 0.2, 0.2))
+    
+    def calculate(file_name, is_dataset, areas):
+        return function3.calculate_shard('job', logger, file_name, is_dataset, areas.copy(), config.copy(),
+                                         tariff.copy(), costmodelinternal, costmodelprovision.copy())[0]
+    
+    expected = calculate(file_name, layout == 'dataset', areas)
+    area_shards = function3.shard_by_zip(areas, 3)
+    shard_files = function3.split_market_data(logger, file_name, layout == 'dataset', area_shards,
+                                              str(tmp_path / 'shards') + '/')
+    result = pd.concat([calculate(shard_file_name, shard_is_dataset, area_shard)
+                        for area_shard, (shard_file_name, shard_is_dataset) in zip(area_shards, shard_files)])
+    
+    assert len(area_shards) == 3
+    for area_shard, (shard_file_name, _) in zip(area_shards, shard_files):
+        shard_zips = pd.read_parquet(shard_file_name)['zip'].astype(object)
+        assert len(shard_zips) > 0
+        assert (shard_zips.isin(area_shard['zip'].dropna()) | (shard_zips.isna() & area_shard['zip'].isna().any())).all()
+    assert_equal_up_to_step28_ties(expected, result)
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_download_market_dataset_round_trip(bucket, tmp_path, cached):
+    market = pd.read_parquet(write_market_data(tmp_path / 'file', 0, 'file')).reset_index(drop=True)
+    dataset_path = write_market_data(tmp_path, 0, 'dataset')
+    function1.upload_parquet_dataset(bucket.meta.client, 'parquet', dataset_path)
+    manifest_key = '%s/%s' % (os.path.basename(dataset_path), function3.MANIFEST_NAME)
+    
+    file_name = function3.download_market_dataset(logger, bucket, manifest_key, str(tmp_path / 'work'),
+                                                  function3.market_zip_prefixes(market['zip'].astype(object)),
+                                                  (0, 100000), bucket.Object(manifest_key).e_tag if cached else None)
+    result = function3.scan_market_data(file_name, list(market.columns) + [function3.ROW_COLUMN],
+                                        market['zip'].astype(object), function1.CATEGORICAL_COLUMNS)
+    result.sort_values(function3.ROW_COLUMN, inplace=True)
+    
+    assert market['zip'].isna().sum() > 0
+    assert result[function3.ROW_COLUMN].tolist() == list(range(len(market)))
+    categorical = {c: object for c in function1.CATEGORICAL_COLUMNS}
+    pd.testing.assert_frame_equal(result.drop(columns=[function3.ROW_COLUMN]).reset_index(drop=True).astype(categorical),
+                                  market.astype(categorical))
+
+
+def prepare_market_data_stepwise(file_name, areas):
+    """
+    Load, Steps 1-3 and the sort of Step 4 of Function3 as they were before
+    the market data was kept Categorical (object strings, rank as read).
+    """
+    
+    vxdata = pd.read_parquet(file_name, columns=function3.MARKET_DATA_COLUMNS)
+    vxdata = vxdata.astype({c: object for c in ['zip', 'city', 'provider']})
+    vxdata.drop_duplicates(subset=['consumption', 'zip', 'city', 'rank'], inplace=True)
+    vxdata.query("provider != @function3.EXCLUDED_PROVIDER", inplace=True)
+    vxdata.drop(columns=['provider'], inplace=True)
+    return pd.merge(areas, vxdata, how='inner', on=['city', 'zip']).sort_values(by=['consumption'])
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_converted_columns_give_same_result(tmp_path, caplog, seed):
+    rng = np.random.default_rng(seed)
+    areas, config, tariff, costmodelinternal, costmodelprovision = random_reference(rng)
+    file_name = write_market_data(tmp_path, seed, 'file', (0.2, 0.2, 0.2))
+    
+    expected = calculate_bonus_stepwise(prepare_market_data_stepwise(file_name, areas.copy()), config.copy(),
+                                        tariff.copy(), costmodelinternal, costmodelprovision.copy())
+    with caplog.at_level(logging.INFO):
+        result = function3.calculate_shard('job', logger, file_name, False, areas.copy(), config.copy(),
+                                           tariff.copy(), costmodelinternal, costmodelprovision.copy())[0]
+    
+    assert_equal_up_to_step28_ties(expected, result)
+    conversions = [record.getMessage() for record in caplog.records if record.getMessage().startswith('Memory of ')]
+    assert [message.split(':')[0] for message in conversions] == ['Memory of zip, city, provider, rank at load',
+                                                                  'Memory of zip, city at Step 3',
+                                                                  'Memory of zip, city at Step 6']
+
+
+def done(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+@pytest.fixture
+def incremental(bucket, tmp_path, monkeypatch):
+    """
+    Today's market data file, yesterday's market data in the bucket with
+    changed market rows for ('01003', 'Köln') and (missing zip, 'Berlin'),
+    reference data with both pairs in areas and the calculation entries of
+    yesterday (in the calculation state) and today.
+    """
+    
+    monkeypatch.setattr(function3, 'CALCULATION_STATE_PATH', str(tmp_path / 'state.json'))
+    file_name = write_market_data(tmp_path, 0, 'file', (0.2, 0.2, 0.2))
+    
+    previous = pd.read_parquet(file_name)
+    changed_price = (previous['zip'] == '01003') & (previous['city'] == 'Köln')
+    previous.loc[changed_price, 'priceSumNet'] += 1
+    removed = np.flatnonzero(previous['zip'].isna() & (previous['city'] == 'Berlin'))[:1]
+    previous = previous.drop(index=previous.index[removed])
+    assert changed_price.sum() > 0 and len(removed) == 1
+    pq.write_table(pa.Table.from_pandas(previous), str(tmp_path / 'previous.parquet'))
+    bucket.upload_file(str(tmp_path / 'previous.parquet'), '20261017_Strom_Privat.parquet')
+    
+    areas, config, tariff, costmodelinternal, costmodelprovision = random_reference(np.random.default_rng(0))
+    areas = pd.concat([areas, pd.DataFrame({'zip': ['01003', None], 'city': ['Köln', 'Berlin'],
+                                            'area_collection': 'AC0', 'area_type': 'T0'})])
+    areas = areas.drop_duplicates(subset=['zip', 'city'], ignore_index=True)
+    reference = {'config': config, 'tariff': tariff, 'costmodelinternal': costmodelinternal,
+                 'costmodelprovision': costmodelprovision, 'areas': areas}
+    
+    reference_sha256 = function3.reference_fingerprint(list(reference.values()))
+    previous_entry = {'date': '20261017', 'market_key': '20261017_Strom_Privat.parquet',
+                      'market_etag': bucket.Object('20261017_Strom_Privat.parquet').e_tag.strip('"'),
+                      'reference_sha256': reference_sha256}
+    function3.write_calculation_state(7, previous_entry)
+    calculation_entry = {'date': '20261018', 'market_key': '20261018_Strom_Privat.parquet', 'market_etag': 'today',
+                         'reference_sha256': reference_sha256}
+    return file_name, str(tmp_path / 'previous.parquet'), reference, calculation_entry
+
+
+def plan_incremental(bucket, tmp_path, file_name, reference, calculation_entry):
+    os.makedirs(tmp_path / 'work', exist_ok=True)
+    return function3.plan_incremental(logger, bucket, str(tmp_path / 'work'), 7, calculation_entry, '20261017',
+                                      file_name, {name: done(df.copy()) for name, df in reference.items()})
+
+
+def test_plan_incremental_recalculates_changed_zip_cities(bucket, tmp_path, incremental):
+    file_name, _, reference, calculation_entry = incremental
+    
+    changed_areas = plan_incremental(bucket, tmp_path, file_name, reference, calculation_entry)
+    
+    areas = reference['areas']
+    changed = ((areas['zip'] == '01003') & (areas['city'] == 'Köln')) | (areas['zip'].isna() & (areas['city'] == 'Berlin'))
+    pd.testing.assert_frame_equal(changed_areas, areas[changed])
+
+
+def test_plan_incremental_unchanged_market_data(bucket, tmp_path, incremental):
+    file_name, _, reference, calculation_entry = incremental
+    calculation_entry = dict(calculation_entry, market_key='20261017_Strom_Privat.parquet',
+                             market_etag=function3.read_calculation_state(7)['market_etag'])
+    
+    changed_areas = plan_incremental(bucket, tmp_path, file_name, reference, calculation_entry)
+    
+    assert len(changed_areas) == 0 and list(changed_areas.columns) == list(reference['areas'].columns)
+
+
+@pytest.mark.parametrize('change', ['reference', 'date', 'market_etag'])
+def test_plan_incremental_calculates_all_zip_cities(bucket, tmp_path, incremental, change):
+    file_name, _, reference, calculation_entry = incremental
+    previous_entry = function3.read_calculation_state(7)
+    if change == 'reference':
+        reference['tariff'] = reference['tariff'].assign(basicrate=reference['tariff']['basicrate'] + 1)
+        calculation_entry = dict(calculation_entry,
+                                 reference_sha256=function3.reference_fingerprint(list(reference.values())))
+    elif change == 'date':
+        function3.write_calculation_state(7, dict(previous_entry, date='20261016'))
+    else:
+        function3.write_calculation_state(7, dict(previous_entry, market_etag='replaced'))
+    
+    assert plan_incremental(bucket, tmp_path, file_name, reference, calculation_entry) is None
+
+
+def test_read_carried_forward_drops_changed_zip_cities(monkeypatch):
+    yesterday = pd.DataFrame({'pid': ['P2', 'P1', 'P2', 'P1'], 'consumption_from': [0, 1000, 0, 0],
+                              'consumption_until': [999, 1999, 999, 999], 'nc': 1.0, 'ib': 2.0,
+                              'zip': ['01003', '01003', None, '01000'], 'city': ['Köln', 'Köln', 'Berlin', 'Berlin']})
+    monkeypatch.setattr(pd, 'read_sql', lambda sql, conn, chunksize: iter([yesterday.iloc[:3], yesterday.iloc[3:]]))
+    changed_areas = pd.DataFrame({'zip': ['01003', '01000', None], 'city': ['Köln', 'Köln', 'Berlin']})
+    
+    result = pd.concat(function3.read_carried_forward(logger, None, 7, changed_areas, np.array(['P1', 'P2'])))
+    
+    assert result['pid_id'].tolist() == [0] and result['zip'].tolist() == ['01000']
+    with pytest.raises(ValueError):
+        list(function3.read_carried_forward(logger, None, 7, changed_areas, np.array(['P2'])))
+
+
+def test_incremental_result_equals_full_recalculation(bucket, tmp_path, monkeypatch, incremental):
+    file_name, previous_file_name, reference, calculation_entry = incremental
+    tariff = reference['tariff']
+    _col_pid = np.array(['P%d' % pid_id for pid_id in range(tariff['pid_id'].max() + 1)], dtype=object)
+    
+    def calculate(file_name, areas):
+        return function3.calculate_shard('job', logger, file_name, False, areas.copy(), reference['config'].copy(),
+                                         tariff.copy(), reference['costmodelinternal'],
+                                         reference['costmodelprovision'].copy())[0]
+    
+    # yesterday's bonus_results as read_carried_forward() reads them
+    yesterday = calculate(previous_file_name, reference['areas'])
+    yesterday['pid'] = _col_pid.take(yesterday.pop('pid_id').values)
+    monkeypatch.setattr(pd, 'read_sql', lambda sql, conn, chunksize: iter([yesterday.astype({'zip': object,
+                                                                                            'city': object})]))
+    changed_areas = plan_incremental(bucket, tmp_path, file_name, reference, calculation_entry)
+    
+    result = pd.concat([calculate(file_name, changed_areas)] +
+                       list(function3.read_carried_forward(logger, None, 7, changed_areas, _col_pid)))
+    expected = calculate(file_name, reference['areas'])
+    
+    assert 0 < len(changed_areas) < len(reference['areas'])
+    function3.compare_results(expected, result.astype({'zip': object, 'city': object}))
+    with pytest.raises(ValueError):
+        function3.compare_results(expected, pd.concat([calculate(previous_file_name, changed_areas), result]))
+
+
+class ClosingConnection:
+    
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def reference_sql(monkeypatch, tmp_path):
+    """
+    SQL of the reference queries of a calculation, read through a stubbed
+    pd.read_sql (DataFrames as pymysql returns them, strings as str or None)
+    that records the queries it runs.
+    """
+    
+    areas, config, tariff, costmodelinternal, costmodelprovision = random_reference(np.random.default_rng(0))
+    tariff = tariff.assign(pid=tariff.pop('pid_id').map('P%d'.__mod__))
+    frames = dict(zip(['areas', 'config', 'tariff', 'costmodelinternal', 'costmodelprovision'],
+                      [areas, config, tariff, costmodelinternal, costmodelprovision]))
+    queries = function3.reference_queries(7, 'Strom')
+    results = {queries[name]: frames[name] for name in queries}
+    monkeypatch.setattr(function3, 'REFERENCE_CACHE_DIR', str(tmp_path / 'reference_cache'))
+    monkeypatch.setattr(function3, 'connect_mysql', lambda local_infile=False: ClosingConnection())
+    calls = []
+    monkeypatch.setattr(pd, 'read_sql', lambda sql, conn: calls.append(sql) or results[sql].copy())
+    return queries, calls
+
+
+@pytest.mark.parametrize('cache_key', [None, ('Strom', '20261018')])
+def test_read_sql_concurrently_equals_sequential_read_sql(reference_sql, cache_key):
+    queries, calls = reference_sql
+    expected = {name: pd.read_sql(sql, ClosingConnection()) for name, sql in queries.items()}
+    
+    # the second round reads the cached queries from the reference cache
+    for _ in range(2):
+        del calls[:]
+        futures = function3.read_sql_concurrently(logger, queries, function3.REFERENCE_STRING_COLUMNS,
+                                                  cache_key=cache_key)
+        
+        assert sorted(futures) == sorted(expected)
+        for name, future in futures.items():
+            pd.testing.assert_frame_equal(future.result(), expected[name])
+        assert futures['areas'].result()['zip'].dtype == object
+        assert futures['areas'].result()['zip'].isna().sum() > 0
+    
+    cached = [] if cache_key is None else function3.REFERENCE_CACHED_QUERIES
+    assert sorted(calls) == sorted(sql for name, sql in queries.items() if name not in cached)
+
+
+def test_reference_cache_hit_expiry_and_invalidation(monkeypatch, tmp_path):
+    monkeypatch.setattr(function3, 'REFERENCE_CACHE_DIR', str(tmp_path))
+    areas = pd.DataFrame({'zip': ['01067', None], 'city': ['Dresden', 'Köln'], 'area_collection': ['AC1', 'AC2']})
+    cache_path = function3.reference_cache_path('areas', 'Strom', '20261018', 'SELECT areas')
+    other_path = function3.reference_cache_path('areas', 'Gas', '20261018', 'SELECT areas')
+    function3.write_reference_cache(areas, cache_path)
+    function3.write_reference_cache(areas, other_path)
+    
+    # hit
+    pd.testing.assert_frame_equal(function3.read_reference_cache(cache_path, ttl=3600), areas)
+    
+    # expiry
+    os.utime(cache_path, (time.time() - 7200, time.time() - 7200))
+    assert function3.read_reference_cache(cache_path, ttl=3600) is None
+    assert function3.read_reference_cache(cache_path, ttl=10800) is not None
+    
+    # invalidation of one calculation type
+    assert function3.invalidate_reference_cache('areas', 'Strom') == 1
+    assert function3.read_reference_cache(cache_path) is None
+    assert function3.read_reference_cache(other_path) is not None
+    assert function3.invalidate_reference_cache() == 1
+    assert function3.read_reference_cache(other_path) is None
+
+
+def test_write_reference_cache_replaces_atomically(monkeypatch, tmp_path):
+    monkeypatch.setattr(function3, 'REFERENCE_CACHE_DIR', str(tmp_path))
+    cache_path = function3.reference_cache_path('tariff', 'Strom', '20261018', 'SELECT tariff')
+    old = pd.DataFrame({'pid': ['P1'], 'basicrate': [100.0]})
+    new = pd.DataFrame({'pid': ['P1', 'P2'], 'basicrate': [100.0, 120.0]})
+    function3.write_reference_cache(old, cache_path)
+    
+    # readers see the old snapshot until the new one is complete
+    write_table = pq.write_table
+    def checked_write_table(table, where, **kwargs):
+        pd.testing.assert_frame_equal(function3.read_reference_cache(cache_path), old)
+        write_table(table, where, **kwargs)
+        pd.testing.assert_frame_equal(function3.read_reference_cache(cache_path), old)
+    monkeypatch.setattr(function3.pq, 'write_table', checked_write_table)
+    function3.write_reference_cache(new, cache_path)
+    
+    pd.testing.assert_frame_equal(function3.read_reference_cache(cache_path), new)
+    assert os.listdir(os.path.dirname(cache_path)) == [os.path.basename(cache_path)]